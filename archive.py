@@ -0,0 +1,124 @@
+"""
+Archive of finished charging sessions.
+
+Removing a vehicle (departed, or taken off the queue early) deletes its live
+document but keeps its data on the removal's tombstone. When tombstones are
+pruned, ``storage.prune_tombstones`` writes the sessions they carry to the
+``session_archive`` in the same batch: one segment per station and day, its
+sessions stored as zlib-compressed JSON lines. The live ``vehicles``
+subcollections only ever hold current vehicles, and nothing is lost.
+
+Segments are partitioned by the station-time day of the removal, so
+``read_sessions`` only fetches the days of the range asked for and skips
+segments whose removals all fall outside it. Times inside archived sessions
+are epoch minutes (see ``timeutil``). Sessions are archived once their
+tombstone is pruned, so the newest hour or two is not in the archive yet.
+
+    python archive.py --from 2026-10-01 --to 2026-10-18 [--station ID] > sessions.jsonl
+"""
+import argparse
+import json
+import zlib
+from datetime import datetime, timedelta
+
+from timeutil import format_minutes, to_minutes
+
+ARCHIVE_ENCODING = "zlib-jsonl"
+
+# Most sessions stored in one segment; keeps segments far below Firestore's 1 MiB document limit
+ARCHIVE_SEGMENT_SESSIONS = 1000
+
+
+def archive_day(minutes):
+    """Partition key of a removal at ``minutes``: its station-time date."""
+    return format_minutes(minutes, "%Y-%m-%d")
+
+
+def _plain(value):
+    if isinstance(value, datetime):
+        return to_minutes(value)
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
+
+
+def session_record(station_id, vehicle_id, tombstone):
+    """The archived form of a removed vehicle, or None if its tombstone carries no session."""
+    session = tombstone.get("session")
+    if not session:
+        return None
+    record = _plain(session)
+    record.update(id=vehicle_id, station_id=station_id, removed_at=_plain(tombstone["removed_at"]),
+                  removed_version=tombstone.get("version"))
+    return record
+
+
+def build_segments(station_id, tombstones):
+    """
+    Archive segments for a station's pruned tombstones ({vehicle_id: tombstone}).
+    Segment ids are derived from their content's versions, so archiving the same
+    tombstones again overwrites rather than duplicates.
+    Returns:
+        dict: {segment_id: segment document}
+    """
+    by_day = {}
+    for vehicle_id, tombstone in tombstones.items():
+        record = session_record(station_id, vehicle_id, tombstone)
+        if record is not None:
+            by_day.setdefault(archive_day(record["removed_at"]), []).append(record)
+    segments = {}
+    for day, records in by_day.items():
+        records.sort(key=lambda record: (record["removed_at"], record["removed_version"] or 0))
+        for start in range(0, len(records), ARCHIVE_SEGMENT_SESSIONS):
+            chunk = records[start:start + ARCHIVE_SEGMENT_SESSIONS]
+            versions = [record["removed_version"] or 0 for record in chunk]
+            lines = "\n".join(json.dumps(record, separators=(",", ":"), sort_keys=True) for record in chunk)
+            segments[f"{station_id}_{day}_{min(versions)}-{max(versions)}"] = {
+                "station_id": station_id,
+                "day": day,
+                "first_removed_at": chunk[0]["removed_at"],
+                "last_removed_at": chunk[-1]["removed_at"],
+                "count": len(chunk),
+                "encoding": ARCHIVE_ENCODING,
+                "data": zlib.compress(lines.encode(), 6),
+            }
+    return segments
+
+
+def decode_segment(segment):
+    """The sessions stored in a segment, oldest removal first."""
+    if segment.get("encoding") != ARCHIVE_ENCODING:
+        raise ValueError(f"Unknown archive encoding: {segment.get('encoding')}")
+    return [json.loads(line) for line in zlib.decompress(segment["data"]).decode().splitlines()]
+
+
+def read_sessions(storage, start, end, station_id=None):
+    """
+    Archived sessions removed in ``[start, end)`` (epoch minutes), per segment in
+    the order they were stored, optionally for one station only.
+    """
+    if end <= start:
+        return
+    segments = storage.list_archive_segments(archive_day(start), archive_day(end - 1), station_id)
+    for segment in segments:
+        if segment["last_removed_at"] < start or segment["first_removed_at"] >= end:
+            continue
+        for session in decode_segment(segment):
+            if start <= session["removed_at"] < end:
+                yield session
+
+
+if __name__ == "__main__":
+    from storage import get_storage
+
+    parser = argparse.ArgumentParser(description="Export archived charging sessions as JSON lines")
+    parser.add_argument("--from", dest="start", required=True, help="first day, YYYY-MM-DD (station time)")
+    parser.add_argument("--to", dest="end", required=True, help="last day, YYYY-MM-DD (station time)")
+    parser.add_argument("--station", help="only this station")
+    args = parser.parse_args()
+    start = to_minutes(datetime.strptime(args.start, "%Y-%m-%d"))
+    end = to_minutes(datetime.strptime(args.end, "%Y-%m-%d") + timedelta(days=1))
+    for session in read_sessions(get_storage(), start, end, args.station):
+        print(json.dumps(session, sort_keys=True))
@@ -1,54 +1,52 @@
-from flask import Flask, request, jsonify, session, redirect, url_for, render_template
-import firebase_admin
-from firebase_admin import credentials, auth, firestore
-from datetime import datetime, date, timedelta
+from flask import Blueprint, Flask, Response, request, jsonify, session, redirect, url_for, render_template
+from datetime import datetime, timedelta, timezone
+import json
+import logging
 import os
+import random
+import threading
+import time
+from collections import Counter
 from functools import wraps
 from dotenv import load_dotenv
+from storage import get_storage, gather, Increment, CommitTooLarge, VersionConflict, MAX_BATCH_OPS
+from slots import (TimelineCache, build_timeline, build_queue_view, listed_at_version, slot_free_at_map,
+                   wait_from_slot_free_at, timeline_from_slot_free_at, wait_forecast, forecast_is_current,
+                   forecast_points)
+from timeutil import (now_minutes, to_timestamp, format_minutes, parse_local, vehicle_minutes, resolve_arrival,
+                      ARRIVAL_WINDOW_MINUTES)
+from events import EventBus
+from charging import estimate_charging, estimate_charging_batch
+from geo import StationIndex, station_entry, station_index_snapshot
+from rollups import ROLLUP_FIELDS, period_range, period_start, summarize
+from outbox import get_outbox, outbox_stats, RateLimited, OutboxFull
+import metrics
+import numpy as np
 
 load_dotenv()
-# --- SendGrid imports ---
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
 
-app = Flask(__name__, static_folder='static')
-app.secret_key = os.environ.get("FLASK_SECRET_KEY", "fallback_secret_for_dev_only") # Required for Flask sessions
+# Routes live on a blueprint so the app itself is only built by create_app(). Storage
+# (Firestore in production; STORAGE_BACKEND=memory runs without Firebase credentials),
+# SendGrid and the scheduler are set up on first use, not when this module is imported.
+bp = Blueprint("main", __name__)
 
-print("Initializing Firebase...") 
-
-# Use environment variable for credential path in deployment, fallback to local file for development
-firebase_cred_path = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS")
-cred = credentials.Certificate(firebase_cred_path)
-firebase_admin.initialize_app(cred)
-db = firestore.client()
-print("Firebase initialized successfully!")  # Debug print
+# Request handling logs here instead of printing (see create_app for the level)
+logger = logging.getLogger(__name__)
 
 # ==================== EMAIL OTP SENDER ====================
 def send_otp_email(receiver_email, otp):
     """
-    Send an OTP email using SendGrid API.
-    Credentials are loaded from environment variables:
-    - SENDGRID_API_KEY
-    - EMAIL_SENDER
+    Queue an OTP email; the outbox sends it in the background (SendGrid, or the
+    stub transport with EMAIL_TRANSPORT=stub), retrying if delivery fails.
+    Raises:
+        RateLimited: the address has been sent too many emails recently
+        OutboxFull: the outbox is not accepting more mail right now
     """
-    sender_email = os.environ.get("EMAIL_SENDER")
-    sendgrid_api_key = os.environ.get("SENDGRID_API_KEY")
-    if not sender_email or not sendgrid_api_key:
-        raise Exception("SendGrid credentials not set in environment variables.")
-
-    message = Mail(
-        from_email=sender_email,
-        to_emails=receiver_email,
-        subject="Your Easy Vahan Login Credentials Reset Request",
-        plain_text_content=f"Your OTP is: {otp}\n\nThis OTP is valid for 5 minutes.\nIf you did not request this, please ignore this email.\n\nThanks,\nEasy Vahan Team"
+    get_outbox().send(
+        receiver_email,
+        "Your Easy Vahan Login Credentials Reset Request",
+        f"Your OTP is: {otp}\n\nThis OTP is valid for 5 minutes.\nIf you did not request this, please ignore this email.\n\nThanks,\nEasy Vahan Team"
     )
-    try:
-        sg = SendGridAPIClient(sendgrid_api_key)
-        response = sg.send(message)
-        print(f"OTP sent to {receiver_email}, status code: {response.status_code}")
-    except Exception as e:
-        print(f"Error sending OTP email: {e}")
-        raise
 
 
 # Custom Exception Classes
@@ -79,38 +77,127 @@ class NotFoundError(InvalidUsage):
 class CalculationError(InvalidUsage):
     status_code = 500
 
-print("Starting application...")  # Debug print
+# Slot timelines of the stations this worker has served
+timelines = TimelineCache()
 
-def ev_charging_time(current_percent, target_percent, charger_power_kw, battery_capacity_kwh,
-                     charging_efficiency=0.9):
-    """Calculate charging time using a modified logistic model, handling edge cases"""
-    if not (0 <= current_percent <= 100 and 0 <= target_percent <= 100):
-        raise ValueError("Percentages must be between 0 and 100")
-    
-    # Special cases to avoid math errors
-    if current_percent >= target_percent:
-        return 0.0
-    if current_percent == 0:
-        current_percent = 0.1  # Avoid division by zero
-    if target_percent == 100:
-        target_percent = 99.9  # Avoid division by zero
-
-    percent_to_charge = target_percent - current_percent
-    energy_needed_kwh = (percent_to_charge / 100) * battery_capacity_kwh
-    charge_time_hours = energy_needed_kwh / (charger_power_kw * charging_efficiency)
-    return charge_time_hours
-
-@app.route("/")
+def station_counters(station_id, station_data):
+    """
+    The counters kept on the station document. Stations that predate them are
+    recounted from their vehicles once, which also stores the counters.
+    """
+    if "vehicle_count" not in station_data:
+        station_data.update(get_storage().reconcile_counters(station_id))
+    return station_data
+
+def live_charging_count(station_id, station_data):
+    """CHARGING vehicles, including WAITING ones past their start time that the scheduler has not promoted yet."""
+    charging = station_counters(station_id, station_data).get("charging_count", 0)
+    return charging + len(get_slot_timeline(station_id, station_data).promoted_by(now_minutes()))
+
+# How long removed vehicles are remembered for delta syncs of the vehicles API
+TOMBSTONE_RETENTION = timedelta(hours=1)
+
+def get_slot_timeline(station_id, station_data):
+    """Return the station's slot timeline, rebuilding it from storage only when it is stale."""
+    version = station_data.get('vehicles_version', 0)
+    total_slots = station_data.get('total_slots', 0)
+    timeline = timelines.get(station_id, version, total_slots)
+    if timeline is None:
+        timeline = build_timeline(get_storage().list_vehicles(station_id), total_slots, version)
+        timelines.put(station_id, timeline)
+    return timeline
+
+def read_station_schedule(station_id, *also):
+    """
+    Read the station document and its slot timeline, plus the results of the
+    independent backend calls ``also``, all at once. Without a cached timeline the
+    vehicles are listed alongside the station read; if that listing does not match
+    the version read they are listed again once the version is known.
+    Returns:
+        tuple: (station data or None, timeline or None, *results of ``also``)
+    """
+    cold = station_id not in timelines
+    calls = [lambda: get_storage().get_station(station_id)]
+    if cold:
+        calls.append(lambda: get_storage().list_vehicles(station_id))
+    results = gather(*calls, *also)
+    station_data, results = results[0], results[1:]
+    vehicles = results.pop(0) if cold else None
+    if station_data is None:
+        return (None, None, *results)
+    version = station_data.get('vehicles_version', 0)
+    if vehicles is not None and listed_at_version(vehicles, version):
+        timelines.put(station_id, build_timeline(vehicles, station_data.get('total_slots', 0), version))
+    return (station_data, get_slot_timeline(station_id, station_data), *results)
+
+# Changes planned from a station's schedule are committed only if the station has not moved
+# on since it was read; otherwise they are planned again, at most this many times in all
+ADMISSION_ATTEMPTS = int(os.environ.get("ADMISSION_ATTEMPTS", 5))
+ADMISSION_BACKOFF_SECONDS = float(os.environ.get("ADMISSION_BACKOFF_SECONDS", 0.02))
+
+# How often this process's planned changes ran into a concurrent write
+admission_stats = Counter()
+_admission_stats_lock = threading.Lock()
+
+def _count_admission(kind):
+    with _admission_stats_lock:
+        admission_stats[kind] += 1
+
+def commit_planned_change(station_id, plan, station_data=None):
+    """
+    Plan a vehicle change against the station's current schedule and commit it only
+    if no other write landed in between, so two requests can never hand out the
+    same slot time. On a conflict the station is read again, the timeline rebuilt
+    and the change planned again after a short randomized backoff.
+
+    ``plan(station_data, timeline)`` returns ``(changes, apply)``: keyword arguments
+    for ``commit_vehicle_changes`` and a function applying the change to a timeline.
+    ``station_data`` may be passed if the caller has just read it.
+    Returns:
+        tuple: (station data the committed plan was made from, new version, conflicts)
+    Raises:
+        InvalidUsage: 409 if every attempt conflicted
+    """
+    for attempt in range(ADMISSION_ATTEMPTS):
+        if station_data is None:
+            station_data, timeline = read_station_schedule(station_id)
+            if station_data is None:
+                raise NotFoundError("Station not found!")
+        else:
+            timeline = get_slot_timeline(station_id, station_data)
+        version = station_data.get('vehicles_version', 0)
+        changes, apply = plan(station_data, timeline)
+        if attempt:
+            # Contention is also counted on the station, in the write that finally succeeds
+            changes["station_updates"] = dict(changes.get("station_updates") or {},
+                                              admission_conflicts=Increment(attempt))
+        try:
+            new_version = get_storage().commit_vehicle_changes(station_id, expected_version=version, **changes)
+        except VersionConflict as e:
+            _count_admission("conflicts")
+            logger.info(f"Admission conflict on station '{station_id}' (attempt {attempt + 1}): {e}")
+            station_data = None
+            time.sleep(random.uniform(0, ADMISSION_BACKOFF_SECONDS * (attempt + 1)))
+            continue
+        _count_admission("commits")
+        timelines.advance(station_id, version, new_version, apply)
+        return station_data, new_version, attempt
+    _count_admission("exhausted")
+    raise InvalidUsage("The station is busy right now, please try again.", status_code=409)
+
+logger.debug("Starting application...")
+
+@bp.route("/")
 def index():
     """Render the main index page."""
     return render_template("index.html")
 
-@app.route("/driver")
+@bp.route("/driver")
 def driver():
     """Render the driver page."""
     return render_template("driver.html")
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login_register():
     """Render login form (GET) and handle login/register (POST)."""
 
@@ -124,23 +211,20 @@ def login_register():
         else:
             data = request.form.to_dict()
 
-        print(f"📨 Received Data: {data}")  # Debug
-
         action = data.get("action")  # login or register
         station_id = data.get("station_id")
         access_key = data.get("access_key")
+        logger.debug(f"📨 Received {action} request for station '{station_id}'")  # Never log the access key
 
         if not station_id or not access_key:
             return jsonify({"error": "Missing station ID or access key!"}), 400
 
-        doc_ref = db.collection("charging_stations").document(station_id)
-
         if action == "login":
-            doc = doc_ref.get()
-            if not doc.exists:
+            # Never check an access key against a cached copy: it may have just been reset elsewhere
+            station_data = get_storage().get_station(station_id, cached=False)
+            if station_data is None:
                 return jsonify({"error": "Station ID not found!"}), 404
 
-            station_data = doc.to_dict()
             if station_data["access_key"] == access_key:
                 session["station_id"] = station_id
                 return jsonify({
@@ -155,16 +239,13 @@ def login_register():
             if not email:
                 return jsonify({"error": "Missing email!"}), 400
 
-            if doc_ref.get().exists:
+            if get_storage().get_station(station_id, cached=False) is not None:
                 return jsonify({"error": "Station ID already exists!"}), 400
 
-            stations_ref = db.collection("charging_stations")
-            email_query = stations_ref.where("email", "==", email.lower().strip()).limit(1)
-            email_docs = list(email_query.stream())
-            if email_docs:
+            if get_storage().find_station_by_email(email.lower().strip()) is not None:
                 return jsonify({"error": "This email is already registered!"}), 400
 
-            doc_ref.set({
+            get_storage().create_station(station_id, {
                 "station_id": station_id,
                 "access_key": access_key,
                 "email": email.lower().strip()
@@ -179,11 +260,11 @@ def login_register():
         return jsonify({"error": "Invalid action!"}), 400
 
     except Exception as e:
-        print(f" Error: {e}")
+        logger.exception(f"Login or registration failed: {e}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
 
-@app.route("/reset-access-key", methods=["POST"])
+@bp.route("/reset-access-key", methods=["POST"])
 def reset_access_key():
     data = request.json
     station_id = data.get("station_id")
@@ -192,13 +273,14 @@ def reset_access_key():
     if not station_id and not email:
         return jsonify({"success": False, "message": "Missing Station ID or Email!"}), 400
 
-    doc_ref = db.collection("charging_stations").document(station_id)
-    doc = doc_ref.get()
+    station_data = get_storage().get_station(station_id, cached=False)
 
-    if doc.exists:
-        station_data = doc.to_dict()
+    if station_data is not None:
         if station_data.get("email") == email:
-            print(f"Simulating sending reset link to {email} for Station ID: {station_id}")
+            # Checked before a new OTP replaces one that may still be on its way
+            if not get_outbox().allows(email):
+                return jsonify({"success": False, "message": "Too many reset requests for this email, please try again later."}), 429
+            logger.info(f"Sending reset OTP to {email} for Station ID: {station_id}")
             # --- Email Sending Integration ---
             # Generate a secure random 6-digit OTP
             import secrets
@@ -206,175 +288,62 @@ def reset_access_key():
             otp = str(secrets.randbelow(900000) + 100000)
             # Store OTP with expiration time (5 minutes from now)
             otp_expiry = datetime.now(timezone.utc) + timedelta(minutes=5)
-            doc_ref.update({
-                'reset_otp': otp,
-                'reset_otp_expiry': otp_expiry
-            })
-            send_otp_email(email, otp)
-            print(f"Successfully sent OTP to {email}")
+            get_storage().set_reset_otp(station_id, otp, otp_expiry)
+            try:
+                send_otp_email(email, otp)
+            except RateLimited:
+                return jsonify({"success": False, "message": "Too many reset requests for this email, please try again later."}), 429
+            except OutboxFull:
+                return jsonify({"success": False, "message": "Email is delayed right now, please try again in a few minutes."}), 503
+            logger.info(f"Queued OTP email to {email}")
             return jsonify({"success": True, "message": "OTP sent to your registered email. Enter the OTP to reset your access key."}), 200
         else:
             return jsonify({"success": False, "message": "Station ID and Email do not match."}), 404
     else:
         return jsonify({"success": False, "message": "Station ID not found."}), 404
 
-def update_vehicle_statuses(vehicles_ref):
-    """Update vehicle statuses based on current time."""
-    now = datetime.now()
-    batch = db.batch()
-    updated_count = 0
-    
-    for vehicle_doc in vehicles_ref.stream():
-        vehicle_data = vehicle_doc.to_dict()
-        vehicle_ref = vehicles_ref.document(vehicle_doc.id)
-        
-        # Only update if status is WAITING and charging start time has passed
-        if (vehicle_data.get('status') == 'WAITING' and 
-            'charging_start_time' in vehicle_data):
-            try:
-                start_time = datetime.strptime(
-                    vehicle_data['charging_start_time'], 
-                    '%Y-%m-%d %H:%M'
-                )
-                if now >= start_time:
-                    batch.update(vehicle_ref, {'status': 'CHARGING'})
-                    batch.update(vehicle_ref, {'wait_time_minutes': 0})
-                    updated_count += 1
-            except (ValueError, TypeError) as e:
-                print(f"Error parsing charging time for vehicle {vehicle_doc.id}: {e}")
-    
-    # Commit all updates in a single batch
-    if updated_count > 0:
-        batch.commit()
-        print(f"Updated {updated_count} vehicle(s) to CHARGING status.")
-    
-    return updated_count
-
-@app.route("/dashboard")
+@bp.route("/dashboard")
 def dashboard():
     if "station_id" not in session:
-        print("No station_id found in session!")  # Debugging
-        return redirect(url_for("login_register"))  # Redirect to login if session is missing
+        logger.debug("No station_id found in session!")
+        return redirect(url_for(".login_register"))  # Redirect to login if session is missing
 
     station_id = session["station_id"]
-    print(f"Station ID from session: {station_id}")  # Debugging
 
-    doc_ref = db.collection("charging_stations").document(station_id)
-    doc = doc_ref.get()
-    
-    # Update vehicle statuses before fetching them
-    if doc.exists:
-        vehicles_ref = doc_ref.collection("vehicles")
-        update_vehicle_statuses(vehicles_ref)
-
-    if doc.exists:
-        station_data = doc.to_dict()
-        print("Station data loaded for dashboard:", station_data) # Debug print
-        print("Station Charging Type from DB:", station_data.get("chargingType")) # Debug print for charging type
-        
-        # Fetch vehicles associated with this station from the vehicles subcollection
-        vehicles_ref = db.collection("charging_stations").document(station_id).collection("vehicles").order_by("arrival_time")
-        vehicles = []
-        now = datetime.now()
-        
-        for doc in vehicles_ref.stream():
-            vehicle_data = doc.to_dict()
-            vehicle_data["id"] = doc.id  # Add the document ID to the vehicle data
-            
-            # Ensure all required fields exist with defaults
-            vehicle_data['status'] = vehicle_data.get('status', 'WAITING').upper()
-            
-            try:
-                # Parse and format times from stored values
-                if 'arrival_time' in vehicle_data:
-                    arrival_dt = datetime.strptime(vehicle_data['arrival_time'], '%Y-%m-%d %H:%M')
-                    vehicle_data['arrival_dt'] = arrival_dt
-                    
-                    # Use stored charging_start_time if available
-                    if 'charging_start_time' in vehicle_data and vehicle_data['charging_start_time']:
-                        charging_start_dt = datetime.strptime(
-                            vehicle_data['charging_start_time'], 
-                            '%Y-%m-%d %H:%M'
-                        )
-                        vehicle_data['start_time'] = vehicle_data['charging_start_time']
-                        
-                        # Use stored departure_time if available
-                        if 'departure_time' in vehicle_data and vehicle_data['departure_time']:
-                            departure_dt = datetime.strptime(
-                                vehicle_data['departure_time'], 
-                                '%Y-%m-%d %H:%M'
-                            )
-                            vehicle_data['end_time'] = vehicle_data['departure_time']
-                        else:
-                            # Calculate departure_time if missing
-                            charging_time = vehicle_data.get('charging_time_minutes', 0)
-                            departure_dt = charging_start_dt + timedelta(minutes=int(charging_time))
-                            vehicle_data['end_time'] = departure_dt.strftime('%Y-%m-%d %H:%M')
-                            
-                        # Update status based on current time
-                        if vehicle_data['status'] == 'WAITING' and now >= charging_start_dt:
-                            vehicle_data['status'] = 'CHARGING'
-                    
-                    vehicles.append(vehicle_data)
-                    
-            except Exception as e:
-                print(f"Error processing vehicle {doc.id}: {e}")
-                continue
-
-        # --- Calculate slot free times based on vehicle schedules ---
-        slot_free_time = {}
-        total_slots = int(station_data.get('totalSlots') or station_data.get('total_slots') or 2)
-        
-        # Group vehicles by slot
-        slot_vehicles = {i: [] for i in range(1, total_slots + 1)}
-        for v in vehicles:
-            slot = int(v.get('slot_number', 1))
-            if 1 <= slot <= total_slots:
-                slot_vehicles[slot].append(v)
-        
-        # Calculate free time for each slot
-        for slot, slot_vs in slot_vehicles.items():
-            # Sort vehicles in this slot by start time
-            slot_vs_sorted = sorted(
-                [v for v in slot_vs if 'start_time' in v and 'end_time' in v],
-                key=lambda x: x['start_time']
-            )
-            
-            if not slot_vs_sorted:
-                slot_free_time[slot] = now.strftime('%Y-%m-%d %H:%M')
-                continue
-                
-            # Find the latest end time in this slot
-            last_end = max(
-                [datetime.strptime(v['end_time'], '%Y-%m-%d %H:%M') for v in slot_vs_sorted]
-            )
-            
-            # Add 1-minute buffer after the last vehicle
-            slot_free_time[slot] = (last_end + timedelta(minutes=1)).strftime('%Y-%m-%d %H:%M')
-        
-        print("Slot free times with 1-minute buffer:", slot_free_time)
-        
-        # Use the latest wait time from the database (updated by the scheduled job)
-        wait_minutes = station_data.get('latest_wait_time_minutes', 0)
-        print(f"Current wait time from database: {wait_minutes} minutes")
-
-        # Dynamically calculate available slots just before rendering
-        total_slots = station_data.get('totalSlots') or station_data.get('total_slots')
-        charging_count = sum(1 for v in vehicles if v.get('status', '').upper() == 'CHARGING')
-        available_slots = max(int(total_slots) - charging_count, 0) if total_slots else 0
+    # The station and its vehicles are read at the same time
+    station_data, stored_vehicles = gather(lambda: get_storage().get_station(station_id),
+                                           lambda: get_storage().list_vehicles(station_id))
+
+    if station_data is not None:
+        logger.debug(f"Dashboard for station '{station_id}', charging type {station_data.get('chargingType')}")
+
+        # Fetch vehicles once; statuses, slot free times and available slots are all derived from this read
+        now = now_minutes()
+        vehicles, slot_free_time, available_slots, timeline = build_queue_view(stored_vehicles, station_data, now)
+        # Read concurrently, the vehicles may predate the station version; cache only a matching timeline
+        if (listed_at_version(stored_vehicles, timeline.version)
+                and timelines.get(station_id, timeline.version, timeline.total_slots) is None):
+            timelines.put(station_id, timeline)
+
+        # The wait time shown is the one the scheduled job stored
+        logger.debug(f"Slot free times with 1-minute buffer: {slot_free_time}; "
+                     f"wait time from database: {station_data.get('latest_wait_time_minutes', 0)} minutes")
+
+        # The forecast is the one the scheduled job stored, as of its last sweep
+        wait_forecast_points = forecast_json(station_data.get('wait_forecast'), now)
         google_maps_api_key = os.environ.get("GOOGLE_MAPS_API_KEY")
-        return render_template("dashboard.html", station=station_data, vehicles=vehicles, slot_free_time=slot_free_time, available_slots=available_slots, google_maps_api_key=google_maps_api_key)  # Pass vehicles data and dynamic available_slotsa and dynamic available_slots
+        return render_template("dashboard.html", station=station_data, station_id=station_id, vehicles=vehicles, slot_free_time=slot_free_time, available_slots=available_slots, wait_forecast=wait_forecast_points, google_maps_api_key=google_maps_api_key)  # Pass vehicles data and dynamic available_slotsa and dynamic available_slots
     else:
         return "Error: Station not found", 404
 
 
-@app.route("/update_station", methods=["POST"])
+@bp.route("/update_station", methods=["POST"])
 def update_station():
     if "station_id" not in session:
         raise UnauthorizedError("Not logged in!")
 
     data = request.json
-    print("Update Station Data:", data)  # Debug print
+    logger.debug(f"Update station data: {data}")
     station_id = session["station_id"]
 
     # Validate required fields for update
@@ -393,11 +362,12 @@ def update_station():
     if charging_rate <= 0:
         raise InvalidUsage("Charging rate must be a positive number.")
 
+    station_data = get_storage().get_station(station_id)
+    if station_data is None:
+        raise NotFoundError("Station not found!")
+
     # Get current vehicles charging
-    doc_ref = db.collection("charging_stations").document(station_id)
-    vehicles_ref = doc_ref.collection("vehicles")
-    charging_vehicles = [doc.to_dict() for doc in vehicles_ref.stream() if doc.to_dict().get('status', '').upper() == 'CHARGING']
-    charging_count = len(charging_vehicles)
+    charging_count = live_charging_count(station_id, station_data)
     # available_slots = total_slots - charging_count, but never below 0
     available_slots = max(total_slots - charging_count, 0)
 
@@ -413,56 +383,24 @@ def update_station():
         "longitude": float(data.get("longitude")) if data.get("longitude") else None
     }
 
-    doc_ref = db.collection("charging_stations").document(station_id)
-    if not doc_ref.get().exists:
-        raise NotFoundError("Station not found!")
-
     try:
-        doc_ref.update(update_data)
-        updated_doc = doc_ref.get()
-        print("Updated document data:", updated_doc.to_dict())  # Debug print
+        get_storage().update_station(station_id, update_data)
+        logger.debug(f"Updated station fields: {update_data}")
         return jsonify({"message": "Station details updated successfully!"}), 200
     except Exception as e:
-        import traceback
-        print(f"An error occurred during station update: {e}")
-        print(traceback.format_exc())
+        logger.exception(f"An error occurred during station update: {e}")
         raise InvalidUsage(f"An error occurred while updating station details: {str(e)}", status_code=500)
 
-def estimate_final_battery(initial_battery_level, charging_time_minutes, battery_capacity_kWh, charging_type):
-    """
-    Estimate the final battery percentage after a given charging time.
-    Args:
-        initial_battery_level (float): Initial battery percentage (0-100)
-        charging_time_minutes (int): Charging time in minutes
-        battery_capacity_kWh (float): Battery capacity in kWh
-        charging_type (str): Type of charger (AC Type 1, AC Type 2, CCS, CHAdeMO, GB/T)
-    Returns:
-        float: Estimated final battery percentage (capped at 100)
-    """
-    # Charging speeds (kW) and efficiencies by type
-    charging_speeds = {
-        "AC Type 1": 7.4, "AC Type 2": 22.0, "CCS": 150.0, "CHAdeMO": 62.5, "GB/T": 120.0
-    }
-    charging_efficiencies = {
-        "AC Type 1": 0.85, "AC Type 2": 0.88, "CCS": 0.92, "CHAdeMO": 0.92, "GB/T": 0.90
-    }
-    charger_power = charging_speeds.get(charging_type, 7.4)
-    efficiency = charging_efficiencies.get(charging_type, 0.85)
-    hours = charging_time_minutes / 60.0
-    energy_added = charger_power * hours * efficiency  # kWh
-    percent_added = (energy_added / battery_capacity_kWh) * 100
-    final_percent = initial_battery_level + percent_added
-    final_percent = min(max(final_percent, 0), 100)
-    # Round to nearest whole number for consistency with frontend
-    return round(final_percent)
-
-@app.route("/add_vehicle", methods=["POST"])
+# Vehicles can be booked up to this many days ahead
+BOOKING_HORIZON_DAYS = int(os.environ.get("BOOKING_HORIZON_DAYS", 30))
+
+@bp.route("/add_vehicle", methods=["POST"])
 def add_vehicle():
     if "station_id" not in session:
         raise UnauthorizedError("Not logged in!")
 
     data = request.json
-    print("Add Vehicle Data:", data)  # Debug print
+    logger.debug(f"Add vehicle data: {data}")
     station_id = session["station_id"]
 
     # Validate required fields
@@ -510,174 +448,84 @@ def add_vehicle():
         if charging_time_minutes <= 0:
             raise InvalidUsage("Charging time in minutes must be greater than 0.")
 
+    # Arrival in epoch minutes; a bare HH:MM is the occurrence nearest now, so it may be tomorrow
+    now = now_minutes()
+    try:
+        arrival = resolve_arrival(arrival_time_str, data.get("arrivalDate"), now)
+    except ValueError:
+        raise InvalidUsage("Arrival time must be HH:MM, optionally with an arrival date (YYYY-MM-DD).")
+    # A late entry for last night is fine (like a bare HH:MM just after midnight); older ones are not
+    if arrival < min(period_start(now, "day"), now - ARRIVAL_WINDOW_MINUTES):
+        raise InvalidUsage("Arrival cannot be before today.")
+    if arrival > now + BOOKING_HORIZON_DAYS * 24 * 60:
+        raise InvalidUsage(f"Arrival can be at most {BOOKING_HORIZON_DAYS} days ahead.")
+
     try:
         # Prioritize minutes if provided
-        estimated_final_battery = None
+        estimate = estimate_charging(chargingType, initial_battery_level, battery_capacity,
+                                     target_soc=target_battery_level, minutes=charging_time_minutes)
+        charging_time_min = estimate["minutes"]
+        charging_cost = estimate["cost"]
         if charging_time_minutes is not None:
-            charging_time_min = charging_time_minutes
-            # Charging cost calculation for charging_time_minutes scenario (match frontend logic)
-            charging_speeds = {
-        "AC Type 1": 7.4,    # 7.4 kW
-        "AC Type 2": 22.0,   # 22 kW
-        "CCS": 150.0,        # 150 kW
-        "CHAdeMO": 62.5,    # 62.5 kW
-        "GB/T": 120.0        # 120 kW
-    }
-            charging_efficiency = {
-    "AC Type 1": 0.85,
-    "AC Type 2": 0.88,
-    "CCS": 0.92,
-    "CHAdeMO": 0.92,
-    "GB/T": 0.90
-}
-            charging_rates = {
-                "AC Type 1": 15, "AC Type 2": 18, "CCS": 25, "CHAdeMO": 25, "GB/T": 20
-            }
-            charger_power = charging_speeds.get(chargingType, 7.4)
-            efficiency = charging_efficiency.get(chargingType, 0.90)
-            rate = charging_rates.get(chargingType, 18)
-            hours = charging_time_minutes / 60.0
-            energy_added = charger_power * hours * efficiency
-            max_energy_addable = ((100 - initial_battery_level) / 100) * battery_capacity
-            usable_energy = min(energy_added, max_energy_addable)
-            charging_cost = (usable_energy / efficiency) * rate
-            # Calculate estimated final battery percentage
-            estimated_final_battery = estimate_final_battery(
-                initial_battery_level, charging_time_minutes, battery_capacity, chargingType
-            )
+            # Round to nearest whole number for consistency with frontend
+            estimated_final_battery = round(estimate["final_soc"])
         else:
-            # Unify cost calculation for target battery scenario
-            charging_speeds = {
-                "AC Type 1": 7.4,    # 7.4 kW
-                "AC Type 2": 22.0,   # 22 kW
-                "CCS": 150.0,        # 150 kW
-                "CHAdeMO": 62.5,    # 62.5 kW
-                "GB/T": 120.0        # 120 kW
-            }
-            charging_efficiency = {
-    "AC Type 1": 0.85,
-    "AC Type 2": 0.88,
-    "CCS": 0.92,
-    "CHAdeMO": 0.92,
-    "GB/T": 0.90
-}
-            charging_rates = {
-                "AC Type 1": 15, "AC Type 2": 18, "CCS": 25, "CHAdeMO": 25, "GB/T": 20
-            }
-            charger_power = charging_speeds.get(chargingType, 7.4)
-            efficiency = charging_efficiency.get(chargingType, 0.90)
-            rate = charging_rates.get(chargingType, 18)
-            energy_needed_kwh = (target_battery_level - initial_battery_level) / 100 * battery_capacity
-            energy_from_grid = energy_needed_kwh / efficiency
-            charging_cost = energy_from_grid * rate
-            # Charging time calculation (as before, using efficiency)
-            charging_time_hours = energy_needed_kwh / (charger_power * efficiency)
-            charging_time_min = charging_time_hours * 60
             estimated_final_battery = target_battery_level
 
-        # Parse arrival_time string to datetime object (assuming format HH:MM)
-        today = date.today()
-        arrival_datetime_obj = datetime.strptime(f"{today} {arrival_time_str}", "%Y-%m-%d %H:%M")
-
-        # --- Wait time calculation: minimum of (max departure time per slot - arrival time) ---
-        station_doc_ref = db.collection("charging_stations").document(station_id)
-        station_snapshot = station_doc_ref.get()
-        total_slots = 0
-        if station_snapshot.exists:
-            station_data = station_snapshot.to_dict()
-            total_slots = station_data.get('total_slots', 0)
-        vehicles_ref = station_doc_ref.collection("vehicles")
-        all_vehicles = [doc.to_dict() for doc in vehicles_ref.stream()]
-        from collections import defaultdict
-        slot_departures = defaultdict(list)
-        for v in all_vehicles:
-            slot = v.get('slot_number') or v.get('slot') or 1
-            dep_time = v.get('departure_time')
-            if dep_time:
-                try:
-                    dep_dt = datetime.strptime(dep_time, "%Y-%m-%d %H:%M")
-                    slot_departures[slot].append(dep_dt)
-                except Exception as e:
-                    print(f"Error parsing departure_time for vehicle {v.get('vehicle_number','?')}: {e}")
-        slot_waits = {}
-        print(f"New vehicle arrival time: {arrival_datetime_obj}")
-        for i in range(1, total_slots+1):
-            departures = slot_departures.get(i, [])
-            if departures:
-                max_dep = max(departures)
-            else:
-                max_dep = arrival_datetime_obj
-            wait = (max_dep - arrival_datetime_obj).total_seconds() // 60
-            slot_waits[i] = max(0, int(wait))
-            print(f"Slot {i}: max departure = {max_dep}, wait = {slot_waits[i]} min")
-        # Find slot with minimum wait and get its free time
-        assigned_slot_number = min(slot_waits, key=slot_waits.get, default=1)
-        wait_time_minutes = slot_waits[assigned_slot_number]
-        slot_number = assigned_slot_number
-        
-        # Calculate charging start time (slot's free time + 1 minute buffer)
-        if wait_time_minutes > 0:
-            # Add 1 minute to wait time to account for buffer
-            wait_time_minutes += 1
-            # Charging starts after wait time (which now includes buffer)
-            charging_start_datetime_obj = arrival_datetime_obj + timedelta(minutes=wait_time_minutes)
-            vehicle_status = "WAITING"
-        else:
-            # If no wait, charging starts at arrival time
-            charging_start_datetime_obj = arrival_datetime_obj
-            vehicle_status = "CHARGING"
-            
-        # Calculate departure time (charging start time + charging duration)
-        departure_datetime_obj = charging_start_datetime_obj + timedelta(minutes=round(charging_time_min))
-        
-        # Update wait time to be the difference between charging start and arrival
-        actual_wait_minutes = max(0, (charging_start_datetime_obj - arrival_datetime_obj).total_seconds() // 60)
-        
-        print("DEBUG: Reached point 1 in add_vehicle")  # Add this before the print statements in question
-        print(f"Assigned slot: {slot_number}, wait time: {actual_wait_minutes} min, status: {vehicle_status}")
-        print("DEBUG: Reached point 2 in add_vehicle")  # Add this after the print statements in question
-        print(f"Charging starts at: {charging_start_datetime_obj}, ends at: {departure_datetime_obj}")
+        # --- Wait time calculation: earliest start on any slot, including gaps between bookings ---
+        logger.debug(f"New vehicle arrival time: {format_minutes(arrival)}")
+        charging_minutes = round(charging_time_min)
+        new_vehicle_id = get_storage().new_vehicle_id(station_id)
+        booking = {}
+
+        def plan(station_data, timeline):
+            # A slot is free 1 minute after its previous vehicle departs; a gap is used if the whole charge fits
+            # An arrival in the past starts now at the earliest; its wait still counts from the arrival
+            slot_number, charging_start = timeline.place(arrival, charging_minutes, now)
+            # A vehicle booked for later waits until its start time even if a slot is free now
+            vehicle_status = "CHARGING" if charging_start <= now else "WAITING"
+            # Calculate departure time (charging start time + charging duration)
+            departure = charging_start + charging_minutes
+            wait_time_minutes = charging_start - arrival
+            booking.update(slot_number=slot_number, charging_start=charging_start, departure=departure,
+                           wait_time_minutes=wait_time_minutes, vehicle_status=vehicle_status,
+                           total_slots=station_data.get('total_slots', 0),
+                           charging_before=live_charging_count(station_id, station_data))
+
+            # Create vehicle data with charging calculations and wait time.
+            # Times are stored as timestamps only; display strings are derived when read.
+            vehicle_data = {
+                "vehicle_number": vehicle_number,
+                "arrival_ts": to_timestamp(arrival),
+                "charging_start_ts": to_timestamp(charging_start),
+                "departure_ts": to_timestamp(departure),
+                "chargingType": chargingType,
+                "estimated_final_battery": estimated_final_battery if estimated_final_battery is not None else None,
+                "initial_battery_level": initial_battery_level,
+                "target_battery_level": target_battery_level,
+                "battery_capacity": battery_capacity,
+                "charging_time_minutes": charging_minutes,
+                "charging_cost": round(charging_cost) if charging_cost is not None else None,
+                "wait_time_minutes": wait_time_minutes,
+                "status": vehicle_status,
+                "slot_number": slot_number
+            }
+            # Store the vehicle together with the station wait time in one atomic write
+            changes = {"added": {new_vehicle_id: vehicle_data},
+                       "station_updates": {"latest_wait_time_minutes": wait_time_minutes}}
+            return changes, lambda t: t.add(new_vehicle_id, slot_number, charging_start, departure,
+                                            vehicle_status == "WAITING", arrival)
+
+        _, _, conflicts = commit_planned_change(station_id, plan)
+        wait_time_minutes = booking["wait_time_minutes"]
+        departure = booking["departure"]
+        logger.debug(f"Assigned slot: {booking['slot_number']}, wait time: {wait_time_minutes} min, "
+                     f"status: {booking['vehicle_status']}, conflicts: {conflicts}, "
+                     f"charging {format_minutes(booking['charging_start'])} to {format_minutes(departure)}")
 
-        # Store station wait time in Firestore
-        try:
-            station_doc_ref.update({"latest_wait_time_minutes": actual_wait_minutes})
-        except Exception as e:
-            print(f"Warning: Could not update latest_wait_time_minutes for station {station_id}: {e}")
-        
-        # Format times as full datetime strings
-        arrival_time_full = arrival_datetime_obj.strftime("%Y-%m-%d %H:%M")
-        departure_time_full = departure_datetime_obj.strftime("%Y-%m-%d %H:%M")
-        charging_start_time_full = charging_start_datetime_obj.strftime("%Y-%m-%d %H:%M")
-        
-        # The charging start time is already calculated above with the slot's free time
-        # which includes the 1-minute buffer from the previous vehicle's departure
-
-        vehicle_doc_ref = station_doc_ref.collection("vehicles").document()
-        new_vehicle_id = vehicle_doc_ref.id
-
-        # Create vehicle data with charging calculations and wait time
-        vehicle_data = {
-            "vehicle_number": vehicle_number,
-            "arrival_time": arrival_time_full,
-            "departure_time": departure_time_full,
-            "charging_start_time": charging_start_time_full,
-            "chargingType": chargingType,
-            "estimated_final_battery": estimated_final_battery if estimated_final_battery is not None else None,
-            "initial_battery_level": initial_battery_level,
-            "target_battery_level": target_battery_level,
-            "battery_capacity": battery_capacity,
-            "charging_time_minutes": round(charging_time_min),
-            "charging_cost": round(charging_cost) if charging_cost is not None else None,
-            "wait_time_minutes": wait_time_minutes,
-            "status": vehicle_status,
-            "slot_number": slot_number,
-            "timestamp": firestore.SERVER_TIMESTAMP
-        }
-        
-        vehicle_doc_ref.set(vehicle_data)
         # Calculate available slots dynamically (do not update Firestore)
-        vehicles_ref = station_doc_ref.collection("vehicles")
-        charging_count = sum(1 for doc in vehicles_ref.stream() if doc.to_dict().get('status', '').upper() == 'CHARGING')
+        total_slots = booking["total_slots"]
+        charging_count = booking["charging_before"] + (1 if booking["vehicle_status"] == "CHARGING" else 0)
         available_slots = max(total_slots - charging_count, 0) if total_slots else 0
 
         return jsonify({
@@ -686,19 +534,17 @@ def add_vehicle():
             "charging_time_minutes": round(charging_time_min),
             "charging_cost": round(charging_cost) if charging_cost is not None else None,
             "wait_time_minutes": wait_time_minutes,
-            "departure_time": departure_time_full,
+            "departure_time": format_minutes(departure),
             "available_slots": available_slots,
             "target_type": "minutes" if charging_time_min is not None else "percentage"
         }), 201
-    except CalculationError as e:
-        raise e # Re-raise CalculationError as is
+    except InvalidUsage as e:
+        raise e # Re-raise CalculationError and the busy-station 409 as is
     except Exception as e:
-        import traceback
-        print(f"An error occurred during add_vehicle: {e}")
-        print(traceback.format_exc())
+        logger.exception(f"An error occurred during add_vehicle: {e}")
         raise InvalidUsage(f"An error occurred while adding vehicle: {str(e)}", status_code=500)
 
-@app.route("/remove_vehicle", methods=["POST"])
+@bp.route("/remove_vehicle", methods=["POST"])
 def remove_vehicle():
     if "station_id" not in session:
         raise UnauthorizedError("Not logged in!")
@@ -711,128 +557,53 @@ def remove_vehicle():
         raise MissingDataError("Missing vehicle ID!")
 
     try:
-        station_doc_ref = db.collection("charging_stations").document(station_id)
-        if not station_doc_ref.get().exists:
+        # The vehicle is read (for the response) together with the station and its schedule
+        station_data, _, vehicle_data = read_station_schedule(
+            station_id, lambda: get_storage().get_vehicle(station_id, vehicle_id))
+        if station_data is None:
             raise NotFoundError("Charging station not found!")
-
-        vehicle_doc_ref = station_doc_ref.collection("vehicles").document(vehicle_id)
-        if not vehicle_doc_ref.get().exists:
+        if vehicle_data is None:
             raise NotFoundError("Vehicle not found!")
 
-        # Get vehicle data before deletion for response
-        vehicle_data = vehicle_doc_ref.get().to_dict()
-        
-        # Delete the vehicle document
-        vehicle_doc_ref.delete()
-        
-        # Update the station's charging count if needed
-        if vehicle_data.get('status', '').upper() == 'CHARGING':
-            # Get the current charging count
-            station_data = station_doc_ref.get().to_dict() or {}
-            current_charging = station_data.get('charging_count', 0)
-            if current_charging > 0:
-                station_doc_ref.update({
-                    'charging_count': firestore.Increment(-1)
-                })
+        # A vehicle leaving before its departure frees its slot: queued vehicles that have
+        # not started yet move up into the freed time
+        now = now_minutes()
+        removed_start = vehicle_minutes(vehicle_data, 'charging_start')
+        rescheduled = {}
+
+        def plan(station_data, timeline):
+            planned = timeline.copy()
+            planned.remove(vehicle_id)
+            moves = planned.reflow(now, after=removed_start)
+            rescheduled["count"] = len(moves)
+            # Delete the vehicle document; the station's counters are adjusted in the same commit
+            changes = {"removed": [vehicle_id], "updated": reflow_updates(moves)}
+            return changes, lambda t: (t.remove(vehicle_id), t.apply(moves))
+
+        commit_planned_change(station_id, plan, station_data)
 
         return jsonify({
             "message": "Vehicle removed successfully!",
-            "success": True
+            "success": True,
+            "rescheduled": rescheduled["count"]
         }), 200
         
+    except InvalidUsage as e:
+        raise e # Re-raise not-found errors and the busy-station 409 as is
     except Exception as e:
-        import traceback
-        print(f"An error occurred during remove_vehicle: {e}")
-        print(traceback.format_exc())
+        logger.exception(f"An error occurred during remove_vehicle: {e}")
         return jsonify({
             "error": f"An error occurred while removing the vehicle: {str(e)}",
             "success": False
         }), 500
 
-def calculate_charging_time(initial_battery_level, target_battery_level, battery_capacity_kWh, charging_type):
-    """
-    Calculate charging time based on charger type and battery levels using logistic model.
-    
-    Args:
-        initial_battery_level (float): Initial battery percentage (0-100)
-        target_battery_level (float): Target battery percentage (0-100)
-        battery_capacity_kWh (float): Battery capacity in kWh
-        charging_type (str): Type of charger (AC Type 1, AC Type 2, CCS, CHAdeMO, GB/T)
-    
-    Returns:
-        tuple: (charging_time_minutes, charging_cost)
-    """
-    # Charging speeds in kW for different charger types
-    charging_speeds = {
-        "AC Type 1": 7.4,    # 7.4 kW
-        "AC Type 2": 22.0,   # 22 kW
-        "CCS": 150.0,        # 150 kW
-        "CHAdeMO": 62.5,    # 62.5 kW
-        "GB/T": 120.0        # 120 kW
-    }
-    
-    # Charging rates in ₹/kWh for different charger types
-    charging_rates = {
-        "AC Type 1": 15,
-        "AC Type 2": 18,
-        "CCS": 25,
-        "CHAdeMO": 25,
-        "GB/T": 20
-    }
-    
-    # Charging efficiency for different charger types (typical values)
-    charging_efficiency = {
-        "AC Type 1": 0.85,  # 85% efficient
-        "AC Type 2": 0.88,  # 88% efficient
-        "CCS": 0.92,        # 92% efficient
-        "CHAdeMO": 0.92,    # 92% efficient
-        "GB/T": 0.90        # 90% efficient
-    }
-    
-    # Get charging speed and efficiency for the selected type
-    charging_speed_kw = charging_speeds.get(charging_type, 7.4)  # Default to AC Type 1 if type not found
-    efficiency = charging_efficiency.get(charging_type, 0.85)  # Default to 85% if type not found
-    
-    try:
-        # Calculate charging time using logistic model
-        charging_time_hours = ev_charging_time(
-            initial_battery_level,
-            target_battery_level,
-            charging_speed_kw,
-            battery_capacity_kWh
-        )
-        
-        # Convert to minutes
-        charging_time_minutes = charging_time_hours * 60
-        
-        # Calculate energy needed and cost with efficiency factor
-        battery_percentage_to_charge = target_battery_level - initial_battery_level
-        energy_needed_kwh = (battery_percentage_to_charge / 100) * battery_capacity_kWh
-        actual_energy_consumed = energy_needed_kwh / efficiency  # Account for charging losses
-        charging_rate = charging_rates.get(charging_type, 15)  # Default to AC Type 1 rate if type not found
-        charging_cost = actual_energy_consumed * charging_rate
-        
-        return charging_time_minutes, charging_cost
-        
-    except ValueError as e:
-        print(f"Error calculating charging time: {e}")
-        # Fallback to linear calculation if logistic model fails
-        battery_percentage_to_charge = target_battery_level - initial_battery_level
-        energy_needed_kwh = (battery_percentage_to_charge / 100) * battery_capacity_kWh
-        actual_energy_consumed = energy_needed_kwh / efficiency  # Account for charging losses
-        charging_time_hours = energy_needed_kwh / (charging_speed_kw * efficiency)
-        charging_time_minutes = charging_time_hours * 60
-        charging_rate = charging_rates.get(charging_type, 15)
-        charging_cost = (energy_needed_kwh / efficiency) * charging_rate
-        return charging_time_minutes, charging_cost
-
-@app.errorhandler(InvalidUsage)
+@bp.app_errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
     response = jsonify(error.to_dict())
     response.status_code = error.status_code
     return response
     
-@app.route("/verify-otp", methods=["POST"])
+@bp.route("/verify-otp", methods=["POST"])
 def verify_otp():
     data = request.json
     station_id = data.get("station_id")
@@ -841,11 +612,9 @@ def verify_otp():
     if not station_id or not otp or not new_access_key:
         return jsonify({"success": False, "message": "Missing required fields."}), 400
 
-    doc_ref = db.collection("charging_stations").document(station_id)
-    doc = doc_ref.get()
-    if not doc.exists:
+    station_data = get_storage().get_station(station_id, cached=False)
+    if station_data is None:
         return jsonify({"success": False, "message": "Station ID not found."}), 404
-    station_data = doc.to_dict()
     stored_otp = station_data.get("reset_otp")
     otp_expiry = station_data.get("reset_otp_expiry")
     if not stored_otp or not otp_expiry:
@@ -872,104 +641,628 @@ def verify_otp():
         }), 400
 
     # Update access key and clear OTP fields
-    doc_ref.update({
-        'access_key': new_access_key,
-        'reset_otp': firestore.DELETE_FIELD,
-        'reset_otp_expiry': firestore.DELETE_FIELD
-    })
+    get_storage().complete_access_key_reset(station_id, new_access_key)
     return jsonify({"success": True, "message": "Access key updated successfully."}), 200
 
-@app.route("/api/vehicle_count")
+@bp.route("/api/vehicle_count")
 def vehicle_count():
     if "station_id" not in session:
         return jsonify({"error": "Not logged in"}), 401
-    vehicles_ref = db.collection("charging_stations").document(session["station_id"]).collection("vehicles")
-    count = len(list(vehicles_ref.stream()))
+    station_data = get_storage().get_station(session["station_id"])
+    if station_data is None:
+        return jsonify({"error": "Station not found"}), 404
+    count = station_counters(session["station_id"], station_data)["vehicle_count"]
     return jsonify({"vehicle_count": count})
-# Add this import at the top of your main.py file
-from apscheduler.schedulers.background import BackgroundScheduler
 
-# Add this new function somewhere in your main.py file
-def update_all_station_wait_times():
+# Most vehicles one /api/quote/batch request may price
+QUOTE_BATCH_LIMIT = 1000
+
+def _number_column(vehicles, *keys):
+    """Float array of the first of ``keys`` present in each vehicle; NaN where none is."""
+    values = []
+    for vehicle in vehicles:
+        value = next((vehicle[key] for key in keys if vehicle.get(key) not in (None, "")), None)
+        values.append(value)
+    return np.array(values, dtype=float)
+
+def _first_invalid(mask):
+    invalid = np.flatnonzero(mask)
+    return int(invalid[0]) if invalid.size else None
+
+@bp.route("/api/quote/batch", methods=["POST"])
+def quote_batch():
     """
-    This function runs in the background to update wait times for ALL stations.
+    Price many charging scenarios in one request, e.g. for a fleet. The body is
+    ``{"vehicles": [...]}`` where each vehicle has the fields of /add_vehicle:
+    chargingType, initialBatteryLevel, batteryCapacity and either
+    targetBatteryLevel or targetChargeMinutes. Quotes come back in the same order.
     """
-    with app.app_context():  # Required for background tasks to access the app
-        print("SCHEDULER: Running job to update wait times...")
-        stations_ref = db.collection("charging_stations")
-        
-        for station_doc in stations_ref.stream():
-            station_id = station_doc.id
-            station_data = station_doc.to_dict()
-            now = datetime.now()
-
-            # This logic is the same as in your dashboard function
-            vehicles_ref = station_doc.reference.collection("vehicles")
-            total_slots = int(station_data.get('total_slots', 0))
-            slot_free_at = {i: now for i in range(1, total_slots + 1)}
-
-            for v_doc in vehicles_ref.stream():
-                v = v_doc.to_dict()
-                departure_time_str = v.get('departure_time')
-                if not departure_time_str: continue
-                try:
-                    slot_number = int(v.get('slot_number', 1))
-                    departure_dt = datetime.strptime(departure_time_str, '%Y-%m-%d %H:%M')
-                    if departure_dt > now:
-                        current_free_time = slot_free_at.get(slot_number, now)
-                        slot_free_at[slot_number] = max(current_free_time, departure_dt)
-                except (ValueError, TypeError):
-                    continue
+    data = request.get_json(silent=True) or {}
+    vehicles = data.get("vehicles")
+    if not isinstance(vehicles, list) or not vehicles:
+        raise MissingDataError("Please provide a list of vehicles to quote!")
+    if len(vehicles) > QUOTE_BATCH_LIMIT:
+        raise InvalidUsage(f"At most {QUOTE_BATCH_LIMIT} vehicles can be quoted per request.")
+    if not all(isinstance(vehicle, dict) for vehicle in vehicles):
+        raise InvalidUsage("Each vehicle must be an object.")
+
+    try:
+        initial = _number_column(vehicles, "initialBatteryLevel")
+        capacity = _number_column(vehicles, "batteryCapacity")
+        target = _number_column(vehicles, "targetBatteryLevel")
+        minutes = _number_column(vehicles, "charging_time_minutes", "targetChargeMinutes")
+    except (TypeError, ValueError):
+        raise InvalidUsage("Invalid data type for battery levels, capacity, or minutes. Must be numbers.")
+    charger_types = [vehicle.get("chargingType") for vehicle in vehicles]
+
+    # Same rules as /add_vehicle, checked for all vehicles at once; the first offender is reported
+    checks = (
+        ([not charger_type for charger_type in charger_types], MissingDataError, "Charging Type is required!"),
+        (np.isnan(initial) | np.isnan(capacity), MissingDataError,
+         "Initial battery level and battery capacity are required."),
+        (np.isnan(target) & np.isnan(minutes), MissingDataError,
+         "Please provide either a target battery level or charging time in minutes."),
+        # Infinite values ("1e999", Infinity) fail like out-of-range ones; NaN marks an optional field left out
+        (~np.isfinite(initial) | (initial < 0) | (initial > 100), InvalidUsage,
+         "Initial battery level must be between 0 and 100."),
+        (~np.isfinite(capacity) | (capacity <= 0), InvalidUsage, "Battery capacity must be a positive number."),
+        (np.isinf(target) | (target < 0) | (target > 100), InvalidUsage,
+         "Target battery level must be between 0 and 100."),
+        (target <= initial, InvalidUsage, "Target battery level must be greater than initial battery level."),
+        (np.isinf(minutes) | (minutes <= 0), InvalidUsage, "Charging time in minutes must be greater than 0."),
+    )
+    for mask, error, message in checks:
+        index = _first_invalid(np.asarray(mask))
+        if index is not None:
+            raise error(f"Vehicle {index}: {message}")
+
+    estimate = estimate_charging_batch(charger_types, initial, capacity, target_soc=target, minutes=minutes)
+    quotes = [
+        {
+            "charging_time_minutes": round(charge_minutes),
+            "charging_cost": round(cost),
+            "estimated_final_battery": round(final_soc, 1),
+            "target_type": "minutes" if by_minutes else "percentage"
+        }
+        for charge_minutes, cost, final_soc, by_minutes in zip(
+            estimate["minutes"].tolist(), estimate["cost"].tolist(), estimate["final_soc"].tolist(),
+            (~np.isnan(minutes)).tolist())
+    ]
+    return jsonify({"quotes": quotes})
+
+# Nearby-station index of this worker, loaded from the snapshot the scheduler sweep stores
+station_index = StationIndex()
+_station_index_lock = threading.Lock()
+
+# Limits of the nearby-station search
+NEARBY_DEFAULT_RADIUS_KM = 25.0
+NEARBY_MAX_RADIUS_KM = 200.0
+NEARBY_MAX_RESULTS = 50
+
+def get_station_index():
+    """This worker's nearby-station index, reloaded from the sweep's snapshot when stale."""
+    if station_index.is_stale():
+        with _station_index_lock:
+            if station_index.is_stale():
+                snapshot = get_storage().load_station_index()
+                if snapshot is None:
+                    # No sweep has stored a snapshot yet: index the stations directly until one has
+                    logger.info("No station index snapshot yet, indexing stations directly")
+                    entries = (station_entry(station_id, station_data)
+                               for station_id, station_data in get_storage().stream_stations())
+                    snapshot = station_index_snapshot(entry for entry in entries if entry is not None)
+                station_index.load(snapshot)
+    return station_index
+
+def forecast_json(forecast, now, every=30):
+    """A stored wait forecast from ``now`` on as ``[{"time": "HH:MM", "wait_minutes": n}]``, every ``every`` minutes."""
+    return [{"time": format_minutes(arrival, "%H:%M"), "wait_minutes": wait}
+            for arrival, wait in forecast_points(forecast, now, every)]
+
+def _query_float(name, default=None, low=None, high=None):
+    value = request.args.get(name)
+    if value in (None, ""):
+        if default is None:
+            raise MissingDataError(f"Missing query parameter: {name}")
+        return default
+    try:
+        value = float(value)
+    except ValueError:
+        raise InvalidUsage(f"{name} must be a number.")
+    if not np.isfinite(value) or (low is not None and value < low) or (high is not None and value > high):
+        raise InvalidUsage(f"{name} must be between {low} and {high}.")
+    return value
 
-            wait_minutes = 0
-            if slot_free_at:
-                earliest_free_dt = min(slot_free_at.values())
-                if earliest_free_dt > now:
-                    wait_minutes = round((earliest_free_dt - now).total_seconds() / 60)
-            
-            current_wait_time = station_data.get('latest_wait_time_minutes')
-            if current_wait_time is None or int(current_wait_time) != wait_minutes:
-                print(f"SCHEDULER: Updating station '{station_id}' wait time from {current_wait_time} to {wait_minutes} min.")
-                station_doc.reference.update({'latest_wait_time_minutes': wait_minutes})
-def remove_completed_vehicles():
+@bp.route("/api/stations/nearby")
+def nearby_stations():
     """
-    This background job checks all stations for completed vehicles and removes them.
-    A vehicle is 'completed' if its departure time is in the past.
+    Stations near ``lat``/``lng`` for drivers, best first by driving minutes plus the
+    wait the station's forecast projects for that arrival. ``charger`` limits the results to one charging type,
+    ``radius_km`` (default 25, at most 200) and ``limit`` (default 10, at most 50)
+    bound the search. Answered from this worker's grid index without reading stations;
+    each station's ``wait_forecast`` lists the projected wait for arrivals on the half hour.
     """
-    with app.app_context(): # Required for background tasks
-        print("SCHEDULER: Running job to remove completed vehicles...")
-        now = datetime.now()
-        stations_ref = db.collection("charging_stations")
-        
-        for station_doc in stations_ref.stream():
-            vehicles_ref = station_doc.reference.collection("vehicles")
-            for vehicle_doc in vehicles_ref.stream():
-                vehicle_data = vehicle_doc.to_dict()
-                departure_time_str = vehicle_data.get('departure_time')
+    latitude = _query_float("lat", low=-90, high=90)
+    longitude = _query_float("lng", low=-180, high=180)
+    radius_km = _query_float("radius_km", NEARBY_DEFAULT_RADIUS_KM, 0, NEARBY_MAX_RADIUS_KM)
+    limit = int(_query_float("limit", 10, 1, NEARBY_MAX_RESULTS))
+    charger = request.args.get("charger") or None
+
+    now = now_minutes()
+    results = get_station_index().nearby(latitude, longitude, charger, radius_km, limit, now)
+    return jsonify({"stations": [{
+        "station_id": entry.station_id,
+        "name": entry.name,
+        "location": entry.location,
+        "latitude": entry.latitude,
+        "longitude": entry.longitude,
+        "charging_type": entry.charging_type,
+        "total_slots": entry.total_slots,
+        "wait_minutes": entry.wait_minutes,
+        "distance_km": round(distance, 2),
+        "travel_minutes": round(travel_minutes),
+        "arrival_time": format_minutes(now + round(travel_minutes), "%H:%M"),
+        "wait_on_arrival_minutes": wait,
+        "wait_forecast": forecast_json(entry.wait_forecast, now),
+        "score_minutes": round(travel_minutes + wait)
+    } for entry, distance, travel_minutes, wait in results]})
+
+# Vehicle fields exposed by the JSON API
+VEHICLE_API_FIELDS = (
+    "id", "vehicle_number", "slot_number", "arrival_time", "charging_start_time", "departure_time",
+    "chargingType", "battery_capacity", "initial_battery_level", "target_battery_level",
+    "estimated_final_battery", "charging_time_minutes", "wait_time_minutes", "status", "charging_cost"
+)
+
+def vehicle_to_json(vehicle):
+    return {field: vehicle.get(field) for field in VEHICLE_API_FIELDS}
+
+@bp.route("/api/stations/<station_id>/vehicles")
+def station_vehicles(station_id):
+    """
+    JSON list of a station's vehicles.
 
-                if not departure_time_str:
-                    continue
+    The strong ETag combines the station's vehicles_version with the number of
+    vehicles whose live status has flipped to CHARGING, so a poll with a matching
+    If-None-Match costs one station read and a 304. With ``since=<version>`` only
+    vehicles changed or removed after that version are returned, plus the ids of
+    WAITING vehicles that are now charging.
+    """
+    if session.get("station_id") != station_id:
+        return jsonify({"error": "Not logged in"}), 401
+
+    since = request.args.get("since")
+    try:
+        since = int(since) if since not in (None, "") else None
+    except ValueError:
+        raise InvalidUsage("since must be an integer version.")
+
+    station_data = get_storage().get_station(station_id)
+    if station_data is None:
+        raise NotFoundError("Station not found!")
+
+    now = now_minutes()
+    version = station_data.get('vehicles_version', 0)
+    promoted = get_slot_timeline(station_id, station_data).promoted_by(now)
+    etag = f"{version}.{len(promoted)}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    if since is not None and since >= station_data.get('tombstone_floor', 0):
+        changed, removed = get_storage().list_vehicle_changes(station_id, since)
+        changed = build_queue_view(changed, station_data, now)[0]
+        payload = {
+            "version": version,
+            "full": False,
+            "changed": [vehicle_to_json(v) for v in changed],
+            "removed": removed,
+            "promoted": promoted
+        }
+    else:
+        vehicles = build_queue_view(get_storage().list_vehicles(station_id), station_data, now)[0]
+        payload = {
+            "version": version,
+            "full": True,
+            "vehicles": [vehicle_to_json(v) for v in vehicles]
+        }
+
+    response = jsonify(payload)
+    response.set_etag(etag)
+    return response
+
+# Longest range one /api/stations/<id>/stats request may cover
+STATS_MAX_DAYS = 31
+
+def _stats_bound(text, end=False):
+    """Epoch minutes of a ``YYYY-MM-DD`` or ``YYYY-MM-DD HH:MM`` stats bound; a bare ``to`` date includes that day."""
+    text = text.strip().replace("T", " ")
+    if " " in text:
+        return parse_local(text)
+    day = parse_local(f"{text} 00:00")
+    return period_range(day, day + 1, "day")[1] if end else day
+
+@bp.route("/api/stations/<station_id>/stats")
+def station_stats(station_id):
+    """
+    Utilization, sessions, energy delivered and revenue of a station per hour
+    (``by=hour``, default) or day (``by=day``) from its hourly rollups. ``from``
+    and ``to`` are station-time ``YYYY-MM-DD`` dates (``to`` included) or
+    ``YYYY-MM-DD HH:MM`` times and default to today so far. The ETag follows the
+    station's vehicles_version, which every change to the rollups advances.
+    """
+    if session.get("station_id") != station_id:
+        return jsonify({"error": "Not logged in"}), 401
 
-                try:
-                    departure_dt = datetime.strptime(departure_time_str, '%Y-%m-%d %H:%M')
-                    
-                    # Check if the vehicle's departure time has passed
-                    if departure_dt <= now:
-                        print(f"SCHEDULER: Removing completed vehicle '{vehicle_data.get('vehicle_number')}' from station '{station_doc.id}'.")
-                        vehicle_doc.reference.delete()
-                        
-                except (ValueError, TypeError):
-                    # Ignore vehicles with an invalid departure time format
+    granularity = request.args.get("by", "hour")
+    if granularity not in ("hour", "day"):
+        raise InvalidUsage("by must be 'hour' or 'day'.")
+    now = now_minutes()
+    try:
+        start = _stats_bound(request.args["from"]) if request.args.get("from") else period_start(now, "day")
+        end = _stats_bound(request.args["to"], end=True) if request.args.get("to") else now + 1
+    except ValueError:
+        raise InvalidUsage("from and to must be YYYY-MM-DD or YYYY-MM-DD HH:MM.")
+    if end <= start:
+        raise InvalidUsage("to must be after from.")
+    start, end = period_range(start, end, granularity)
+    if end - start > STATS_MAX_DAYS * 24 * 60 + 60:
+        raise InvalidUsage(f"At most {STATS_MAX_DAYS} days of stats can be requested at once.")
+
+    station_data = get_storage().get_station(station_id)
+    if station_data is None:
+        raise NotFoundError("Station not found!")
+    etag = f"{station_data.get('vehicles_version', 0)}.{granularity}.{start}.{end}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    total_slots = int(station_data.get('total_slots') or 0)
+    periods = summarize(get_storage().list_rollups(station_id, start, end), start, end, total_slots, granularity)
+    slot_minutes = total_slots * (end - start)
+    overall = {field: sum(period[field] for period in periods) for field in ROLLUP_FIELDS}
+    overall.update(energy_kwh=round(overall["energy_kwh"], 3), revenue=round(overall["revenue"], 2),
+                   utilization=round(overall["charging_minutes"] / slot_minutes, 4) if slot_minutes else None)
+    for period in periods:
+        period["start"] = format_minutes(period["start"])
+
+    response = jsonify({
+        "station_id": station_id,
+        "from": format_minutes(start),
+        "to": format_minutes(end),
+        "by": granularity,
+        "total_slots": total_slots,
+        "totals": overall,
+        "periods": periods
+    })
+    response.set_etag(etag)
+    return response
+
+# Each open event stream holds one of the worker's threads, so only a few are allowed per worker
+_event_bus = None
+_event_bus_lock = threading.Lock()
+
+def get_event_bus():
+    """The worker's EventBus, created on first use so no watch threads exist before a fork."""
+    global _event_bus
+    if _event_bus is None:
+        with _event_bus_lock:
+            if _event_bus is None:
+                _event_bus = EventBus(get_storage(), max_subscribers=int(os.environ.get("SSE_MAX_STREAMS", 2)))
+    return _event_bus
+SSE_HEARTBEAT_SECONDS = 15
+SSE_STREAM_SECONDS = 55
+
+@bp.route("/api/stations/<station_id>/events")
+def station_events(station_id):
+    """
+    Server-Sent Events stream of a station's queue changes.
+
+    Sends ``added``, ``removed`` and ``status`` events (or ``sync`` when several
+    changes were coalesced or the client fell too far behind; it then reloads its
+    whole list) with the new vehicles_version as the event id. Streams
+    close after SSE_STREAM_SECONDS and the browser reconnects; a client whose
+    Last-Event-ID is behind gets a ``sync`` event straight away. When the worker
+    has no stream capacity left it answers 503 and the client keeps polling.
+    """
+    if session.get("station_id") != station_id:
+        return jsonify({"error": "Not logged in"}), 401
+
+    subscription = get_event_bus().subscribe(station_id)
+    if subscription is None:
+        return jsonify({"error": "Too many open event streams, poll instead."}), 503, {"Retry-After": "30"}
+
+    last_event_id = request.headers.get("Last-Event-ID", "")
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            if last_event_id.isdigit() and subscription.version is not None \
+                    and subscription.version > int(last_event_id):
+                yield format_sse({"type": "sync", "version": subscription.version})
+            deadline = time.monotonic() + SSE_STREAM_SECONDS
+            while time.monotonic() < deadline:
+                event = subscription.get(timeout=SSE_HEARTBEAT_SECONDS)
+                yield format_sse(event) if event else ": keep-alive\n\n"
+        finally:
+            subscription.close()
+
+    response = Response(stream(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # The generator's finally never runs if the response is dropped before streaming starts
+    response.call_on_close(subscription.close)
+    return response
+
+def format_sse(event):
+    return f"id: {event['version']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+# --- Scheduler jobs: each handles one station and is run for every station by scheduler.py ---
+
+def _commit_chunks(removed, updated):
+    """
+    Split a station's removals and updates into commits that each fit in one
+    transaction. A removal is two writes (the vehicle and its tombstone) and every
+    commit also writes the station document. The hourly rollups a commit touches
+    are only known once it reads the vehicles, so a chunk they make too large is
+    split again by ``_split_chunk``.
+    """
+    chunk_removed, chunk_updated, ops = [], {}, 1
+    for vehicle_id in removed:
+        if ops + 2 > MAX_BATCH_OPS:
+            yield chunk_removed, chunk_updated
+            chunk_removed, chunk_updated, ops = [], {}, 1
+        chunk_removed.append(vehicle_id)
+        ops += 2
+    for vehicle_id, fields in updated.items():
+        if ops + 1 > MAX_BATCH_OPS:
+            yield chunk_removed, chunk_updated
+            chunk_removed, chunk_updated, ops = [], {}, 1
+        chunk_updated[vehicle_id] = fields
+        ops += 1
+    if chunk_removed or chunk_updated:
+        yield chunk_removed, chunk_updated
+
+def _split_chunk(removed, updated):
+    """The two halves of a chunk that ``commit_vehicle_changes`` refused as too large."""
+    if len(removed) > 1:
+        middle = len(removed) // 2
+        return [(removed[:middle], {}), (removed[middle:], updated)]
+    items = list(updated.items())
+    middle = len(items) // 2
+    return [(removed, dict(items[:middle])), ([], dict(items[middle:]))]
+
+def reflow_updates(moves):
+    """Vehicle fields to store for the moves made by ``SlotTimeline.reflow``."""
+    return {vehicle_id: {'slot_number': slot,
+                         'charging_start_ts': to_timestamp(start),
+                         'departure_ts': to_timestamp(departure),
+                         'wait_time_minutes': start - arrival}
+            for vehicle_id, (slot, start, departure, arrival) in moves.items()}
+
+def sweep_station(station_id, station_data, now, due=None):
+    """
+    Bring one station up to date: remove the vehicles that have departed, persist
+    WAITING -> CHARGING for those whose start time has passed and recompute the
+    station's wait time. Counters are kept in step by the commits.
+
+    ``due`` is the station's ``(departed_ids, started_ids)`` from
+    ``get_storage().find_due_vehicles``. With it, only those vehicles are touched and the
+    wait time comes from the station's ``slot_free_at`` map. Without it, or if the
+    station has no map yet, every vehicle is read once: missing timestamps are
+    backfilled, vehicles that have not started are moved up into any free time
+    (see ``SlotTimeline.reflow``), the map is rebuilt and the slot timeline cache
+    is seeded. Those commits are planned from the vehicles as read, so like
+    ``commit_planned_change`` they only land if no other write got in since;
+    otherwise the station is read and swept again, and after ADMISSION_ATTEMPTS
+    it is left for the next run.
+    The station's wait forecast is recomputed too when it is out of date (see
+    ``slots.wait_forecast``); with ``due`` it is placed on the cached timeline or,
+    without one, on the ``slot_free_at`` map, so no vehicles are read for it.
+    Returns:
+        dict: removed, promoted and rescheduled counts, the wait time and whether it changed,
+        the wait forecast and the station fields still to be written (batched by the caller)
+        if no commit carried them, never including ``slot_free_at``
+    """
+    for attempt in range(ADMISSION_ATTEMPTS):
+        try:
+            return _sweep_once(station_id, station_data, now, due)
+        except VersionConflict as e:
+            logger.info(f"SCHEDULER: Station '{station_id}' changed while it was swept (attempt {attempt + 1}): {e}")
+            time.sleep(random.uniform(0, ADMISSION_BACKOFF_SECONDS * (attempt + 1)))
+            # The due vehicles were found before the station changed, so read all of them again
+            station_data, due = get_storage().get_station(station_id, cached=False), None
+            if station_data is None:
+                raise NotFoundError("Station not found!")
+    logger.warning(f"SCHEDULER: Station '{station_id}' kept changing while it was swept, leaving it for the next run.")
+    return {
+        "removed": 0,
+        "promoted": 0,
+        "rescheduled": 0,
+        "wait_minutes": station_data.get('latest_wait_time_minutes'),
+        "wait_updated": False,
+        "wait_forecast": station_data.get('wait_forecast'),
+        "station_updates": {}
+    }
+
+def _sweep_once(station_id, station_data, now, due):
+    """
+    One pass of ``sweep_station``. Raises VersionConflict if the station changed
+    since the vehicles a full pass planned from were read.
+    """
+    if due is not None and station_data.get('slot_free_at') is not None:
+        departed, started = due
+        completed = list(departed)
+        promotions = {vehicle_id: {'status': 'CHARGING', 'wait_time_minutes': 0}
+                      for vehicle_id in set(started) - set(departed)}
+        updated = promotions
+        wait_minutes = wait_from_slot_free_at(station_data['slot_free_at'], station_data.get('total_slots', 0), now)
+        moves = {}
+        timeline = None
+        station_updates = {}
+        slot_free_at = None
+    else:
+        completed, promotions, updated, remaining = [], {}, {}, []
+        for vehicle_data in get_storage().list_vehicles(station_id):
+            try:
+                departure = vehicle_minutes(vehicle_data, 'departure')
+                # A vehicle is 'completed' if its departure time is in the past
+                if departure is not None and departure <= now:
+                    logger.info(f"SCHEDULER: Removing completed vehicle '{vehicle_data.get('vehicle_number')}' from station '{station_id}'.")
+                    completed.append(vehicle_data['id'])
                     continue
-@app.route('/logout')
+                start = vehicle_minutes(vehicle_data, 'charging_start')
+                arrival = vehicle_minutes(vehicle_data, 'arrival')
+                fields = {}
+                if arrival is not None and vehicle_data.get('arrival_ts') is None:
+                    fields['arrival_ts'] = to_timestamp(arrival)
+                if departure is not None and vehicle_data.get('departure_ts') is None:
+                    fields['departure_ts'] = to_timestamp(departure)
+                if start is not None and vehicle_data.get('charging_start_ts') is None:
+                    fields['charging_start_ts'] = to_timestamp(start)
+                if vehicle_data.get('status') == 'WAITING' and start is not None and start <= now:
+                    promotions[vehicle_data['id']] = {'status': 'CHARGING', 'wait_time_minutes': 0}
+                    fields.update(promotions[vehicle_data['id']])
+                if fields:
+                    updated[vehicle_data['id']] = fields
+                    vehicle_data.update(fields)
+            except (ValueError, TypeError) as e:
+                # Vehicles with an invalid time format are left alone
+                logger.warning(f"Error parsing times for vehicle {vehicle_data['id']}: {e}")
+            remaining.append(vehicle_data)
+
+        timeline = build_timeline(remaining, station_data.get('total_slots', 0), station_data.get('vehicles_version', 0))
+        moves = timeline.reflow(now)
+        for vehicle_id, fields in reflow_updates(moves).items():
+            updated.setdefault(vehicle_id, {}).update(fields)
+        wait_minutes = timeline.next_free_at(now) - now
+        station_updates = {}
+        slot_free_at = slot_free_at_map(timeline)
+        if station_data.get('slot_free_at') == slot_free_at:
+            slot_free_at = None
+
+    current_wait_time = station_data.get('latest_wait_time_minutes')
+    wait_updated = current_wait_time is None or int(current_wait_time) != wait_minutes
+    if wait_updated:
+        logger.info(f"SCHEDULER: Updating station '{station_id}' wait time from {current_wait_time} to {wait_minutes} min.")
+        station_updates['latest_wait_time_minutes'] = wait_minutes
+
+    # A full pass planned every change, reflow moves included, from the vehicles it read, so each
+    # of its commits requires the version to be the one its previous commit left
+    version = station_data.get('vehicles_version', 0)
+    checked = timeline is not None
+    committed = False
+    chunks = list(_commit_chunks(completed, updated))
+    if slot_free_at is not None and not chunks:
+        chunks = [([], {})]
+    while chunks:
+        chunk_removed, chunk_updated = chunks.pop(0)
+        last = not chunks
+        commit_updates = None
+        if last:
+            commit_updates = station_updates if slot_free_at is None else dict(station_updates, slot_free_at=slot_free_at)
+        try:
+            new_version = get_storage().commit_vehicle_changes(station_id, removed=chunk_removed, updated=chunk_updated,
+                                                       station_updates=commit_updates,
+                                                       expected_version=version if checked else None)
+        except CommitTooLarge:
+            if len(chunk_removed) + len(chunk_updated) < 2:
+                raise
+            chunks[:0] = _split_chunk(chunk_removed, chunk_updated)
+            continue
+        committed = True
+        if not checked:
+            timelines.advance(station_id, version, new_version,
+                              lambda t: (t.remove_many(chunk_removed), t.mark_charging(chunk_updated)))
+        version = new_version
+    if committed:
+        station_updates = {}
+    if checked:
+        timeline.version = version
+        timelines.put(station_id, timeline)
+
+    # The forecast follows the schedule as committed; it is only recomputed once the station
+    # has changed or the curve has aged, so an unchanged station costs nothing here
+    forecast = station_data.get('wait_forecast')
+    if not forecast_is_current(forecast, version, now):
+        if not checked:
+            # A pass driven by the due vehicles never lists them: this worker's timeline if it has
+            # one at this version, else the station's slot_free_at map
+            total_slots = station_data.get('total_slots', 0)
+            timeline = timelines.get(station_id, version, total_slots)
+            if timeline is None:
+                timeline = timeline_from_slot_free_at(station_data['slot_free_at'], total_slots, version, now)
+        forecast = wait_forecast(timeline, now)
+        station_updates['wait_forecast'] = forecast
+
+    return {
+        "removed": len(completed),
+        "promoted": len(promotions),
+        "rescheduled": len(moves),
+        "wait_minutes": wait_minutes,
+        "wait_updated": wait_updated,
+        "wait_forecast": forecast,
+        "station_updates": station_updates
+    }
+
+def reconcile_station_counters(station_id, station_data, now):
+    """
+    Recount the station's vehicle counters from its vehicles and repair any drift.
+    Counters are maintained on every commit, so this only runs occasionally.
+    """
+    counters = get_storage().reconcile_counters(station_id)
+    if any(station_data.get(field) != value for field, value in counters.items()):
+        logger.info(f"SCHEDULER: Repaired counters for station '{station_id}': {counters}")
+    return counters
+
+def prune_station_tombstones(station_id, station_data, now):
+    """
+    Forget removals older than TOMBSTONE_RETENTION. Clients that have not synced
+    since then get a full list instead of a delta. Returns how many were pruned.
+    """
+    # Stations with no commit since the last prune have nothing to forget
+    if station_data.get('vehicles_version', 0) <= station_data.get('tombstone_floor', 0):
+        return 0
+    return get_storage().prune_tombstones(station_id, datetime.now(timezone.utc) - TOMBSTONE_RETENTION)
+
+@bp.route('/logout')
 def logout():
     """Handle user logout by clearing the session and redirecting to login page."""
     # Clear the session data
-    print("This is logout section")
+    logger.debug("This is logout section")
     session.clear()
     # Redirect to the login page
     return redirect('/login')
 
+def _station_cache_counts():
+    stats = get_storage().station_cache.snapshot()
+    return {result: stats.get(result, 0) for result in ("hits", "misses", "invalidations", "evictions")}
+
+def create_app():
+    """Build the Flask app. Cheap: no storage, mail or scheduler clients are created here."""
+    app = Flask(__name__, static_folder='static')
+    app.secret_key = os.environ.get("FLASK_SECRET_KEY", "fallback_secret_for_dev_only") # Required for Flask sessions
+    # Gunicorn leaves the root logger unconfigured; LOG_LEVEL=DEBUG shows the per-request details
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    app.register_blueprint(bp)
+    metrics.init_app(app)
+    metrics.register_counters("vehicle_admissions_total", "Vehicle add/remove commits, conflicts and give-ups.",
+                              "outcome", lambda: dict(admission_stats))
+    metrics.register_counters("email_outbox_total", "Emails queued, sent, retried, failed and refused.",
+                              "outcome", outbox_stats)
+    metrics.register_counters("station_cache_total", "Station cache lookups and drops in this worker.",
+                              "result", _station_cache_counts)
+    return app
+
+# For gunicorn (auth:app) and scheduler.py
+app = create_app()
+
 if __name__ == "__main__":
+    # With SCHEDULER_IN_WEB=1 the jobs run in this process too (gunicorn starts them in gunicorn.conf.py)
+    if os.environ.get("SCHEDULER_IN_WEB") == "1":
+        import scheduler
+        scheduler.start_background()
     # Run the Flask app
     app.run(debug=True)
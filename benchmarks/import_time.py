@@ -0,0 +1,92 @@
+"""
+Import-time benchmark.
+
+Measures, in fresh interpreters, how long it takes to import the web app (what
+each gunicorn worker pays at boot without --preload) and the scheduler (what
+every cron start pays), and how long the first request takes once the storage
+backend is created on first use. Runs against the memory backend so no
+credentials are needed.
+
+    python benchmarks/import_time.py [--runs 7] [--json results.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = {
+    "python startup": "pass",
+    "import auth (worker boot)": "import auth",
+    "import scheduler (cron start)": "import scheduler",
+    "first request": (
+        "import auth\n"
+        "client = auth.app.test_client()\n"
+        "client.get('/')"
+    ),
+}
+
+
+def time_case(code, runs):
+    """Wall-clock seconds of ``runs`` fresh interpreters running ``code``."""
+    env = dict(os.environ, STORAGE_BACKEND="memory", PYTHONPATH=ROOT)
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def heaviest_imports(module, count=10):
+    """
+    The slowest modules (cumulative microseconds) imported directly while importing
+    ``module``, as reported by ``python -X importtime``.
+    """
+    env = dict(os.environ, STORAGE_BACKEND="memory", PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=ROOT, env=env, check=True, capture_output=True, text=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Each nesting level indents by two; keep one level below the top so nothing is counted twice
+        if len(name) - len(name.lstrip(" ")) != 3:
+            continue
+        entries.append((int(cumulative), name.strip()))
+    return sorted(entries, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    for name, code in CASES.items():
+        timings = time_case(code, args.runs)
+        results[name] = {"median_ms": round(statistics.median(timings) * 1000, 1),
+                         "min_ms": round(min(timings) * 1000, 1)}
+        print(f"{name:32s} median {results[name]['median_ms']:8.1f} ms   min {results[name]['min_ms']:8.1f} ms")
+
+    print("\nHeaviest direct imports of auth (cumulative):")
+    heaviest = heaviest_imports("auth")
+    for us, name in heaviest:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+    results["heaviest_imports_ms"] = {name: round(us / 1000, 1) for us, name in heaviest}
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+Station traffic load test.
+
+Simulates ``--stations`` stations whose vehicles arrive as a Poisson process
+(``--rate`` per station per hour) and drives the real Flask routes with them:
+every station logs in, each arrival is added with ``/add_vehicle`` and followed
+by a ``/dashboard`` view, staff poll ``/api/vehicle_count`` and a share of the
+vehicles leaves early through ``/remove_vehicle``. The scheduler sweep runs at
+the end of every ``--sweep-minutes`` step, as the cron job would.
+
+Simulated time runs on a clock the benchmark advances step by step; within a
+step the stations' requests run on ``--concurrency`` threads, each station's in
+order. Runs against the memory backend so no credentials are needed;
+``--rtt-ms`` adds a delay to every backend call to stand in for Firestore
+round-trips.
+
+Reports throughput and p50/p95/p99 latency per route and backend operations
+per request, and with ``--json`` writes them as a baseline that ``--compare``
+diffs against on a later run.
+
+    python benchmarks/load.py [--stations 50] [--hours 2] [--rtt-ms 0] [--json base.json] [--compare base.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ.setdefault("EMAIL_TRANSPORT", "stub")
+
+import auth  # noqa: E402
+import scheduler  # noqa: E402
+import storage  # noqa: E402
+from timeutil import format_minutes, now_minutes  # noqa: E402
+
+ROUTES = ("/login", "/add_vehicle", "/dashboard", "/api/vehicle_count", "/remove_vehicle")
+OP_KINDS = ("read", "write", "stream", "docs_read", "cache_hit")
+CHARGER_TYPES = ("CCS", "AC Type 2", "CHAdeMO", "GB/T")
+
+
+class SimClock:
+    """Epoch minutes the benchmark moves forward; stands in for ``now_minutes`` in the app."""
+
+    def __init__(self, start):
+        self.minutes = start
+
+    def __call__(self):
+        return self.minutes
+
+
+def add_round_trip_delay(rtt_ms):
+    """Make every timed memory backend call take ``rtt_ms`` longer, counted as storage time."""
+    delay = rtt_ms / 1000
+
+    def delayed(method):
+        def call(self, *args, **kwargs):
+            time.sleep(delay)
+            return method(self, *args, **kwargs)
+        return storage._timed(call)
+
+    for name, method in list(vars(storage.MemoryStorage).items()):
+        # Functions wrapped by storage._timed are the ones making round-trips
+        if isinstance(method, types.FunctionType) and hasattr(method, "__wrapped__"):
+            setattr(storage.MemoryStorage, name, delayed(method.__wrapped__))
+
+
+def plan_station(station_id, rate_per_hour, start, minutes, leave_early, poll_minutes, rng):
+    """
+    The simulated events of one station as (minute, route, payload) tuples.
+    Removals name the arrival they belong to, the vehicle id is only known once it is added.
+    """
+    events = [(start, "/login", None)]
+    minute = start
+    arrival = 0
+    while True:
+        minute += rng.expovariate(rate_per_hour / 60)
+        if minute >= start + minutes:
+            break
+        capacity = rng.choice((30, 40, 60, 75))
+        initial = rng.randint(5, 50)
+        vehicle = {"vehicleNumber": f"{station_id}-V{arrival}",
+                   "arrivalTime": format_minutes(int(minute)),
+                   "chargingType": rng.choice(CHARGER_TYPES),
+                   "initialBatteryLevel": initial,
+                   "batteryCapacity": capacity,
+                   "targetBatteryLevel": rng.randint(initial + 20, 100) if initial < 80 else 100}
+        events.append((minute, "/add_vehicle", (arrival, vehicle)))
+        events.append((minute, "/dashboard", None))
+        if rng.random() < leave_early:
+            events.append((minute + rng.uniform(5, 60), "/remove_vehicle", arrival))
+        arrival += 1
+    events += [(start + offset, "/api/vehicle_count", None) for offset in range(0, minutes, poll_minutes)]
+    return sorted(events, key=lambda event: event[0])
+
+
+class Station:
+    """One station's client, session and the ids of the vehicles it added."""
+
+    def __init__(self, station_id, events):
+        self.station_id = station_id
+        self.events = events
+        self.client = auth.app.test_client()
+        self.vehicle_ids = {}
+
+
+def setup_station(station, slots, rng):
+    client = station.client
+    credentials = {"station_id": station.station_id, "access_key": "bench-key"}
+    client.post("/login", json=dict(credentials, action="register", email=f"{station.station_id}@bench.local"))
+    client.post("/login", json=dict(credentials, action="login"))
+    client.post("/update_station", json={
+        "stationName": station.station_id, "operatorName": "bench", "chargingType": rng.choice(CHARGER_TYPES),
+        "location": "bench", "totalSlots": slots, "chargingRate": 10,
+        "latitude": 12.9 + rng.uniform(-0.5, 0.5), "longitude": 77.6 + rng.uniform(-0.5, 0.5)})
+
+
+def parse_ops(header):
+    ops = {}
+    for part in (header or "").split(","):
+        if "=" in part:
+            kind, value = part.strip().split("=")
+            ops[kind] = int(value)
+    return ops
+
+
+def run_event(station, event, samples, lock):
+    _, route, payload = event
+    client = station.client
+    if route == "/login":
+        request = lambda: client.post("/login", json={"action": "login", "station_id": station.station_id,
+                                                      "access_key": "bench-key"})
+    elif route == "/add_vehicle":
+        request = lambda: client.post("/add_vehicle", json=payload[1])
+    elif route == "/remove_vehicle":
+        vehicle_id = station.vehicle_ids.pop(payload, None)
+        if vehicle_id is None:
+            return
+        request = lambda: client.post("/remove_vehicle", json={"vehicle_id": vehicle_id})
+    else:
+        request = lambda: client.get(route)
+    started = time.perf_counter()
+    response = request()
+    elapsed = time.perf_counter() - started
+    if route == "/add_vehicle" and response.status_code == 201:
+        station.vehicle_ids[payload[0]] = response.get_json()["vehicle_id"]
+    with lock:
+        samples[route].append((elapsed, response.status_code, parse_ops(response.headers.get("X-Storage-Ops"))))
+
+
+def forget_departed(station):
+    """Drop vehicles the sweep has removed, so no removal is sent for them."""
+    vehicles = storage.get_storage().list_vehicles(station.station_id)
+    present = {vehicle["id"] for vehicle in vehicles}
+    for arrival, vehicle_id in list(station.vehicle_ids.items()):
+        if vehicle_id not in present:
+            del station.vehicle_ids[arrival]
+
+
+def run_sweep():
+    """One scheduler sweep with its output silenced; returns (seconds, backend ops)."""
+    before = storage.get_storage().op_counts.copy()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        scheduler.run_scheduled_tasks()
+    elapsed = time.perf_counter() - started
+    return elapsed, dict(storage.get_storage().op_counts - before)
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(int(round(share * (len(ordered) - 1))), len(ordered) - 1)]
+
+
+def summarize(samples, wall_seconds):
+    routes = {}
+    for route in ROUTES:
+        entries = samples.get(route, [])
+        if not entries:
+            continue
+        latencies = [elapsed * 1000 for elapsed, _, _ in entries]
+        routes[route] = {
+            "requests": len(entries),
+            "errors": sum(1 for _, status, _ in entries if status >= 400),
+            "throughput_rps": round(len(entries) / wall_seconds, 1),
+            "p50_ms": round(percentile(latencies, 0.50), 2),
+            "p95_ms": round(percentile(latencies, 0.95), 2),
+            "p99_ms": round(percentile(latencies, 0.99), 2),
+            "mean_ms": round(statistics.fmean(latencies), 2),
+            "ops_per_request": {kind: round(sum(ops.get(kind, 0) for _, _, ops in entries) / len(entries), 2)
+                                for kind in OP_KINDS},
+        }
+    return routes
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nCompared with {baseline_path} (commit {baseline.get('commit')}):")
+    for route, current in results["routes"].items():
+        before = baseline.get("routes", {}).get(route)
+        if before is None:
+            continue
+        changes = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            change = (current[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            changes.append(f"{key[:-3]} {before[key]:.2f} -> {current[key]:.2f} ms ({change:+.0f}%)")
+        ops = [f"{kind} {before['ops_per_request'][kind]} -> {current['ops_per_request'][kind]}"
+               for kind in OP_KINDS if before["ops_per_request"].get(kind) != current["ops_per_request"][kind]]
+        print(f"  {route:20s} " + ", ".join(changes) + (f"; ops {', '.join(ops)}" if ops else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--stations", type=int, default=50)
+    parser.add_argument("--slots", type=int, default=4, help="charging slots per station")
+    parser.add_argument("--rate", type=float, default=12, help="vehicle arrivals per station per hour")
+    parser.add_argument("--hours", type=float, default=2, help="simulated hours of traffic")
+    parser.add_argument("--leave-early", type=float, default=0.2, help="share of vehicles removed before departure")
+    parser.add_argument("--poll-minutes", type=int, default=5, help="minutes between vehicle count polls")
+    parser.add_argument("--sweep-minutes", type=int, default=2, help="simulated minutes between sweeps")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads sending requests")
+    parser.add_argument("--rtt-ms", type=float, default=0, help="added to every backend call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="print the change against results written earlier with --json")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.rtt_ms:
+        add_round_trip_delay(args.rtt_ms)
+    rng = random.Random(args.seed)
+    clock = SimClock(now_minutes())
+    auth.now_minutes = scheduler.now_minutes = clock
+    minutes = int(args.hours * 60)
+
+    stations = [Station(f"bench-{index:04d}", plan_station(f"bench-{index:04d}", args.rate, clock.minutes, minutes,
+                                                           args.leave_early, args.poll_minutes, rng))
+                for index in range(args.stations)]
+    for station in stations:
+        setup_station(station, args.slots, rng)
+    print(f"{len(stations)} stations, {sum(len(station.events) for station in stations)} requests "
+          f"over {args.hours:g} simulated hours, {args.concurrency} threads, {args.rtt_ms:g} ms per backend call")
+
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    sweeps = []
+    start = clock.minutes
+    wall_started = time.perf_counter()
+    request_seconds = 0.0
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for step_start in range(start, start + minutes, args.sweep_minutes):
+            step_end = step_start + args.sweep_minutes
+
+            def run_step(station):
+                for event in station.events:
+                    if step_start <= event[0] < step_end:
+                        run_event(station, event, samples, lock)
+
+            step_started = time.perf_counter()
+            list(pool.map(run_step, stations))
+            request_seconds += time.perf_counter() - step_started
+            clock.minutes = step_end
+            sweeps.append(run_sweep())
+            for station in stations:
+                forget_departed(station)
+    wall_seconds = time.perf_counter() - wall_started
+
+    routes = summarize(samples, request_seconds)
+    total = sum(route["requests"] for route in routes.values())
+    sweep_ms = [seconds * 1000 for seconds, _ in sweeps]
+    results = {
+        "commit": git_commit(),
+        "config": vars(args) | {"json": None, "compare": None},
+        "throughput_rps": round(total / request_seconds, 1),
+        "routes": routes,
+        "sweep": {
+            "runs": len(sweeps),
+            "p50_ms": round(percentile(sweep_ms, 0.50), 2),
+            "p95_ms": round(percentile(sweep_ms, 0.95), 2),
+            "max_ms": round(max(sweep_ms), 2),
+            "ops_per_run": {kind: round(sum(ops.get(kind, 0) for _, ops in sweeps) / len(sweeps), 2)
+                            for kind in OP_KINDS},
+        },
+        "wall_seconds": round(wall_seconds, 2),
+    }
+
+    print(f"\n{total} requests in {request_seconds:.2f}s of request time ({results['throughput_rps']} req/s)\n")
+    print(f"{'route':20s} {'requests':>8s} {'errors':>6s} {'req/s':>8s} {'p50 ms':>8s} {'p95 ms':>8s} "
+          f"{'p99 ms':>8s}   ops/request")
+    for route, summary in routes.items():
+        ops = " ".join(f"{kind}={value:g}" for kind, value in summary["ops_per_request"].items())
+        print(f"{route:20s} {summary['requests']:8d} {summary['errors']:6d} {summary['throughput_rps']:8.1f} "
+              f"{summary['p50_ms']:8.2f} {summary['p95_ms']:8.2f} {summary['p99_ms']:8.2f}   {ops}")
+    sweep = results["sweep"]
+    print(f"{'sweep':20s} {sweep['runs']:8d} {'':6s} {'':8s} {sweep['p50_ms']:8.2f} {sweep['p95_ms']:8.2f} "
+          f"{'':8s}   " + " ".join(f"{kind}={value:g}" for kind, value in sweep["ops_per_run"].items()))
+
+    if args.compare:
+        compare(results, args.compare)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Charger profiles and charging estimates.
+
+Every charger type has one ``ChargerProfile`` (power, efficiency and price per
+kWh). ``estimate_charging_batch`` turns arrays of vehicles into charging time,
+cost and final state of charge in a handful of NumPy operations, so pricing
+hundreds of scenarios costs about as much as pricing one. ``estimate_charging``
+is the single-vehicle form used when a vehicle is added.
+
+Charging follows a CC/CV curve: full power up to the profile's knee state of
+charge, then power tapers linearly down to ``taper_floor`` of full power at
+100%. For each profile the time to charge from 0% to every SoC on a fine grid
+is integrated once at import into a cumulative-time table, so an estimate is
+a table interpolation in either direction (SoC range -> time, or start SoC and
+time -> end SoC) and costs the same whatever the curve looks like.
+
+A vehicle is quoted either for a target battery level or for a number of
+minutes on the charger; when both are given the minutes win.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+ChargerProfile = namedtuple("ChargerProfile",
+                            ["power_kw", "efficiency", "rate_per_kwh", "knee_soc", "taper_floor"])
+
+# DC fast chargers taper hard above ~80%; AC charging is limited by the on-board
+# charger and only slows down near full
+CHARGER_PROFILES = {
+    "AC Type 1": ChargerProfile(power_kw=7.4, efficiency=0.85, rate_per_kwh=15, knee_soc=95, taper_floor=0.5),
+    "AC Type 2": ChargerProfile(power_kw=22.0, efficiency=0.88, rate_per_kwh=18, knee_soc=95, taper_floor=0.5),
+    "CCS": ChargerProfile(power_kw=150.0, efficiency=0.92, rate_per_kwh=25, knee_soc=80, taper_floor=0.2),
+    "CHAdeMO": ChargerProfile(power_kw=62.5, efficiency=0.92, rate_per_kwh=25, knee_soc=80, taper_floor=0.2),
+    "GB/T": ChargerProfile(power_kw=120.0, efficiency=0.90, rate_per_kwh=20, knee_soc=80, taper_floor=0.2),
+}
+
+# Unknown charger types are quoted as the slowest charger
+DEFAULT_TYPE = "AC Type 1"
+
+# SoC grid of the cumulative-time tables, in percent
+SOC_STEP = 0.1
+SOC_GRID = np.linspace(0, 100, int(round(100 / SOC_STEP)) + 1)
+
+
+def charger_profile(charger_type):
+    return CHARGER_PROFILES.get(charger_type, CHARGER_PROFILES[DEFAULT_TYPE])
+
+
+def power_fraction(profile, soc):
+    """Share of full power the charger delivers at ``soc`` percent."""
+    soc = np.asarray(soc, dtype=float)
+    taper = (soc - profile.knee_soc) / max(100 - profile.knee_soc, 1e-9)
+    return np.where(soc <= profile.knee_soc, 1.0, 1 - (1 - profile.taper_floor) * np.clip(taper, 0, 1))
+
+
+def _cumulative_hours(profile):
+    """
+    Hours per kWh of battery capacity to charge from 0% to each SoC on the grid, at
+    full power 1 kW and 100% efficiency. Multiply by capacity / (power * efficiency).
+    """
+    # 1% of SoC is 0.01 kWh per kWh of capacity; trapezoidal rule on the linear taper is exact enough
+    hours_per_percent = 0.01 / power_fraction(profile, SOC_GRID)
+    steps = (hours_per_percent[1:] + hours_per_percent[:-1]) / 2 * SOC_STEP
+    return np.concatenate(([0.0], np.cumsum(steps)))
+
+
+_TYPE_NAMES = list(CHARGER_PROFILES)
+_PROFILE_VALUES = np.array([CHARGER_PROFILES[name][:3] for name in _TYPE_NAMES], dtype=float)
+_TIME_TABLES = np.array([_cumulative_hours(CHARGER_PROFILES[name]) for name in _TYPE_NAMES])
+
+
+def _profile_indices(charger_types):
+    """Row of each charger type in the profile and time tables."""
+    names, inverse = np.unique(np.asarray(charger_types, dtype=str), return_inverse=True)
+    rows = np.array([_TYPE_NAMES.index(name if name in CHARGER_PROFILES else DEFAULT_TYPE) for name in names])
+    return rows[inverse]
+
+
+def _hours_to(rows, soc):
+    """Cumulative-table value at ``soc`` for each vehicle's profile row, by linear interpolation."""
+    position = np.clip(soc, 0, 100) / SOC_STEP
+    lower = np.minimum(position.astype(int), SOC_GRID.size - 2)
+    fraction = position - lower
+    below = _TIME_TABLES[rows, lower]
+    above = _TIME_TABLES[rows, lower + 1]
+    return below + (above - below) * fraction
+
+
+def _soc_at(rows, hours):
+    """Inverse of ``_hours_to``: the SoC whose cumulative-table value is ``hours``."""
+    soc = np.empty_like(hours)
+    for row in np.unique(rows):
+        mine = rows == row
+        soc[mine] = np.interp(hours[mine], _TIME_TABLES[row], SOC_GRID)
+    return soc
+
+
+def estimate_charging_batch(charger_types, initial_soc, capacity_kwh, target_soc=None, minutes=None):
+    """
+    Estimate charging for many vehicles at once.
+    Args:
+        charger_types (array-like): charger type name per vehicle
+        initial_soc (array-like): battery percentage on arrival (0-100)
+        capacity_kwh (array-like): battery capacity in kWh
+        target_soc (array-like): target percentage, NaN where not given
+        minutes (array-like): minutes on the charger, NaN where not given
+    Returns:
+        dict: arrays ``minutes``, ``cost`` (₹), ``final_soc`` (%) and ``energy_kwh``
+        (energy stored in the battery)
+    """
+    initial_soc = np.asarray(initial_soc, dtype=float)
+    capacity_kwh = np.asarray(capacity_kwh, dtype=float)
+    count = initial_soc.shape[0]
+    target_soc = np.full(count, np.nan) if target_soc is None else np.asarray(target_soc, dtype=float)
+    minutes = np.full(count, np.nan) if minutes is None else np.asarray(minutes, dtype=float)
+    rows = _profile_indices(charger_types)
+    power_kw, efficiency, rate = _PROFILE_VALUES[rows].T
+
+    by_minutes = ~np.isnan(minutes)
+    # Table hours scale with capacity and inversely with full power and efficiency
+    scale = capacity_kwh / (power_kw * efficiency)
+    start_hours = _hours_to(rows, initial_soc)
+    final_soc = np.where(by_minutes,
+                         _soc_at(rows, start_hours + np.where(by_minutes, minutes, 0) / 60 / scale),
+                         target_soc)
+    charge_minutes = np.where(by_minutes, minutes,
+                              (_hours_to(rows, np.nan_to_num(target_soc)) - start_hours) * scale * 60)
+    energy_kwh = (final_soc - initial_soc) / 100 * capacity_kwh
+    return {
+        "minutes": charge_minutes,
+        "cost": energy_kwh / efficiency * rate,
+        "final_soc": final_soc,
+        "energy_kwh": energy_kwh,
+    }
+
+
+def estimate_charging(charger_type, initial_soc, capacity_kwh, target_soc=None, minutes=None):
+    """Single-vehicle ``estimate_charging_batch``. Returns the same keys as floats."""
+    estimate = estimate_charging_batch(
+        [charger_type], [initial_soc], [capacity_kwh],
+        target_soc=[np.nan if target_soc is None else target_soc],
+        minutes=[np.nan if minutes is None else minutes])
+    return {key: float(values[0]) for key, values in estimate.items()}
@@ -0,0 +1,152 @@
+"""
+Queue change events for open dashboards.
+
+Every vehicle commit records a ``last_change`` summary on the station document.
+The ``EventBus`` watches the documents of stations that have subscribers (a
+Firestore snapshot listener in production), turns each new version into
+``added``, ``removed`` and ``status`` events and hands them to the subscribers'
+queues. One watch per station is shared by all subscribers in the worker, and
+it is kept open for a grace period after the last one leaves so reconnecting
+clients do not restart it. Nothing is read while a station is idle.
+"""
+import queue
+import threading
+
+
+class Subscription:
+    """Events of one station for one client."""
+
+    def __init__(self, bus, station_id):
+        self._bus = bus
+        self.station_id = station_id
+        self.version = None
+        self._queue = queue.Queue(maxsize=100)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # A client this far behind is told to reload everything instead of the events it missed
+            self._overflow(event["version"])
+
+    def _overflow(self, version):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            self._queue.put_nowait({"type": "sync", "version": version})
+        except queue.Full:
+            # Another put refilled the queue in between; the next one overflows again
+            pass
+
+    def get(self, timeout):
+        """Next event, or None if nothing happened within ``timeout`` seconds."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._bus.unsubscribe(self)
+
+
+class _StationWatch:
+    def __init__(self):
+        self.subscribers = set()
+        self.version = None
+        self.unsubscribe = None
+        self.stop_timer = None
+
+
+class EventBus:
+    """Fans station changes out to subscribers, watching each station once per worker."""
+
+    def __init__(self, store, max_subscribers=2, idle_grace_seconds=60):
+        self._store = store
+        self.max_subscribers = max_subscribers
+        self.idle_grace_seconds = idle_grace_seconds
+        self._lock = threading.Lock()
+        self._watches = {}
+        self._subscriber_count = 0
+
+    def subscribe(self, station_id):
+        """Return a new Subscription, or None if this worker already serves too many."""
+        with self._lock:
+            if self._subscriber_count >= self.max_subscribers:
+                return None
+            self._subscriber_count += 1
+            subscription = Subscription(self, station_id)
+            watch = self._watches.get(station_id)
+            start = watch is None
+            if start:
+                watch = self._watches[station_id] = _StationWatch()
+            if watch.stop_timer is not None:
+                watch.stop_timer.cancel()
+                watch.stop_timer = None
+            watch.subscribers.add(subscription)
+            subscription.version = watch.version
+
+        if start:
+            try:
+                unsubscribe = self._store.watch_station(
+                    station_id, lambda data: self._on_station(station_id, data))
+            except Exception:
+                self.unsubscribe(subscription)
+                raise
+            with self._lock:
+                watch.unsubscribe = unsubscribe
+                subscription.version = watch.version
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            watch = self._watches.get(subscription.station_id)
+            if watch is None or subscription not in watch.subscribers:
+                return
+            watch.subscribers.discard(subscription)
+            self._subscriber_count -= 1
+            if not watch.subscribers:
+                watch.stop_timer = threading.Timer(
+                    self.idle_grace_seconds, self._stop_if_idle, args=(subscription.station_id, watch))
+                watch.stop_timer.daemon = True
+                watch.stop_timer.start()
+
+    def _stop_if_idle(self, station_id, watch):
+        with self._lock:
+            if watch.subscribers or self._watches.get(station_id) is not watch:
+                return
+            del self._watches[station_id]
+        if watch.unsubscribe is not None:
+            watch.unsubscribe()
+
+    def _on_station(self, station_id, data):
+        data = data or {}
+        version = data.get("vehicles_version", 0)
+        with self._lock:
+            watch = self._watches.get(station_id)
+            if watch is None:
+                return
+            previous, watch.version = watch.version, version
+            subscribers = list(watch.subscribers)
+        # The first snapshot only sets the baseline; later ones without a new version are other field updates
+        if previous is None or version <= previous:
+            return
+        for event in change_events(data, previous):
+            for subscription in subscribers:
+                subscription.put(event)
+
+
+def change_events(station_data, since_version):
+    """Events describing the station's latest change after ``since_version``."""
+    version = station_data.get("vehicles_version", 0)
+    change = station_data.get("last_change") or {}
+    if change.get("version") != version or version != since_version + 1:
+        # Several commits were coalesced into one snapshot; clients resync from the delta endpoint
+        return [{"type": "sync", "version": version}]
+    events = []
+    for event_type, key in (("added", "added"), ("removed", "removed"), ("status", "updated")):
+        if change.get(key):
+            events.append({"type": event_type, "version": version, "vehicle_ids": change[key]})
+    return events or [{"type": "sync", "version": version}]
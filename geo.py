@@ -0,0 +1,138 @@
+"""
+Nearby-station search.
+
+Stations with coordinates are kept in a ``StationIndex``: a grid of cells
+``CELL_DEGREES`` wide, so a search only looks at the stations in the cells
+around the driver instead of at every station. Results are ranked by the
+minutes it takes to get there plus the wait the station's forecast projects
+for that arrival (see ``slots.wait_forecast``), or its current wait time.
+
+The index is filled from a snapshot the scheduler sweep writes after every
+run (``station_index_snapshot``): one small entry per station with its
+position, charger type, wait time and wait forecast. Web workers load the snapshot when
+their copy is older than ``STATION_INDEX_TTL_SECONDS``, so a search never
+reads the stations collection.
+"""
+import math
+import os
+import threading
+import time
+from collections import namedtuple
+
+from slots import forecast_wait
+
+# Grid cell size in degrees (about 28 km north-south)
+CELL_DEGREES = 0.25
+KM_PER_DEGREE = 111.32
+EARTH_RADIUS_KM = 6371.0
+
+# Average driving speed used to turn distance into minutes for ranking
+AVERAGE_SPEED_KMH = float(os.environ.get("NEARBY_AVERAGE_SPEED_KMH", 30))
+
+# How long a web worker uses its copy of the index before loading the snapshot again
+STATION_INDEX_TTL_SECONDS = int(os.environ.get("STATION_INDEX_TTL_SECONDS", 60))
+
+# Snapshots stored before the wait forecast existed load with none
+StationEntry = namedtuple("StationEntry", [
+    "station_id", "name", "location", "latitude", "longitude", "charging_type", "total_slots", "wait_minutes",
+    "wait_forecast"
+], defaults=(None,))
+
+
+def station_entry(station_id, station_data, wait_minutes=None, wait_forecast=None):
+    """Index entry for a station document, or None if it has no coordinates."""
+    try:
+        latitude = float(station_data["latitude"])
+        longitude = float(station_data["longitude"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if wait_minutes is None:
+        wait_minutes = station_data.get("latest_wait_time_minutes") or 0
+    return StationEntry(station_id, station_data.get("name"), station_data.get("location"), latitude, longitude,
+                        station_data.get("chargingType"), int(station_data.get("total_slots") or 0),
+                        int(wait_minutes), wait_forecast or station_data.get("wait_forecast"))
+
+
+def wait_on_arrival(entry, arrival):
+    """Projected wait at a station for an arrival at ``arrival``; its current wait where it has no forecast."""
+    wait = forecast_wait(entry.wait_forecast, arrival)
+    return entry.wait_minutes if wait is None else wait
+
+
+def station_index_snapshot(entries):
+    """The document the sweep stores for web workers to load with ``StationIndex.load``."""
+    return {"stations": [entry._asdict() for entry in entries]}
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def _cell(latitude, longitude):
+    return int(math.floor(latitude / CELL_DEGREES)), int(math.floor(longitude / CELL_DEGREES))
+
+
+class StationIndex:
+    """Grid index of station positions, replaced as a whole whenever a new snapshot is loaded."""
+
+    def __init__(self, entries=()):
+        self._lock = threading.Lock()
+        self._cells = {}
+        self.loaded_at = None
+        if entries:
+            self.replace(entries)
+
+    def __len__(self):
+        return sum(len(cell) for cell in self._cells.values())
+
+    def replace(self, entries):
+        cells = {}
+        for entry in entries:
+            cells.setdefault(_cell(entry.latitude, entry.longitude), []).append(entry)
+        with self._lock:
+            self._cells = cells
+            self.loaded_at = time.monotonic()
+
+    def load(self, snapshot):
+        """Replace the entries with those of a ``station_index_snapshot`` document."""
+        self.replace(StationEntry(**entry) for entry in (snapshot or {}).get("stations", ()))
+
+    def is_stale(self, ttl_seconds=STATION_INDEX_TTL_SECONDS):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > ttl_seconds
+
+    def nearby(self, latitude, longitude, charger=None, radius_km=25.0, limit=10, now=None):
+        """
+        Stations within ``radius_km``, best first by travel minutes plus wait minutes.
+        Args:
+            charger (str): only stations with this charging type (case-insensitive)
+            now (int): epoch minutes of departure; with it the wait is the one projected for the
+                arrival, otherwise the station's current wait
+        Returns:
+            list: (entry, distance_km, travel_minutes, wait_minutes) tuples
+        """
+        with self._lock:
+            cells = self._cells
+        lat_span = radius_km / KM_PER_DEGREE
+        # Degrees of longitude shrink towards the poles; size the span for the band's poleward edge
+        poleward = min(abs(latitude) + lat_span, 90.0)
+        lng_span = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(poleward)), 0.01))
+        low_row, low_col = _cell(latitude - lat_span, longitude - lng_span)
+        high_row, high_col = _cell(latitude + lat_span, longitude + lng_span)
+        charger = charger.lower() if charger else None
+
+        results = []
+        for row in range(low_row, high_row + 1):
+            for col in range(low_col, high_col + 1):
+                for entry in cells.get((row, col), ()):
+                    if charger and (entry.charging_type or "").lower() != charger:
+                        continue
+                    distance = distance_km(latitude, longitude, entry.latitude, entry.longitude)
+                    if distance <= radius_km:
+                        travel_minutes = distance / AVERAGE_SPEED_KMH * 60
+                        wait = entry.wait_minutes if now is None else wait_on_arrival(entry, now + round(travel_minutes))
+                        results.append((entry, distance, travel_minutes, wait))
+        results.sort(key=lambda result: (result[2] + result[3], result[1]))
+        return results[:limit]
@@ -0,0 +1,14 @@
+# gunicorn.conf.py - read by gunicorn from the working directory
+import os
+
+# Import the app once in the master and fork the workers from it. This is safe because
+# importing auth creates no storage clients, gRPC channels, threads or sockets; each
+# worker creates those on first use.
+preload_app = True
+
+
+def post_worker_init(worker):
+    # With SCHEDULER_IN_WEB=1 every worker starts the scheduler; its lock lets only one run the jobs
+    if os.environ.get("SCHEDULER_IN_WEB") == "1":
+        import scheduler
+        scheduler.start_background()
@@ -0,0 +1,172 @@
+"""
+Request metrics.
+
+``init_app`` hooks every request of the app: it times the request, counts the
+storage round-trips it made by kind (calls, seconds and documents read, see
+``storage.begin_op_tracking``) and adds them up per route. ``/metrics`` serves
+the totals as Prometheus text, together with any counters registered with
+``register_counters`` (e.g. admissions and station cache hits).
+
+Requests slower than ``SLOW_REQUEST_SECONDS`` are logged as one JSON object
+each, with their storage round-trips, so the slow endpoints and the calls that
+made them slow can be found in the logs.
+
+The numbers are per process: with several gunicorn workers every worker keeps
+its own and ``/metrics`` shows those of the worker that served the scrape.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from flask import Response, g, request
+
+from storage import begin_op_tracking, end_op_tracking
+
+logger = logging.getLogger(__name__)
+
+# Requests taking longer than this are logged with their storage round-trips
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", 0.5))
+
+# Upper bounds of the request duration histogram, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STORAGE_KINDS = ("read", "write", "stream", "cache_hit")
+
+_lock = threading.Lock()
+_requests = Counter()  # (route, method, status) -> requests
+_latency = {}  # route -> [count per bucket..., +Inf count, sum of seconds]
+_storage_calls = Counter()  # (route, kind) -> calls
+_storage_seconds = Counter()  # (route, kind) -> seconds
+_docs_read = Counter()  # route -> documents read
+_slow_requests = Counter()  # route -> requests over SLOW_REQUEST_SECONDS
+_registered = {}  # name -> (help, label, source)
+
+
+def register_counters(name, help_text, label, source):
+    """
+    Export ``source()`` on ``/metrics`` as the counter ``name``: it returns a
+    mapping of ``label`` values to numbers, read at every scrape. Registering a
+    name again replaces it, so building the app twice exports each counter once.
+    """
+    _registered[name] = (help_text, label, source)
+
+
+def _route():
+    # The rule, not the path, so that ids in URLs do not make a series each
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    begin_op_tracking()
+
+
+def _after_request(response):
+    ops = end_op_tracking()
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return response
+    seconds = time.perf_counter() - started
+    route = _route()
+    response.headers["X-Storage-Ops"] = ", ".join(
+        f"{kind}={ops[kind]}" for kind in ("read", "write", "stream", "docs_read", "cache_hit"))
+
+    with _lock:
+        _requests[route, request.method, response.status_code] += 1
+        latency = _latency.setdefault(route, [0] * (len(LATENCY_BUCKETS) + 2))
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                latency[index] += 1
+        latency[-2] += 1
+        latency[-1] += seconds
+        for kind in STORAGE_KINDS:
+            _storage_calls[route, kind] += ops[kind]
+            _storage_seconds[route, kind] += ops[f"{kind}_seconds"]
+        _docs_read[route] += ops["docs_read"]
+        if seconds > SLOW_REQUEST_SECONDS:
+            _slow_requests[route] += 1
+
+    if seconds > SLOW_REQUEST_SECONDS:
+        logger.warning("slow request %s", json.dumps({
+            "method": request.method,
+            "path": request.path,
+            "route": route,
+            "status": response.status_code,
+            "duration_ms": round(seconds * 1000, 1),
+            "storage_ms": round(sum(ops[f"{kind}_seconds"] for kind in STORAGE_KINDS) * 1000, 1),
+            "storage": {kind: ops[kind] for kind in STORAGE_KINDS + ("docs_read",)},
+        }))
+    return response
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+def _header(lines, name, help_text, kind="counter"):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        requests = dict(_requests)
+        latency = {route: list(values) for route, values in _latency.items()}
+        storage_calls = dict(_storage_calls)
+        storage_seconds = dict(_storage_seconds)
+        docs_read = dict(_docs_read)
+        slow_requests = dict(_slow_requests)
+
+    lines = []
+    _header(lines, "http_requests_total", "Requests served, by route, method and status.")
+    for (route, method, status), count in sorted(requests.items()):
+        lines.append(f"http_requests_total{{{_labels(route=route, method=method, status=status)}}} {count}")
+
+    _header(lines, "http_request_duration_seconds", "Time to build the response, by route.", "histogram")
+    for route, values in sorted(latency.items()):
+        for bound, count in zip(LATENCY_BUCKETS, values):
+            lines.append(f"http_request_duration_seconds_bucket{{{_labels(route=route, le=bound)}}} {count}")
+        lines.append(f"http_request_duration_seconds_bucket{{{_labels(route=route, le='+Inf')}}} {values[-2]}")
+        lines.append(f"http_request_duration_seconds_count{{{_labels(route=route)}}} {values[-2]}")
+        lines.append(f"http_request_duration_seconds_sum{{{_labels(route=route)}}} {values[-1]:.6f}")
+
+    _header(lines, "http_slow_requests_total", f"Requests slower than {SLOW_REQUEST_SECONDS}s, by route.")
+    for route, count in sorted(slow_requests.items()):
+        lines.append(f"http_slow_requests_total{{{_labels(route=route)}}} {count}")
+
+    _header(lines, "storage_operations_total", "Storage round-trips made by requests, by route and kind.")
+    for (route, kind), count in sorted(storage_calls.items()):
+        lines.append(f"storage_operations_total{{{_labels(route=route, kind=kind)}}} {count}")
+
+    _header(lines, "storage_operation_seconds_total", "Time spent in storage round-trips, by route and kind.")
+    for (route, kind), seconds in sorted(storage_seconds.items()):
+        lines.append(f"storage_operation_seconds_total{{{_labels(route=route, kind=kind)}}} {seconds:.6f}")
+
+    _header(lines, "storage_documents_read_total", "Documents read by requests, by route.")
+    for route, count in sorted(docs_read.items()):
+        lines.append(f"storage_documents_read_total{{{_labels(route=route)}}} {count}")
+
+    for name, (help_text, label, source) in list(_registered.items()):
+        _header(lines, name, help_text)
+        for value, count in sorted(source().items()):
+            lines.append(f"{name}{{{_labels(**{label: value})}}} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics():
+    return Response(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def init_app(app):
+    """Time every request of ``app`` and serve the totals on ``/metrics``."""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule("/metrics", "metrics", metrics)
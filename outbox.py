@@ -0,0 +1,228 @@
+"""
+Outgoing email, sent in the background.
+
+Requests hand mail to the process's ``Outbox`` (``get_outbox``) and return at
+once; a few worker threads deliver it through one transport that is built once
+per process and reused for every message. A failed delivery is retried with
+exponential backoff up to ``EMAIL_MAX_ATTEMPTS`` times, except when the provider
+rejected the message itself (a 4xx other than 429). Each address may be sent at
+most ``EMAIL_RATE_LIMIT`` messages per ``EMAIL_RATE_WINDOW_SECONDS``.
+
+``EMAIL_TRANSPORT`` picks the transport: ``sendgrid`` (default, needs
+``SENDGRID_API_KEY`` and ``EMAIL_SENDER``) or ``stub``, which only logs and
+keeps the messages, for running and testing without network access.
+
+Mail still queued when the process exits is lost; the workers get
+``EMAIL_DRAIN_SECONDS`` at exit to finish it.
+"""
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, deque, namedtuple
+
+logger = logging.getLogger(__name__)
+
+EMAIL_TRANSPORT = os.environ.get("EMAIL_TRANSPORT", "sendgrid")
+EMAIL_WORKERS = int(os.environ.get("EMAIL_WORKERS", 2))
+EMAIL_QUEUE_SIZE = int(os.environ.get("EMAIL_QUEUE_SIZE", 1000))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get("EMAIL_MAX_ATTEMPTS", 5))
+# Delay before the first retry; doubled for every further one
+EMAIL_RETRY_SECONDS = float(os.environ.get("EMAIL_RETRY_SECONDS", 2))
+EMAIL_RATE_LIMIT = int(os.environ.get("EMAIL_RATE_LIMIT", 3))
+EMAIL_RATE_WINDOW_SECONDS = int(os.environ.get("EMAIL_RATE_WINDOW_SECONDS", 900))
+EMAIL_DRAIN_SECONDS = float(os.environ.get("EMAIL_DRAIN_SECONDS", 5))
+
+Email = namedtuple("Email", ["to", "subject", "body"])
+
+
+class RateLimited(Exception):
+    """The address has been sent as many messages as it may for now."""
+
+
+class OutboxFull(Exception):
+    """Too much mail is waiting to be sent."""
+
+
+class StubTransport:
+    """Keeps and logs messages instead of sending them."""
+
+    name = "stub"
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, email):
+        self.sent.append(email)
+        logger.info(f"Stub email to {email.to}: {email.subject}")
+
+
+class SendGridTransport:
+    """Sends through the SendGrid API with one client for the whole process."""
+
+    name = "sendgrid"
+
+    def __init__(self, api_key=None, sender=None):
+        self.sender = sender or os.environ.get("EMAIL_SENDER")
+        api_key = api_key or os.environ.get("SENDGRID_API_KEY")
+        if not self.sender or not api_key:
+            raise Exception("SendGrid credentials not set in environment variables.")
+        # Imported here so that workers which never send mail do not load SendGrid
+        from sendgrid import SendGridAPIClient
+        self.client = SendGridAPIClient(api_key)
+
+    def send(self, email):
+        from sendgrid.helpers.mail import Mail
+        response = self.client.send(Mail(from_email=self.sender, to_emails=email.to,
+                                         subject=email.subject, plain_text_content=email.body))
+        logger.info(f"Email sent to {email.to}, status code: {response.status_code}")
+
+
+def create_transport(name=EMAIL_TRANSPORT):
+    if name == "stub":
+        return StubTransport()
+    if name == "sendgrid":
+        return SendGridTransport()
+    raise ValueError(f"Unknown EMAIL_TRANSPORT '{name}' (expected 'sendgrid' or 'stub')")
+
+
+def _permanent(error):
+    """Whether the provider rejected the message itself, so sending it again cannot help."""
+    status = getattr(error, "status_code", None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+class Outbox:
+    """Queue of mail delivered by background threads, started with the first message."""
+
+    def __init__(self, transport, workers=EMAIL_WORKERS, max_queued=EMAIL_QUEUE_SIZE,
+                 max_attempts=EMAIL_MAX_ATTEMPTS, retry_seconds=EMAIL_RETRY_SECONDS,
+                 rate_limit=EMAIL_RATE_LIMIT, rate_window_seconds=EMAIL_RATE_WINDOW_SECONDS):
+        self.transport = transport
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.rate_limit = rate_limit
+        self.rate_window_seconds = rate_window_seconds
+        self.stats = Counter()
+        self._cond = threading.Condition()
+        self._pending = []  # heap of (due, sequence, attempt, email)
+        self._sequence = itertools.count()
+        self._sending = 0
+        self._sent_to = {}  # address -> deque of send times within the window
+        self._threads = []
+
+    def _recent(self, address, now):
+        sent = self._sent_to.setdefault(address, deque())
+        while sent and sent[0] <= now - self.rate_window_seconds:
+            sent.popleft()
+        if not sent:
+            del self._sent_to[address]
+        return sent
+
+    def allows(self, to):
+        """Whether a message to ``to`` would be accepted now."""
+        with self._cond:
+            return len(self._recent(to.strip().lower(), time.monotonic())) < self.rate_limit
+
+    def send(self, to, subject, body):
+        """
+        Queue a message; it is delivered in the background.
+        Raises:
+            RateLimited: ``to`` has had EMAIL_RATE_LIMIT messages within the window
+            OutboxFull: EMAIL_QUEUE_SIZE messages are waiting already
+        """
+        address = to.strip().lower()
+        with self._cond:
+            now = time.monotonic()
+            recent = self._recent(address, now)
+            if len(recent) >= self.rate_limit:
+                self.stats["rate_limited"] += 1
+                raise RateLimited(f"Too many emails to {address}, try again later.")
+            if len(self._pending) >= self.max_queued:
+                self.stats["rejected"] += 1
+                raise OutboxFull("Too many emails are waiting to be sent.")
+            recent.append(now)
+            self._sent_to[address] = recent
+            self._push(now, 1, Email(to, subject, body))
+            self.stats["queued"] += 1
+            self._start_workers()
+
+    def _push(self, due, attempt, email):
+        heapq.heappush(self._pending, (due, next(self._sequence), attempt, email))
+        self._cond.notify_all()
+
+    def _start_workers(self):
+        # Threads are started on first use, never at import, so gunicorn can fork safely
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"outbox-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._pending and self._pending[0][0] <= now:
+                    _, _, attempt, email = heapq.heappop(self._pending)
+                    self._sending += 1
+                    return attempt, email
+                self._cond.wait(self._pending[0][0] - now if self._pending else None)
+
+    def _work(self):
+        while True:
+            attempt, email = self._next()
+            try:
+                self.transport.send(email)
+                outcome = "sent"
+            except Exception as e:
+                if _permanent(e) or attempt >= self.max_attempts:
+                    logger.error(f"Giving up on email to {email.to} after {attempt} attempt(s): {e}")
+                    outcome = "failed"
+                else:
+                    delay = self.retry_seconds * 2 ** (attempt - 1) * random.uniform(1, 1.5)
+                    logger.warning(f"Email to {email.to} failed (attempt {attempt}), retrying in {delay:.1f}s: {e}")
+                    outcome = "retried"
+                    with self._cond:
+                        self._push(time.monotonic() + delay, attempt + 1, email)
+            with self._cond:
+                self._sending -= 1
+                self.stats[outcome] += 1
+                self._cond.notify_all()
+
+    def drain(self, timeout):
+        """Wait up to ``timeout`` seconds for every message that is due to be delivered."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._sending or (self._pending and self._pending[0][0] <= time.monotonic()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    """The process's outbox, created on first use with the EMAIL_TRANSPORT transport."""
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = Outbox(create_transport())
+                atexit.register(_outbox.drain, EMAIL_DRAIN_SECONDS)
+    return _outbox
+
+
+def outbox_stats():
+    """Counts of queued, sent, retried, failed, rate limited and rejected mail (empty before first use)."""
+    return dict(_outbox.stats) if _outbox is not None else {}
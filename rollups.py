@@ -0,0 +1,155 @@
+"""
+Hourly utilization and revenue rollups per station.
+
+Every vehicle commit updates the rollups of the hours it affects in the same
+write (see ``storage.commit_vehicle_changes``), so reports read one small
+document per station and hour instead of the sessions themselves:
+
+- a vehicle added counts as a booking in the hour it was booked;
+- a vehicle removed after its departure counts as a completed session, with its
+  ``charging_cost`` as revenue and the energy it charged, in its departure hour;
+- a vehicle removed before its departure counts as cancelled in the hour it was
+  removed, with the revenue and energy of the part it had charged, if any.
+
+The minutes a removed vehicle spent charging are spread over the hours it
+occupied its slot, up to ``ROLLUP_MAX_SPREAD_HOURS`` of them; divided by the
+station's slot minutes they give the utilization. Hours are station-time hours,
+identified by the epoch minute they start at. Rollups only count sessions booked and removed since they were
+introduced.
+"""
+from bisect import bisect_right
+from datetime import datetime, time, timedelta
+
+from timeutil import to_local, to_minutes, vehicle_minutes
+
+ROLLUP_FIELDS = ("sessions_booked", "sessions_completed", "sessions_cancelled",
+                 "charging_minutes", "energy_kwh", "revenue")
+
+# Hours a session's charging minutes are spread over; any later minutes count in the hour it ended,
+# so removing one vehicle touches a bounded number of rollups however long it stayed
+ROLLUP_MAX_SPREAD_HOURS = 48
+
+
+def hour_start(minutes):
+    """Epoch minute at which the station-time hour containing ``minutes`` starts."""
+    return minutes - to_local(minutes).minute
+
+
+def rollup_id(station_id, hour):
+    return f"{station_id}_{hour}"
+
+
+def _energy_kwh(vehicle):
+    try:
+        final = vehicle.get("estimated_final_battery")
+        if final is None:
+            final = vehicle.get("target_battery_level")
+        charged = float(final) - float(vehicle["initial_battery_level"])
+        return max(charged, 0.0) * float(vehicle["battery_capacity"]) / 100
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+def _add(deltas, hour, field, amount):
+    if amount:
+        fields = deltas.setdefault(hour, {})
+        fields[field] = fields.get(field, 0) + amount
+
+
+def _spread(deltas, start, end):
+    """Charging minutes of ``[start, end)`` per hour, for at most ROLLUP_MAX_SPREAD_HOURS hours."""
+    for _ in range(ROLLUP_MAX_SPREAD_HOURS):
+        if start >= end:
+            return
+        hour = hour_start(start)
+        until = min(hour + 60, end)
+        _add(deltas, hour, "charging_minutes", until - start)
+        start = until
+    if start < end:
+        _add(deltas, hour_start(end - 1), "charging_minutes", end - start)
+
+
+def rollup_deltas(added, previous, removed, now):
+    """
+    The rollup increments of a commit made at ``now`` (epoch minutes). ``previous``
+    maps the ids of removed vehicles to their stored data.
+    Returns:
+        dict: {hour: {field: amount}}
+    """
+    deltas = {}
+    for _ in (added or {}):
+        _add(deltas, hour_start(now), "sessions_booked", 1)
+    for vehicle_id in removed:
+        vehicle = previous.get(vehicle_id)
+        if vehicle is None:
+            continue
+        try:
+            start = vehicle_minutes(vehicle, "charging_start")
+            departure = vehicle_minutes(vehicle, "departure")
+        except ValueError:
+            start = departure = None
+        completed = departure is not None and departure <= now
+        end = departure if completed else now
+        if start is not None and departure is not None:
+            _spread(deltas, start, end)
+        # A session cut short is counted for the share of its charge it received
+        share = 1.0
+        if not completed:
+            planned = vehicle.get("charging_time_minutes") or 0
+            charged = max(end - start, 0) if start is not None else 0
+            share = min(charged / planned, 1.0) if planned else 0.0
+        hour = hour_start(departure if completed else now)
+        _add(deltas, hour, "sessions_completed" if completed else "sessions_cancelled", 1)
+        _add(deltas, hour, "energy_kwh", round(_energy_kwh(vehicle) * share, 3))
+        _add(deltas, hour, "revenue", round((vehicle.get("charging_cost") or 0) * share, 2))
+    return deltas
+
+
+def period_start(minutes, granularity):
+    """Start of the station-time ``hour`` or ``day`` containing ``minutes``."""
+    if granularity == "day":
+        return to_minutes(datetime.combine(to_local(minutes).date(), time()))
+    return hour_start(minutes)
+
+
+def _next_period(period, granularity):
+    if granularity == "day":
+        # Station-time days are not always 24 hours long
+        return to_minutes(datetime.combine(to_local(period).date() + timedelta(days=1), time()))
+    return period + 60
+
+
+def period_range(start, end, granularity):
+    """``[start, end)`` widened to whole station-time hours or days."""
+    return period_start(start, granularity), _next_period(period_start(end - 1, granularity), granularity)
+
+
+def summarize(rows, start, end, total_slots, granularity="hour"):
+    """
+    Totals per station-time ``hour`` or ``day`` over ``[start, end)`` from rollup
+    rows, with utilization as the share of the station's slot minutes spent
+    charging. Periods without rows are included with zeros; ``start`` must be a
+    period start.
+    Returns:
+        list: dicts with the period's ``start`` (epoch minutes), the ROLLUP_FIELDS and ``utilization``
+    """
+    bounds = []
+    period = start
+    while period < end:
+        bounds.append(period)
+        period = _next_period(period, granularity)
+    totals = [dict.fromkeys(ROLLUP_FIELDS, 0) for _ in bounds]
+    for row in rows:
+        if start <= row["hour"] < end:
+            period_totals = totals[bisect_right(bounds, row["hour"]) - 1]
+            for field in ROLLUP_FIELDS:
+                period_totals[field] += row.get(field) or 0
+    summaries = []
+    for index, period in enumerate(bounds):
+        capacity = total_slots * (min(_next_period(period, granularity), end) - period)
+        period_totals = totals[index]
+        summaries.append(dict(period_totals, start=period,
+                              energy_kwh=round(period_totals["energy_kwh"], 3),
+                              revenue=round(period_totals["revenue"], 2),
+                              utilization=round(period_totals["charging_minutes"] / capacity, 4) if capacity else None))
+    return summaries
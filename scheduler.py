@@ -1,34 +1,371 @@
 # scheduler.py
+import argparse
 import logging
-from datetime import datetime
-from auth import app, update_all_station_wait_times, remove_completed_vehicles  # Fixed import
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from auth import app, sweep_station, reconcile_station_counters, prune_station_tombstones
+from geo import station_entry, station_index_snapshot
+from timeutil import now_minutes, to_timestamp
+from storage import get_storage
 
-def run_scheduled_tasks():
-    """Run tasks once and exit - perfect for cron jobs"""
+try:
+    import fcntl
+except ImportError:  # not available on Windows; the storage lease still applies
+    fcntl = None
+
+# Stations are processed concurrently; each worker mostly waits on Firestore round-trips
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 8))
+
+# Long-running mode (--serve): how often each job runs. The sweep may run more than once a minute.
+SCHEDULER_INTERVAL_SECONDS = int(os.environ.get("SCHEDULER_INTERVAL_SECONDS", 120))
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get("RECONCILE_INTERVAL_SECONDS", 3600))
+# A holder that stops renewing loses the lease after this long and another process takes over
+SCHEDULER_LEASE_SECONDS = int(os.environ.get("SCHEDULER_LEASE_SECONDS", max(2 * SCHEDULER_INTERVAL_SECONDS, 60)))
+SCHEDULER_LOCK_FILE = os.environ.get("SCHEDULER_LOCK_FILE",
+                                     os.path.join(tempfile.gettempdir(), "easy-vahan-scheduler.lock"))
+
+class LeaseLost(Exception):
+    """The scheduler lease could not be renewed while a job was running."""
+
+# Set by the lease heartbeat of the running job (see ``run_job``) once the lease is lost
+_lease_lost = threading.Event()
+
+def check_lease():
+    """Raise LeaseLost if the running job's lease was lost, so another process may be running jobs."""
+    if _lease_lost.is_set():
+        raise LeaseLost("The scheduler lease was lost to another process, stopping the job")
+
+def _run_station(job, station_id, station_data, now):
+    check_lease()
+    return job(station_id, station_data, now)
+
+def sweep_stations(name, job, stations, now):
+    """
+    Run ``job(station_id, station_data, now)`` for every station on a bounded thread pool.
+    A failing station is logged and skipped so it cannot stall the rest of the sweep.
+    If the scheduler lease is lost, the stations not started yet are dropped and
+    LeaseLost is raised.
+    Returns:
+        tuple: ({station_id: result}, number of failed stations)
+    """
+    started = time.perf_counter()
+    results = {}
+    errors = 0
+    with ThreadPoolExecutor(max_workers=SCHEDULER_WORKERS) as pool:
+        futures = {pool.submit(_run_station, job, station_id, station_data, now): station_id
+                   for station_id, station_data in stations}
+        for future in as_completed(futures):
+            station_id = futures[future]
+            try:
+                results[station_id] = future.result()
+            except LeaseLost:
+                for pending in futures:
+                    pending.cancel()
+                raise
+            except Exception as e:
+                errors += 1
+                logging.error(f"Scheduler job '{name}' failed for station '{station_id}': {e}", exc_info=True)
+    elapsed = time.perf_counter() - started
+    rate = len(stations) / elapsed if elapsed > 0 else 0.0
+    print(f"⏱️  {name}: {len(stations)} stations in {elapsed:.2f}s ({rate:.1f} stations/s), {errors} failed")
+    return results, errors
+
+_last_index_snapshot = None
+
+def refresh_station_index(stations, swept):
+    """
+    Store the snapshot the nearby-station search loads, with the wait times and
+    forecasts just computed. Skipped if nothing in it changed since this process last stored it.
+    """
+    global _last_index_snapshot
+    entries = []
+    for station_id, station_data in sorted(stations, key=lambda station: station[0]):
+        result = swept.get(station_id)
+        entry = station_entry(station_id, station_data, result["wait_minutes"] if result else None,
+                              result["wait_forecast"] if result else None)
+        if entry is not None:
+            entries.append(entry)
+    snapshot = station_index_snapshot(entries)
+    if snapshot != _last_index_snapshot:
+        get_storage().save_station_index(dict(snapshot, refreshed_at=datetime.now(timezone.utc)))
+        _last_index_snapshot = snapshot
+        print(f"📍 Station index refreshed: {len(entries)} stations with coordinates")
+
+def run_scheduled_tasks(full=False):
+    """
+    Run tasks once and exit - perfect for cron jobs.
+    With ``full`` every station's vehicles are read instead of only the ones the
+    index queries find; this also backfills the timestamps of older vehicles.
+    """
     print(f"🚀 Starting scheduled tasks at: {datetime.now()}")
-    
+    started = time.perf_counter()
+    ops_before = get_storage().op_counts.copy()
+
     try:
         with app.app_context():
-            print("📊 Updating station wait times...")
-            update_all_station_wait_times()
-            print("✅ Station wait times updated successfully")
-            
-            print("🚗 Removing completed vehicles...")
-            remove_completed_vehicles()
-            print("✅ Completed vehicles removed successfully")
-            
+            now = now_minutes()
+            stations = list(get_storage().stream_stations())
+
+            # Index queries find the vehicles that have departed or are due to start charging;
+            # one pass per station then removes, promotes and recomputes the wait time
+            due = None if full else get_storage().find_due_vehicles(to_timestamp(now))
+            print(f"🔄 Sweeping stations ({'full scan' if full else 'due vehicles only'})...")
+            job = sweep_station if full else (
+                lambda station_id, station_data, now: sweep_station(station_id, station_data, now,
+                                                                    due.get(station_id, ((), ()))))
+            swept, failed = sweep_stations("sweep", job, stations, now)
+            # Wait times of stations without vehicle changes are written in batches
+            updates = {station_id: result["station_updates"]
+                       for station_id, result in swept.items() if result["station_updates"]}
+            check_lease()
+            get_storage().update_stations(updates)
+            print("✅ Stations swept successfully")
+            try:
+                refresh_station_index(stations, swept)
+            except Exception as e:
+                logging.error(f"Could not refresh the station index: {e}", exc_info=True)
+
+            elapsed = time.perf_counter() - started
+            ops = get_storage().op_counts - ops_before
+            print(f"📈 Run took {elapsed:.2f}s for {len(stations)} stations "
+                  f"({len(stations) / elapsed if elapsed > 0 else 0.0:.1f} stations/s): "
+                  f"{sum(r['wait_updated'] for r in swept.values())} wait times updated, "
+                  f"{sum(r['promoted'] for r in swept.values())} vehicles promoted, "
+                  f"{sum(r['rescheduled'] for r in swept.values())} vehicles rescheduled, "
+                  f"{sum(r['removed'] for r in swept.values())} vehicles removed; backend ops {dict(ops)}")
+
+            if failed:
+                raise RuntimeError(f"{failed} station job(s) failed, see the log above")
             print("🎉 All scheduled tasks completed!")
-            
+
     except Exception as e:
         print(f"❌ Error in scheduled tasks: {e}")
         logging.error(f"Scheduler error: {e}", exc_info=True)
         raise
 
+def run_reconcile():
+    """
+    Recount station counters from the vehicles and prune old tombstones - run
+    occasionally to repair drift. Ends with a full sweep, which also rebuilds any
+    slot_free_at map that drifted and catches vehicles the index queries missed.
+    """
+    print(f"🧮 Reconciling station counters at: {datetime.now()}")
+    try:
+        with app.app_context():
+            stations = list(get_storage().stream_stations())
+            _, failed = sweep_stations("reconcile", reconcile_station_counters, stations, now_minutes())
+            pruned, errors = sweep_stations("tombstones", prune_station_tombstones, stations, now_minutes())
+            failed += errors
+            print(f"🪦 Pruned {sum(pruned.values())} tombstones")
+            if failed:
+                raise RuntimeError(f"{failed} station(s) could not be reconciled, see the log above")
+            print("✅ Station counters reconciled")
+        run_scheduled_tasks(full=True)
+    except Exception as e:
+        print(f"❌ Error reconciling counters: {e}")
+        logging.error(f"Reconcile error: {e}", exc_info=True)
+        raise
+
+class SchedulerLock:
+    """
+    Decides which process runs the jobs. A file lock keeps out other processes on
+    the same host (e.g. the other gunicorn workers) and a lease in storage keeps
+    out other hosts, including the old instance during a deploy.
+    """
+
+    def __init__(self, name="scheduler", ttl_seconds=SCHEDULER_LEASE_SECONDS, lock_file=SCHEDULER_LOCK_FILE):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.lock_file = lock_file
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._file = None
+
+    def acquire(self):
+        """Take or renew the lock. Returns False if another process holds it."""
+        if fcntl is not None and self._file is None:
+            lock_file = open(self.lock_file, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._file = lock_file
+        return get_storage().acquire_lease(self.name, self.holder, self.ttl_seconds)
+
+    def release(self):
+        get_storage().release_lease(self.name, self.holder)
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class JobMetrics:
+    """Run counts and durations of the scheduler jobs run by this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs = {}
+
+    def _job(self, name):
+        return self.jobs.setdefault(name, {
+            "runs": 0, "failures": 0, "skipped": 0,
+            "last_run_at": None, "last_duration_s": None, "max_duration_s": 0.0, "total_duration_s": 0.0,
+            "last_error": None
+        })
+
+    def record_run(self, name, started_at, duration, error=None):
+        with self._lock:
+            job = self._job(name)
+            job["runs"] += 1
+            job["last_run_at"] = started_at
+            job["last_duration_s"] = round(duration, 3)
+            job["max_duration_s"] = round(max(job["max_duration_s"], duration), 3)
+            job["total_duration_s"] = round(job["total_duration_s"] + duration, 3)
+            if error is not None:
+                job["failures"] += 1
+                job["last_error"] = str(error)
+            return dict(job)
+
+    def record_skip(self, name):
+        with self._lock:
+            self._job(name)["skipped"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(job) for name, job in self.jobs.items()}
+
+
+metrics = JobMetrics()
+_lock = SchedulerLock()
+
+def _renew_lease(stop):
+    """
+    Renew the scheduler lease until ``stop`` is set. Renewed three times per TTL, so
+    a failed round-trip is retried; once another process holds the lease, or it has
+    gone unrenewed for a whole TTL, the running job is told to stop.
+    """
+    renewed_at = time.monotonic()
+    while not stop.wait(_lock.ttl_seconds / 3):
+        try:
+            if _lock.acquire():
+                renewed_at = time.monotonic()
+                continue
+            logging.error("Scheduler lease taken over by another process while a job was running")
+        except Exception as e:
+            if time.monotonic() - renewed_at < _lock.ttl_seconds:
+                logging.warning(f"Could not renew the scheduler lease, retrying: {e}")
+                continue
+            logging.error(f"Scheduler lease expired while a job was running: {e}", exc_info=True)
+        _lease_lost.set()
+        return
+
+def run_job(name, task):
+    """
+    Run one scheduler job if this process holds the scheduler lock, timing it.
+    The lease is renewed for as long as the job runs; if that fails the job is
+    stopped between stations (see ``check_lease``).
+    Failures are recorded and logged but not raised, so the schedule keeps going.
+    """
+    if not _lock.acquire():
+        print(f"⏸️  {name}: another process holds the scheduler lock, skipping")
+        metrics.record_skip(name)
+        return
+    started_at = datetime.now(timezone.utc)
+    started = time.perf_counter()
+    error = None
+    _lease_lost.clear()
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_renew_lease, args=(stop,), name="scheduler-lease", daemon=True)
+    heartbeat.start()
+    try:
+        task()
+    except Exception as e:
+        error = e
+    finally:
+        stop.set()
+        heartbeat.join()
+    duration = time.perf_counter() - started
+    stats = metrics.record_run(name, started_at, duration, error)
+    print(f"📊 {name}: took {duration:.2f}s; {stats['runs']} runs, {stats['failures']} failed, "
+          f"max {stats['max_duration_s']:.2f}s, {stats['skipped']} skipped")
+    try:
+        get_storage().save_job_stats(name, dict(stats, holder=_lock.holder))
+    except Exception as e:
+        logging.error(f"Could not save stats of scheduler job '{name}': {e}", exc_info=True)
+
+def _on_job_skipped(event):
+    # The previous run is still going (or the process was busy); coalesced runs are not queued up
+    metrics.record_skip(event.job_id)
+
+def create_scheduler(background=False):
+    """
+    Build an APScheduler with the sweep and reconcile jobs. Jobs run one at a time
+    on a single thread, never overlap with themselves, and missed runs are
+    coalesced into one.
+    """
+    from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+    from apscheduler.executors.pool import ThreadPoolExecutor as JobExecutor
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from apscheduler.schedulers.blocking import BlockingScheduler
+
+    scheduler_class = BackgroundScheduler if background else BlockingScheduler
+    scheduler = scheduler_class(
+        executors={"default": JobExecutor(1)},
+        job_defaults={"max_instances": 1, "coalesce": True,
+                      "misfire_grace_time": max(SCHEDULER_INTERVAL_SECONDS // 2, 1)}
+    )
+    scheduler.add_listener(_on_job_skipped, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
+    now = datetime.now()
+    scheduler.add_job(run_job, "interval", seconds=SCHEDULER_INTERVAL_SECONDS, id="sweep",
+                      args=("sweep", run_scheduled_tasks), next_run_time=now)
+    scheduler.add_job(run_job, "interval", seconds=RECONCILE_INTERVAL_SECONDS, id="reconcile",
+                      args=("reconcile", run_reconcile))
+    return scheduler
+
+def serve():
+    """Run the jobs on a schedule until interrupted - replaces the per-tick cron processes"""
+    print(f"🕰️  Scheduler serving: sweep every {SCHEDULER_INTERVAL_SECONDS}s, "
+          f"reconcile every {RECONCILE_INTERVAL_SECONDS}s, lock holder {_lock.holder}")
+    scheduler = create_scheduler()
+    try:
+        scheduler.start()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        _lock.release()
+
+def start_background():
+    """Run the jobs on a background thread of the current process (e.g. a web worker)."""
+    scheduler = create_scheduler(background=True)
+    scheduler.start()
+    return scheduler
+
 if __name__ == "__main__":
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
-    
-    run_scheduled_tasks()
+    parser = argparse.ArgumentParser(description="Easy Vahan background jobs")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="recount station counters instead of running the regular jobs")
+    parser.add_argument("--serve", action="store_true",
+                        help="keep running and run the jobs every SCHEDULER_INTERVAL_SECONDS")
+    parser.add_argument("--backfill", action="store_true",
+                        help="read every station's vehicles, backfilling arrival_ts/charging_start_ts/departure_ts "
+                             "and each station's slot_free_at (run once after upgrading, safe to repeat)")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve()
+    elif args.reconcile:
+        run_reconcile()
+    else:
+        run_scheduled_tasks(full=args.backfill)
     print("👋 Scheduler script exiting...")
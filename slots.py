@@ -0,0 +1,444 @@
+"""
+Per-station slot timelines.
+
+A ``SlotTimeline`` keeps the charging interval (start to departure) of every
+vehicle queued on each charging slot in sorted order. A new arrival is placed
+at the earliest start any slot can take it, including gaps between bookings,
+and the wait for a new arrival can be found without rescanning the vehicles
+subcollection. When a vehicle leaves early or is removed, ``reflow`` moves the
+vehicles that have not started yet into the freed time; a vehicle is only ever
+moved to an earlier start, never a later one.
+
+The timeline also remembers when each vehicle stored as WAITING is due to start
+charging, so the vehicles whose live status has already flipped to CHARGING can
+be listed without reading them.
+
+The scheduler sweep turns each station's timeline into a ``wait_forecast``: the
+projected wait for arrivals every few minutes over the next hours, stored on
+the station so pages can show "wait if you arrive at T" without a timeline.
+
+Timelines are cached per worker in a ``TimelineCache`` keyed by the station's
+``vehicles_version``. A cached timeline is only used while the version stored on
+the station document still matches; any write made elsewhere bumps the version
+and forces a rebuild from storage.
+
+All times are epoch minutes (see ``timeutil``).
+"""
+import logging
+import os
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+from timeutil import format_minutes, to_local, to_minutes, to_timestamp, vehicle_minutes
+
+logger = logging.getLogger(__name__)
+
+# Sorts after every vehicle id, so (time, _LAST_ID) bounds all entries at ``time``
+_LAST_ID = chr(0x10FFFF)
+
+# A slot is free again this many minutes after a vehicle departs
+SLOT_BUFFER_MINUTES = 1
+
+# The wait forecast gives the projected wait for arrivals every WAIT_FORECAST_STEP_MINUTES
+# over the next WAIT_FORECAST_HOURS, planning each as a charge of WAIT_FORECAST_CHARGE_MINUTES
+WAIT_FORECAST_STEP_MINUTES = int(os.environ.get("WAIT_FORECAST_STEP_MINUTES", 5))
+WAIT_FORECAST_HOURS = float(os.environ.get("WAIT_FORECAST_HOURS", 3))
+WAIT_FORECAST_CHARGE_MINUTES = int(os.environ.get("WAIT_FORECAST_CHARGE_MINUTES", 30))
+# An unchanged station's forecast is recomputed once it is this old, so it always reaches far enough ahead
+WAIT_FORECAST_REFRESH_MINUTES = int(os.environ.get("WAIT_FORECAST_REFRESH_MINUTES", 30))
+
+
+class SlotTimeline:
+    """Sorted charging intervals per slot for one station."""
+
+    def __init__(self, total_slots, version=0):
+        self.total_slots = int(total_slots or 0)
+        self.version = version
+        self._lock = threading.Lock()
+        self._departures = {}  # slot -> sorted list of (departure, vehicle_id)
+        self._intervals = {}   # slot -> sorted list of (start, departure, vehicle_id)
+        self._pending = []     # sorted (charging start, vehicle_id) of vehicles stored as WAITING
+        self._vehicles = {}    # vehicle_id -> (slot, start, departure, arrival, waiting)
+
+    def __len__(self):
+        return len(self._vehicles)
+
+    def copy(self):
+        """An independent timeline with the same vehicles, e.g. to plan a change before committing it."""
+        with self._lock:
+            clone = SlotTimeline(self.total_slots, self.version)
+            clone._departures = {slot: list(entries) for slot, entries in self._departures.items()}
+            clone._intervals = {slot: list(entries) for slot, entries in self._intervals.items()}
+            clone._pending = list(self._pending)
+            clone._vehicles = dict(self._vehicles)
+            return clone
+
+    def add(self, vehicle_id, slot, start, departure, waiting=False, arrival=None):
+        """
+        Track a vehicle charging on ``slot`` from ``start`` to ``departure``. Pass
+        ``waiting`` while the vehicle is stored as WAITING. ``arrival`` (default
+        ``start``) is the earliest start a reflow may move the vehicle to.
+        """
+        with self._lock:
+            self._discard(vehicle_id)
+            self._insert(vehicle_id, slot, start, departure, start if arrival is None else arrival, waiting)
+
+    def remove(self, vehicle_id):
+        with self._lock:
+            self._discard(vehicle_id)
+
+    def remove_many(self, vehicle_ids):
+        with self._lock:
+            for vehicle_id in vehicle_ids:
+                self._discard(vehicle_id)
+
+    def _insert(self, vehicle_id, slot, start, departure, arrival, waiting):
+        insort(self._departures.setdefault(slot, []), (departure, vehicle_id))
+        insort(self._intervals.setdefault(slot, []), (start, departure, vehicle_id))
+        if waiting:
+            insort(self._pending, (start, vehicle_id))
+        self._vehicles[vehicle_id] = (slot, start, departure, arrival, waiting)
+
+    def _discard(self, vehicle_id):
+        entry = self._vehicles.pop(vehicle_id, None)
+        if entry is None:
+            return
+        slot, start, departure, _, waiting = entry
+        _remove_sorted(self._departures[slot], (departure, vehicle_id))
+        _remove_sorted(self._intervals[slot], (start, departure, vehicle_id))
+        if waiting:
+            _remove_sorted(self._pending, (start, vehicle_id))
+
+    def mark_charging(self, vehicle_ids):
+        """Forget the pending start of vehicles whose CHARGING status has been stored."""
+        with self._lock:
+            for vehicle_id in vehicle_ids:
+                entry = self._vehicles.get(vehicle_id)
+                if entry is not None and entry[4]:
+                    _remove_sorted(self._pending, (entry[1], vehicle_id))
+                    self._vehicles[vehicle_id] = entry[:4] + (False,)
+
+    def promoted_by(self, now):
+        """Ids of vehicles stored as WAITING whose charging start time has passed."""
+        with self._lock:
+            cut = bisect_right(self._pending, (now, _LAST_ID))
+            return [vehicle_id for _, vehicle_id in self._pending[:cut]]
+
+    def slot_free_at(self, slot):
+        """Latest departure on ``slot``, or None if nothing is queued on it."""
+        departures = self._departures.get(slot)
+        return departures[-1][0] if departures else None
+
+    def next_free_at(self, now):
+        """Earliest time from ``now`` on at which any slot is free."""
+        with self._lock:
+            free_times = [self.slot_free_at(slot) for slot in range(1, self.total_slots + 1)]
+        return min((now if free_at is None else max(free_at, now) for free_at in free_times), default=now)
+
+    def _earliest_start(self, slot, earliest, duration):
+        """Earliest start from ``earliest`` on at which ``slot`` is free for ``duration`` minutes."""
+        start = earliest
+        for booked_start, booked_departure, _ in self._intervals.get(slot, ()):
+            if booked_departure + SLOT_BUFFER_MINUTES <= start:
+                continue
+            if start + duration + SLOT_BUFFER_MINUTES <= booked_start:
+                break
+            start = booked_departure + SLOT_BUFFER_MINUTES
+        return start
+
+    def _place(self, arrival, duration):
+        options = [(self._earliest_start(slot, arrival, duration), slot) for slot in range(1, self.total_slots + 1)]
+        start, slot = min(options, default=(arrival, 1))
+        return slot, start
+
+    def place(self, arrival, duration, now=None):
+        """
+        Return ``(slot, start)`` for a vehicle arriving at ``arrival`` that charges
+        for ``duration`` minutes: the earliest start on any slot, either after the
+        slot's last booking or in a gap between two bookings that is long enough.
+        With ``now`` the start is never in the past, even for an arrival that is.
+        """
+        with self._lock:
+            return self._place(arrival if now is None else max(arrival, now), duration)
+
+    def reflow(self, now, after=None):
+        """
+        Move vehicles that have not started by ``now`` to the earliest start their
+        arrival allows, in order of their current start, so time freed by vehicles
+        that left early is used. Only vehicles starting after ``after`` (e.g. the
+        start of the vehicle that left) can gain, so only those are looked at.
+        A vehicle is never moved later and keeps its charging duration.
+        Returns:
+            dict: ``{vehicle_id: (slot, start, departure, arrival)}`` of the vehicles moved
+        """
+        moves = {}
+        threshold = now if after is None else max(now, after)
+        with self._lock:
+            queued = sorted((entry[1], vehicle_id) for vehicle_id, entry in self._vehicles.items()
+                            if entry[1] > threshold)
+            for start, vehicle_id in queued:
+                slot, _, departure, arrival, waiting = self._vehicles[vehicle_id]
+                duration = departure - start
+                self._discard(vehicle_id)
+                # A vehicle moved up still gets the slot's buffer to get to the charger
+                new_slot, new_start = self._place(max(arrival, now + SLOT_BUFFER_MINUTES), duration)
+                if new_start >= start:
+                    new_slot, new_start = slot, start
+                self._insert(vehicle_id, new_slot, new_start, new_start + duration, arrival, waiting)
+                if new_start != start:
+                    moves[vehicle_id] = (new_slot, new_start, new_start + duration, arrival)
+        return moves
+
+    def apply(self, moves):
+        """Apply moves returned by ``reflow`` on a copy of this timeline."""
+        with self._lock:
+            for vehicle_id, (slot, start, departure, arrival) in moves.items():
+                entry = self._vehicles.get(vehicle_id)
+                if entry is not None:
+                    self._discard(vehicle_id)
+                    self._insert(vehicle_id, slot, start, departure, arrival, entry[4])
+
+
+def slot_free_at_map(timeline):
+    """The ``slot_free_at`` station field for a timeline: latest departure per slot."""
+    free_at = {}
+    for slot in range(1, timeline.total_slots + 1):
+        departure = timeline.slot_free_at(slot)
+        if departure is not None:
+            free_at[str(slot)] = to_timestamp(departure)
+    return free_at
+
+
+def wait_from_slot_free_at(slot_free_at, total_slots, now):
+    """
+    Minutes until the first slot is free, from the station's ``slot_free_at`` map.
+    Matches ``SlotTimeline.next_free_at`` without needing the vehicles.
+    """
+    free_times = []
+    for slot in range(1, int(total_slots or 0) + 1):
+        departure = slot_free_at.get(str(slot))
+        free_times.append(max(to_minutes(departure), now) if departure is not None else now)
+    return min(free_times, default=now) - now
+
+
+def timeline_from_slot_free_at(slot_free_at, total_slots, version, now):
+    """
+    A timeline with each slot busy until its departure in the station's
+    ``slot_free_at`` map, for a wait forecast without reading the vehicles. Gaps
+    between bookings are not known, so arrivals are placed after each slot's last
+    vehicle, as in ``wait_from_slot_free_at``.
+    """
+    timeline = SlotTimeline(total_slots, version)
+    for slot in range(1, timeline.total_slots + 1):
+        departure = slot_free_at.get(str(slot))
+        if departure is not None and to_minutes(departure) > now:
+            timeline.add(f"slot-{slot}", slot, now, to_minutes(departure))
+    return timeline
+
+
+def wait_forecast(timeline, now, step=WAIT_FORECAST_STEP_MINUTES, hours=WAIT_FORECAST_HOURS,
+                  duration=WAIT_FORECAST_CHARGE_MINUTES):
+    """
+    The station's ``wait_forecast`` field: the wait of a vehicle arriving at
+    every ``step`` minutes of the clock for the next ``hours``, placed like a new
+    arrival (see ``SlotTimeline.place``). Stored as one list of minutes with the
+    curve's start (epoch minutes), step and the timeline version it was computed at.
+    """
+    start = now - now % step
+    arrivals = range(start, now + int(hours * 60) + 1, step)
+    return {
+        "start": start,
+        "step": step,
+        "version": timeline.version,
+        "waits": [timeline.place(arrival, duration, now)[1] - arrival for arrival in arrivals]
+    }
+
+
+def forecast_is_current(forecast, version, now, refresh_minutes=WAIT_FORECAST_REFRESH_MINUTES):
+    """Whether a stored forecast was computed at ``version`` less than ``refresh_minutes`` ago."""
+    return bool(forecast) and forecast.get("version") == version and now - forecast["start"] < refresh_minutes
+
+
+def forecast_wait(forecast, arrival):
+    """
+    Projected wait for an arrival at ``arrival`` from a stored forecast, or None
+    if the curve does not cover it. Between two points the wait is exact while
+    the arrival is no later than the start found for the earlier point. After
+    it, the driver is taken to wait for the later point's start, or not at all
+    if the later point has no wait.
+    """
+    if not forecast:
+        return None
+    start, step, waits = forecast["start"], forecast["step"], forecast["waits"]
+    index = (arrival - start) // step
+    if arrival < start or index >= len(waits):
+        return None
+    charging_start = start + index * step + waits[index]
+    if arrival <= charging_start:
+        return charging_start - arrival
+    if index + 1 < len(waits):
+        return start + (index + 1) * step + waits[index + 1] - arrival if waits[index + 1] else 0
+    return None
+
+
+def forecast_points(forecast, now, every=None):
+    """
+    ``(arrival, wait)`` pairs of a stored forecast from ``now`` on, optionally
+    only those on the quarter, half or full hour of station time (``every`` 15, 30 or 60).
+    """
+    if not forecast:
+        return []
+    start, step = forecast["start"], forecast["step"]
+    points = [(start + index * step, wait) for index, wait in enumerate(forecast["waits"])
+              if start + index * step >= now]
+    if every:
+        points = [(arrival, wait) for arrival, wait in points if to_local(arrival).minute % every == 0]
+    return points
+
+
+def _remove_sorted(entries, entry):
+    index = bisect_left(entries, entry)
+    if index < len(entries) and entries[index] == entry:
+        del entries[index]
+
+
+def build_timeline(vehicles, total_slots, version=0):
+    """Build a timeline from vehicle dicts as stored in the vehicles subcollection."""
+    timeline = SlotTimeline(total_slots, version)
+    for v in vehicles:
+        try:
+            departure = vehicle_minutes(v, 'departure')
+            if departure is None:
+                continue
+            start = vehicle_minutes(v, 'charging_start')
+            arrival = vehicle_minutes(v, 'arrival')
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Error parsing departure_time for vehicle {v.get('vehicle_number','?')}: {e}")
+            continue
+        waiting = start is not None and v.get('status', 'WAITING').upper() == 'WAITING'
+        start = departure if start is None else start
+        slot = v.get('slot_number') or v.get('slot') or 1
+        timeline.add(v['id'], int(slot), start, departure, waiting, start if arrival is None else min(arrival, start))
+    return timeline
+
+
+def listed_at_version(vehicles, version):
+    """
+    Whether vehicles listed at the same time as the station document was read
+    show the station at ``version``: a vehicle carries that version's stamp and
+    none carries a later one. Vehicles removed after ``version`` may be missing,
+    which is harmless: a commit expecting ``version`` is refused in that case.
+    """
+    return max((v.get('version') or 0 for v in vehicles), default=0) == version
+
+
+def build_queue_view(vehicles, station_data, now):
+    """
+    Prepare a station's vehicles for display in a single pass.
+
+    Vehicles are ordered by arrival and their times formatted for display.
+    WAITING vehicles whose charging start time has passed are shown as CHARGING;
+    the change is derived here and not written back.
+    Args:
+        vehicles (list): vehicle dicts as stored
+        station_data (dict): the station document
+        now (int): current time in epoch minutes
+    Returns:
+        tuple: (vehicles, slot_free_time, available_slots, timeline) where the
+        timeline holds the departures seen, ready to seed the timeline cache
+    """
+    configured_slots = station_data.get('totalSlots') or station_data.get('total_slots')
+    total_slots = int(configured_slots or 2)
+    timeline = SlotTimeline(station_data.get('total_slots', 0), station_data.get('vehicles_version', 0))
+    slot_last_end = {}
+    charging_count = 0
+    view = []
+
+    for vehicle_data in vehicles:
+        # Ensure all required fields exist with defaults
+        vehicle_data['status'] = vehicle_data.get('status', 'WAITING').upper()
+        try:
+            arrival = vehicle_minutes(vehicle_data, 'arrival')
+            if arrival is None:
+                continue
+            start = vehicle_minutes(vehicle_data, 'charging_start')
+            departure = vehicle_minutes(vehicle_data, 'departure')
+            if start is not None and departure is None:
+                # Calculate departure_time if missing
+                departure = start + int(vehicle_data.get('charging_time_minutes', 0))
+        except Exception as e:
+            logger.warning(f"Error processing vehicle {vehicle_data.get('id')}: {e}")
+            continue
+
+        vehicle_data['arrival_time'] = format_minutes(arrival)
+        vehicle_data['charging_start_time'] = format_minutes(start) if start is not None else None
+        vehicle_data['departure_time'] = format_minutes(departure) if departure is not None else None
+        pending_start = None
+        # Derive the live status from the current time
+        if start is not None and vehicle_data['status'] == 'WAITING':
+            pending_start = start
+            if now >= start:
+                vehicle_data['status'] = 'CHARGING'
+                vehicle_data['wait_time_minutes'] = 0
+
+        view.append((arrival, vehicle_data))
+        if vehicle_data['status'] == 'CHARGING':
+            charging_count += 1
+        if start is not None:
+            slot = int(vehicle_data.get('slot_number') or vehicle_data.get('slot') or 1)
+            timeline.add(vehicle_data['id'], slot, start, departure, pending_start is not None, min(arrival, start))
+            if 1 <= slot <= total_slots:
+                slot_last_end[slot] = max(slot_last_end.get(slot, departure), departure)
+
+    # Slots free up 1 minute after their last vehicle leaves
+    slot_free_time = {}
+    for slot in range(1, total_slots + 1):
+        if slot in slot_last_end:
+            slot_free_time[slot] = format_minutes(slot_last_end[slot] + 1)
+        else:
+            slot_free_time[slot] = format_minutes(now)
+
+    view.sort(key=lambda entry: entry[0])
+    available_slots = max(int(configured_slots) - charging_count, 0) if configured_slots else 0
+    return [vehicle_data for _, vehicle_data in view], slot_free_time, available_slots, timeline
+
+
+class TimelineCache:
+    """Slot timelines of recently used stations, validated by ``vehicles_version``."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timelines = {}
+
+    def __contains__(self, station_id):
+        with self._lock:
+            return station_id in self._timelines
+
+    def get(self, station_id, version, total_slots):
+        """Return the cached timeline if it is still current, else None."""
+        with self._lock:
+            timeline = self._timelines.get(station_id)
+        if timeline is None or timeline.version != version or timeline.total_slots != int(total_slots or 0):
+            return None
+        return timeline
+
+    def put(self, station_id, timeline):
+        with self._lock:
+            self._timelines[station_id] = timeline
+
+    def advance(self, station_id, from_version, to_version, change=None):
+        """
+        Record a write this process made, moving the station from ``from_version``
+        to ``to_version``. ``change`` is called with the timeline to apply it.
+        If any other write happened in between, the cached timeline is dropped.
+        """
+        with self._lock:
+            timeline = self._timelines.get(station_id)
+            if timeline is None:
+                return
+            if timeline.version != from_version or to_version != from_version + 1:
+                del self._timelines[station_id]
+                return
+            if change is not None:
+                change(timeline)
+            timeline.version = to_version
@@ -0,0 +1,1215 @@
+"""
+Storage backends for charging stations, their vehicles and reset OTPs.
+
+Routes and scheduler jobs talk to a ``Storage`` object instead of the Firestore
+client directly, so the same code can run against Firestore in production or
+against an in-process store for local load testing. The backend is chosen with
+the ``STORAGE_BACKEND`` environment variable (``firestore`` or ``memory``) and
+created on first use by ``get_storage``.
+
+Vehicle writes go through ``commit_vehicle_changes``, which applies them
+atomically and bumps the station's ``vehicles_version``. Each written vehicle is
+stamped with that version, so readers can tell whether anything changed since
+they last looked. Removed vehicles leave a tombstone carrying the version of the
+removal and the vehicle's data until ``prune_tombstones`` forgets it, moving the
+data to the session archive (see ``archive``); the station's ``tombstone_floor``
+records the newest version that may have been forgotten. The same commit adds
+the added and removed sessions to the station's hourly rollups (see
+``rollups``), which ``list_rollups`` reads back for reports. The station's
+``last_change`` field summarises the latest commit (which ids were added,
+updated and removed) so watchers of the station document can tell what happened.
+
+The same commit keeps the station's counters in step: ``vehicle_count``,
+``charging_count``, ``waiting_count`` and ``slot_occupancy`` (vehicles per slot
+number). They reflect stored statuses and are computed from the documents read
+inside the transaction; ``reconcile_counters`` recounts them from scratch.
+
+Vehicles store their times only as timezone-aware UTC timestamps
+(``arrival_ts``, ``charging_start_ts``, ``departure_ts``); display strings are
+derived when read (see ``timeutil``). The scheduler finds the vehicles that are
+due with range queries on them instead of reading every station.
+Once a station has a ``slot_free_at`` map (latest ``departure_ts`` per slot) the
+commit keeps it current too, which lets the wait time be recomputed without
+reading any vehicles. The sweep rebuilds the map whenever it has been dropped.
+
+A commit can be made conditional on the station's ``vehicles_version`` with
+``expected_version``: if another write landed since the caller read the station,
+``VersionConflict`` is raised and nothing is written. Requests that plan a
+change from what they read (e.g. picking a slot) use this to never act on a
+stale schedule.
+
+The scheduler also stores a snapshot of every station's position, charger type,
+wait time and wait forecast (``save_station_index``), which web workers load to
+answer nearby-station searches without reading the stations collection. In
+Firestore it is split over documents of ``STATION_INDEX_SHARD_SIZE`` stations.
+
+Scheduler leases make sure only one process runs the background jobs at a
+time: a lease is held until it expires unless its holder renews it.
+
+Station documents are cached per process for ``STATION_CACHE_TTL_SECONDS`` by
+``get_storage().get_station``; every write this process makes to a station drops
+its entry, so only writes made elsewhere can be seen late, by at most the TTL.
+
+``gather`` runs independent backend calls of one request at once on a shared
+thread pool, so the request waits for the slowest round-trip instead of all
+of them in turn.
+
+Every backend call is counted and timed by kind (``read``, ``write``,
+``stream``) along with the number of documents read, both per process and per
+request. Station reads answered from the cache are counted as ``cache_hit``.
+"""
+import contextvars
+import copy
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from archive import build_segments
+from rollups import rollup_deltas, rollup_id
+from timeutil import to_minutes
+
+logger = logging.getLogger(__name__)
+
+# Most writes Firestore accepts in one batch or transaction
+MAX_BATCH_OPS = 500
+
+# Entries per document of the nearby-station index: a Firestore document holds at most 1 MiB
+# and an entry with its wait forecast takes about 450 bytes
+STATION_INDEX_SHARD_SIZE = 1000
+
+# Station documents are cached per process for this long (0 disables the cache) ...
+STATION_CACHE_TTL_SECONDS = float(os.environ.get("STATION_CACHE_TTL_SECONDS", 5))
+# ... for at most this many stations, least recently used first out
+STATION_CACHE_SIZE = int(os.environ.get("STATION_CACHE_SIZE", 1024))
+
+# Threads per process that run the independent backend calls of a request at once (0: one after another)
+STORAGE_FANOUT_WORKERS = int(os.environ.get("STORAGE_FANOUT_WORKERS", 8))
+
+# Counter for the request currently being served (None outside a request)
+_request_ops = ContextVar("storage_request_ops", default=None)
+
+
+# When the backend call being made started, or when its previous round-trip ended
+_round_trip_mark = ContextVar("storage_round_trip_mark", default=None)
+
+
+def _timed(method):
+    """Time the round-trips a backend method records, each from the end of the one before."""
+    @wraps(method)
+    def timed(self, *args, **kwargs):
+        if _round_trip_mark.get() is not None:
+            # Called from another backend method, which is timing already
+            return method(self, *args, **kwargs)
+        token = _round_trip_mark.set(time.perf_counter())
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _round_trip_mark.reset(token)
+    return timed
+
+
+def begin_op_tracking():
+    """
+    Start counting backend operations for the current request: calls and seconds
+    spent per kind (e.g. ``read`` and ``read_seconds``) and ``docs_read``.
+    """
+    ops = Counter()
+    _request_ops.set(ops)
+    return ops
+
+
+def end_op_tracking():
+    """Stop counting and return the operations made by the current request."""
+    ops = _request_ops.get()
+    _request_ops.set(None)
+    return ops or Counter()
+
+
+class Increment:
+    """Field value that adds ``amount`` to the stored number."""
+
+    def __init__(self, amount):
+        self.amount = amount
+
+
+class _DeleteField:
+    """Field value that removes the field from the document."""
+
+
+DELETE_FIELD = _DeleteField()
+
+
+class CommitTooLarge(Exception):
+    """A vehicle commit, with the hourly rollups it updates, needs more than MAX_BATCH_OPS writes."""
+
+    def __init__(self, station_id, writes):
+        super().__init__(f"Commit to station '{station_id}' needs {writes} writes, at most {MAX_BATCH_OPS} fit")
+        self.station_id = station_id
+        self.writes = writes
+
+
+class VersionConflict(Exception):
+    """The station's ``vehicles_version`` was not the ``expected_version`` of a commit."""
+
+    def __init__(self, station_id, expected, actual):
+        super().__init__(f"Station '{station_id}' is at version {actual}, expected {expected}")
+        self.station_id = station_id
+        self.expected = expected
+        self.actual = actual
+
+
+class StationCache:
+    """
+    LRU cache of station documents with a time to live. Entries are copied in and
+    out so callers may modify what they get. ``invalidate`` bumps a per-station
+    generation, so a read that started before a write cannot store what it read.
+    """
+
+    def __init__(self, ttl_seconds=STATION_CACHE_TTL_SECONDS, max_entries=STATION_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # station_id -> (expires_at, data)
+        self._generations = Counter()
+        self.stats = Counter()
+
+    def get(self, station_id):
+        with self._lock:
+            entry = self._entries.get(station_id)
+            if entry is None or entry[0] <= time.monotonic():
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(station_id)
+            self.stats["hits"] += 1
+            data = entry[1]
+        return copy.deepcopy(data)
+
+    def generation(self, station_id):
+        with self._lock:
+            return self._generations[station_id]
+
+    def put(self, station_id, data, generation):
+        """Cache ``data`` read while the station was at ``generation``; ignored if written since."""
+        if data is None or self.ttl_seconds <= 0:
+            return
+        data = copy.deepcopy(data)
+        with self._lock:
+            if self._generations[station_id] != generation:
+                return
+            self._entries[station_id] = (time.monotonic() + self.ttl_seconds, data)
+            self._entries.move_to_end(station_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, *station_ids):
+        with self._lock:
+            for station_id in station_ids:
+                self._generations[station_id] += 1
+                if self._entries.pop(station_id, None) is not None:
+                    self.stats["invalidations"] += 1
+
+    def snapshot(self):
+        """Hit, miss, invalidation and eviction counts and the current size."""
+        with self._lock:
+            return dict(self.stats, size=len(self._entries))
+
+
+def vehicle_counters(vehicles):
+    """Station counters for a complete list of vehicle dicts."""
+    counters = {"vehicle_count": 0, "charging_count": 0, "waiting_count": 0, "slot_occupancy": {}}
+    for vehicle in vehicles:
+        _count_vehicle(counters, vehicle, 1)
+    return counters
+
+
+def _station_counters(station):
+    counters = vehicle_counters(())
+    for field in ("vehicle_count", "charging_count", "waiting_count"):
+        counters[field] = station.get(field) or 0
+    counters["slot_occupancy"] = dict(station.get("slot_occupancy") or {})
+    return counters
+
+
+def _count_vehicle(counters, vehicle, sign):
+    counters["vehicle_count"] += sign
+    status = (vehicle.get("status") or "WAITING").upper()
+    if status == "CHARGING":
+        counters["charging_count"] += sign
+    elif status == "WAITING":
+        counters["waiting_count"] += sign
+    slot = str(vehicle.get("slot_number") or vehicle.get("slot") or 1)
+    occupancy = counters["slot_occupancy"]
+    occupancy[slot] = occupancy.get(slot, 0) + sign
+    if occupancy[slot] == 0:
+        del occupancy[slot]
+
+
+def _updated_counters(station, previous, added, updated, removed):
+    """
+    Station counters after a commit. ``previous`` maps the ids of updated and
+    removed vehicles to their stored data (missing if they no longer exist).
+    """
+    counters = _station_counters(station)
+    for data in (added or {}).values():
+        _count_vehicle(counters, data, 1)
+    for vehicle_id, fields in (updated or {}).items():
+        if vehicle_id in previous:
+            _count_vehicle(counters, previous[vehicle_id], -1)
+            _count_vehicle(counters, dict(previous[vehicle_id], **fields), 1)
+    for vehicle_id in removed:
+        if vehicle_id in previous:
+            _count_vehicle(counters, previous[vehicle_id], -1)
+    return counters
+
+
+def _updated_slot_free_at(station, previous, added, updated, removed, now):
+    """
+    The station's ``slot_free_at`` map after a commit, as fields to write. Stations
+    without the map are left alone. If a slot's last vehicle leaves before its
+    departure, or a vehicle without ``departure_ts`` joins, the next departure on
+    the slot is unknown here, so the map is dropped for the sweep to rebuild.
+    """
+    free_at = station.get("slot_free_at")
+    if free_at is None:
+        return {}
+    free_at = dict(free_at)
+    changes = [(previous.get(vehicle_id), None) for vehicle_id in removed]
+    changes += [(previous.get(vehicle_id), dict(previous[vehicle_id], **fields))
+                for vehicle_id, fields in (updated or {}).items()
+                if vehicle_id in previous and ("departure_ts" in fields or "slot_number" in fields)]
+    changes += [(None, data) for data in (added or {}).values()]
+    for before, after in changes:
+        if before and before.get("departure_ts") is not None and before["departure_ts"] > now:
+            slot = str(before.get("slot_number") or before.get("slot") or 1)
+            if slot not in free_at or before["departure_ts"] >= free_at[slot]:
+                return {"slot_free_at": DELETE_FIELD}
+        if after is not None:
+            if after.get("departure_ts") is None:
+                return {"slot_free_at": DELETE_FIELD}
+            slot = str(after.get("slot_number") or after.get("slot") or 1)
+            if slot not in free_at or after["departure_ts"] > free_at[slot]:
+                free_at[slot] = after["departure_ts"]
+    return {"slot_free_at": free_at}
+
+
+def _rollup_docs(station_id, previous, added, removed, now):
+    """``{rollup_id: fields}`` incrementing the station's hourly rollups for a commit made at ``now``."""
+    return {rollup_id(station_id, hour): dict({field: Increment(amount) for field, amount in fields.items()},
+                                              station_id=station_id, hour=hour)
+            for hour, fields in rollup_deltas(added, previous, removed, to_minutes(now)).items()}
+
+
+def _check_commit_size(station_id, added, updated, removed, rollup_docs):
+    # The station, every vehicle written or deleted, a tombstone per removal and the rollups
+    writes = 1 + len(added or {}) + len(updated or {}) + 2 * len(removed) + len(rollup_docs)
+    if writes > MAX_BATCH_OPS:
+        raise CommitTooLarge(station_id, writes)
+
+
+def _last_change(version, added, updated, removed):
+    return {
+        "version": version,
+        "added": list(added or ()),
+        "updated": list(updated or ()),
+        "removed": list(removed)
+    }
+
+
+class Storage:
+    """Interface shared by the storage backends."""
+
+    name = "base"
+
+    def __init__(self):
+        self.op_counts = Counter()
+        self.op_seconds = Counter()
+        self._op_lock = threading.Lock()
+        self.station_cache = StationCache()
+
+    def _record(self, kind, docs=0):
+        seconds = 0.0
+        mark = _round_trip_mark.get()
+        if mark is not None:
+            now = time.perf_counter()
+            seconds = now - mark
+            _round_trip_mark.set(now)
+        ops = _request_ops.get()
+        with self._op_lock:
+            self.op_counts[kind] += 1
+            self.op_counts["docs_read"] += docs
+            self.op_seconds[kind] += seconds
+            # Calls of one request may run on several threads (see gather)
+            if ops is not None:
+                ops[kind] += 1
+                ops["docs_read"] += docs
+                ops[f"{kind}_seconds"] += seconds
+
+    # --- stations ---
+    def get_station(self, station_id, cached=True):
+        """
+        Return the station document as a dict, or None if it does not exist.
+        With ``cached`` a copy younger than STATION_CACHE_TTL_SECONDS may be
+        returned; pass ``cached=False`` where a write from another process must
+        be seen at once (e.g. access keys and reset OTPs).
+        """
+        if cached:
+            station = self.station_cache.get(station_id)
+            if station is not None:
+                self._record("cache_hit")
+                return station
+        generation = self.station_cache.generation(station_id)
+        station = self._get_station(station_id)
+        self.station_cache.put(station_id, station, generation)
+        return station
+
+    def _get_station(self, station_id):
+        """Read the station document from the backend."""
+        raise NotImplementedError
+
+    def create_station(self, station_id, data):
+        raise NotImplementedError
+
+    def update_station(self, station_id, updates):
+        """Apply a partial update. Values may be ``Increment`` or ``DELETE_FIELD``."""
+        raise NotImplementedError
+
+    def update_stations(self, updates):
+        """Apply ``{station_id: fields}`` partial updates in batches of at most MAX_BATCH_OPS."""
+        raise NotImplementedError
+
+    def find_station_by_email(self, email):
+        raise NotImplementedError
+
+    def stream_stations(self):
+        """Iterator of ``(station_id, data)`` for every station."""
+        raise NotImplementedError
+
+    # --- vehicles ---
+    def get_vehicle(self, station_id, vehicle_id):
+        raise NotImplementedError
+
+    def list_vehicles(self, station_id):
+        """Return the station's vehicles as dicts with their document ``id``."""
+        raise NotImplementedError
+
+    def new_vehicle_id(self, station_id):
+        """Reserve a document id for a vehicle that is about to be added."""
+        raise NotImplementedError
+
+    def commit_vehicle_changes(self, station_id, added=None, updated=None, removed=(), station_updates=None,
+                               expected_version=None):
+        """
+        Atomically add, update and remove vehicles of one station.
+        Args:
+            added (dict): {vehicle_id: data} for new vehicles
+            updated (dict): {vehicle_id: fields} partial updates
+            removed (iterable): ids of vehicles to delete; ids already gone are skipped, keeping
+                the tombstone of their removal
+            station_updates (dict): fields to update on the station document; a
+                ``slot_free_at`` given here replaces the one the commit would compute
+            expected_version (int): only commit if the station is still at this ``vehicles_version``
+        Returns:
+            int: the station's new ``vehicles_version``
+        Raises:
+            VersionConflict: if ``expected_version`` is given and no longer current
+            CommitTooLarge: if the writes, including the hourly rollups the removals
+                touch, do not fit in one transaction; nothing is written
+        """
+        raise NotImplementedError
+
+    def find_due_vehicles(self, now):
+        """
+        Query vehicles across all stations that need the scheduler's attention:
+        those whose ``departure_ts`` has passed and those stored as WAITING whose
+        ``charging_start_ts`` has passed. Vehicles without the timestamps are not found.
+        Returns:
+            dict: {station_id: (departed_ids, started_ids)}
+        """
+        raise NotImplementedError
+
+    def reconcile_counters(self, station_id):
+        """Recount the station's counters from its vehicles, fixing any drift. Returns the counters."""
+        raise NotImplementedError
+
+    def list_vehicle_changes(self, station_id, since_version):
+        """
+        Return ``(changed, removed)``: the vehicles written after ``since_version``
+        and the ids of the vehicles removed after it.
+        """
+        raise NotImplementedError
+
+    def prune_tombstones(self, station_id, before):
+        """
+        Forget removals recorded before ``before``, archiving the sessions they carry
+        in the same write. Returns how many were pruned.
+        """
+        raise NotImplementedError
+
+    def list_archive_segments(self, first_day, last_day, station_id=None):
+        """Session archive segments of the days ``first_day`` to ``last_day`` (YYYY-MM-DD), both included."""
+        raise NotImplementedError
+
+    def list_rollups(self, station_id, start, end):
+        """The station's hourly rollups of the hours starting in ``[start, end)`` (epoch minutes)."""
+        raise NotImplementedError
+
+    def watch_station(self, station_id, callback):
+        """
+        Call ``callback(data)`` with the station document now and whenever it changes.
+        Returns a function that stops watching.
+        """
+        raise NotImplementedError
+
+    # --- scheduler ---
+    def acquire_lease(self, name, holder, ttl_seconds):
+        """
+        Take or renew the lease ``name`` for ``holder`` for ``ttl_seconds``.
+        Returns False if another holder's lease has not expired yet.
+        """
+        raise NotImplementedError
+
+    def release_lease(self, name, holder):
+        """Give up the lease if ``holder`` still holds it."""
+        raise NotImplementedError
+
+    def save_job_stats(self, job_name, stats):
+        """Store the run-time statistics of a scheduler job for operators to inspect."""
+        raise NotImplementedError
+
+    # --- nearby-station index ---
+    def save_station_index(self, snapshot):
+        """Store the nearby-station index snapshot written by the scheduler sweep (see ``geo``)."""
+        raise NotImplementedError
+
+    def load_station_index(self):
+        """The latest nearby-station index snapshot, or None if none has been stored."""
+        raise NotImplementedError
+
+    # --- reset OTPs ---
+    def set_reset_otp(self, station_id, otp, expiry):
+        self.update_station(station_id, {"reset_otp": otp, "reset_otp_expiry": expiry})
+
+    def complete_access_key_reset(self, station_id, new_access_key):
+        """Store the new access key and clear the pending OTP."""
+        self.update_station(station_id, {
+            "access_key": new_access_key,
+            "reset_otp": DELETE_FIELD,
+            "reset_otp_expiry": DELETE_FIELD
+        })
+
+
+class FirestoreStorage(Storage):
+    """Storage backed by Cloud Firestore."""
+
+    name = "firestore"
+
+    def __init__(self, client=None):
+        super().__init__()
+        from firebase_admin import firestore
+        self._firestore = firestore
+        if client is None:
+            import firebase_admin
+            from firebase_admin import credentials
+            logger.info("Initializing Firebase...")
+            # Use environment variable for credential path in deployment
+            cred = credentials.Certificate(os.environ.get("GOOGLE_APPLICATION_CREDENTIALS"))
+            firebase_admin.initialize_app(cred)
+            client = firestore.client()
+            logger.info("Firebase initialized successfully!")
+        self.db = client
+
+    def _stations(self):
+        return self.db.collection("charging_stations")
+
+    def _vehicles(self, station_id):
+        return self._stations().document(station_id).collection("vehicles")
+
+    def _tombstones(self, station_id):
+        return self._stations().document(station_id).collection("vehicle_tombstones")
+
+    def _convert(self, updates):
+        converted = {}
+        for key, value in updates.items():
+            if isinstance(value, Increment):
+                value = self._firestore.Increment(value.amount)
+            elif value is DELETE_FIELD:
+                value = self._firestore.DELETE_FIELD
+            converted[key] = value
+        return converted
+
+    @_timed
+    def _get_station(self, station_id):
+        doc = self._stations().document(station_id).get()
+        self._record("read", 1 if doc.exists else 0)
+        return doc.to_dict() if doc.exists else None
+
+    @_timed
+    def create_station(self, station_id, data):
+        self._stations().document(station_id).set(data)
+        self.station_cache.invalidate(station_id)
+        self._record("write")
+
+    @_timed
+    def update_station(self, station_id, updates):
+        try:
+            self._stations().document(station_id).update(self._convert(updates))
+        finally:
+            self.station_cache.invalidate(station_id)
+        self._record("write")
+
+    @_timed
+    def update_stations(self, updates):
+        items = list(updates.items())
+        for start in range(0, len(items), MAX_BATCH_OPS):
+            batch = self.db.batch()
+            for station_id, fields in items[start:start + MAX_BATCH_OPS]:
+                batch.update(self._stations().document(station_id), self._convert(fields))
+            batch.commit()
+            self.station_cache.invalidate(*(station_id for station_id, _ in items[start:start + MAX_BATCH_OPS]))
+            self._record("write")
+
+    @_timed
+    def find_station_by_email(self, email):
+        docs = list(self._stations().where("email", "==", email).limit(1).stream())
+        self._record("stream", len(docs))
+        return docs[0].to_dict() if docs else None
+
+    @_timed
+    def stream_stations(self):
+        docs = list(self._stations().stream())
+        self._record("stream", len(docs))
+        return ((doc.id, doc.to_dict()) for doc in docs)
+
+    @_timed
+    def get_vehicle(self, station_id, vehicle_id):
+        doc = self._vehicles(station_id).document(vehicle_id).get()
+        self._record("read", 1 if doc.exists else 0)
+        if not doc.exists:
+            return None
+        vehicle = doc.to_dict()
+        vehicle["id"] = doc.id
+        return vehicle
+
+    @_timed
+    def list_vehicles(self, station_id):
+        vehicles = []
+        for doc in self._vehicles(station_id).stream():
+            vehicle = doc.to_dict()
+            vehicle["id"] = doc.id
+            vehicles.append(vehicle)
+        self._record("stream", len(vehicles))
+        return vehicles
+
+    def new_vehicle_id(self, station_id):
+        return self._vehicles(station_id).document().id
+
+    @_timed
+    def commit_vehicle_changes(self, station_id, added=None, updated=None, removed=(), station_updates=None,
+                               expected_version=None):
+        station_ref = self._stations().document(station_id)
+        vehicles_ref = self._vehicles(station_id)
+        tombstones_ref = self._tombstones(station_id)
+        rollups_ref = self.db.collection("station_rollups")
+        firestore = self._firestore
+        removed_at = datetime.now(timezone.utc)
+        removed = list(removed)
+
+        @firestore.transactional
+        def commit(transaction):
+            snapshot = station_ref.get(transaction=transaction)
+            station = snapshot.to_dict() if snapshot.exists else {}
+            if expected_version is not None and (station.get("vehicles_version") or 0) != expected_version:
+                # Raised inside the transaction, so it is rolled back without writing anything
+                raise VersionConflict(station_id, expected_version, station.get("vehicles_version") or 0)
+            version = (station.get("vehicles_version") or 0) + 1
+            touched = [vehicles_ref.document(vehicle_id) for vehicle_id in list(updated or {}) + removed]
+            previous = {doc.id: doc.to_dict() for doc in transaction.get_all(touched) if doc.exists} if touched else {}
+            # A vehicle removed since the caller looked keeps the tombstone, and session, of that removal
+            present = [vehicle_id for vehicle_id in removed if vehicle_id in previous]
+            rollup_docs = _rollup_docs(station_id, previous, added, present, removed_at)
+            # Raised before the first write, so the transaction is rolled back without writing anything
+            _check_commit_size(station_id, added, updated, present, rollup_docs)
+            for vehicle_id, data in (added or {}).items():
+                transaction.set(vehicles_ref.document(vehicle_id),
+                                dict(data, version=version, timestamp=firestore.SERVER_TIMESTAMP))
+            for vehicle_id, fields in (updated or {}).items():
+                transaction.update(vehicles_ref.document(vehicle_id),
+                                   self._convert(dict(fields, version=version)))
+            for vehicle_id in present:
+                transaction.delete(vehicles_ref.document(vehicle_id))
+                transaction.set(tombstones_ref.document(vehicle_id),
+                                {"version": version, "removed_at": removed_at, "session": previous[vehicle_id]})
+            for doc_id, fields in rollup_docs.items():
+                transaction.set(rollups_ref.document(doc_id), self._convert(fields), merge=True)
+            station_fields = dict(station_updates or {}, vehicles_version=version,
+                                  last_change=_last_change(version, added, updated, present),
+                                  **_updated_counters(station, previous, added, updated, present))
+            if "slot_free_at" not in station_fields:
+                station_fields.update(_updated_slot_free_at(station, previous, added, updated, present, removed_at))
+            transaction.update(station_ref, self._convert(station_fields))
+            return version, len(touched)
+
+        try:
+            version, reads = commit(self.db.transaction())
+        except VersionConflict:
+            self._record("read", 1)
+            raise
+        except CommitTooLarge:
+            self._record("read", 1 + len(updated or {}) + len(removed))
+            raise
+        finally:
+            # Also after a conflict: the cached copy is what the caller planned from, and it is stale
+            self.station_cache.invalidate(station_id)
+        self._record("read", 1 + reads)
+        self._record("write")
+        return version
+
+    @_timed
+    def find_due_vehicles(self, now):
+        # Collection group queries over every station's vehicles; only document names are fetched
+        vehicles = self.db.collection_group("vehicles")
+        departed = list(vehicles.where("departure_ts", "<=", now).select([]).stream())
+        started = list(vehicles.where("status", "==", "WAITING")
+                       .where("charging_start_ts", "<=", now).select([]).stream())
+        self._record("stream", len(departed))
+        self._record("stream", len(started))
+        due = {}
+        for index, docs in enumerate((departed, started)):
+            for doc in docs:
+                due.setdefault(doc.reference.parent.parent.id, ([], []))[index].append(doc.id)
+        return due
+
+    @_timed
+    def reconcile_counters(self, station_id):
+        station_ref = self._stations().document(station_id)
+        vehicles_ref = self._vehicles(station_id)
+
+        @self._firestore.transactional
+        def reconcile(transaction):
+            snapshot = station_ref.get(transaction=transaction)
+            vehicles = [doc.to_dict() for doc in transaction.get(vehicles_ref.order_by("__name__"))]
+            counters = vehicle_counters(vehicles)
+            station = snapshot.to_dict() or {}
+            if any(station.get(field) != value for field, value in counters.items()):
+                transaction.update(station_ref, counters)
+            return counters, len(vehicles)
+
+        counters, count = reconcile(self.db.transaction())
+        self.station_cache.invalidate(station_id)
+        self._record("read", 1)
+        self._record("stream", count)
+        return counters
+
+    @_timed
+    def list_vehicle_changes(self, station_id, since_version):
+        changed = []
+        for doc in self._vehicles(station_id).where("version", ">", since_version).stream():
+            vehicle = doc.to_dict()
+            vehicle["id"] = doc.id
+            changed.append(vehicle)
+        removed = [doc.id for doc in self._tombstones(station_id).where("version", ">", since_version).stream()]
+        self._record("stream", len(changed))
+        self._record("stream", len(removed))
+        return changed, removed
+
+    @_timed
+    def prune_tombstones(self, station_id, before):
+        docs = list(self._tombstones(station_id).where("removed_at", "<", before).order_by("removed_at").stream())
+        self._record("stream", len(docs))
+        archive = self.db.collection("session_archive")
+        # Room in each batch for the station and a few days' segments next to the deletes
+        chunk_size = MAX_BATCH_OPS - 20
+        for start in range(0, len(docs), chunk_size):
+            chunk = docs[start:start + chunk_size]
+            tombstones = {doc.id: doc.to_dict() for doc in chunk}
+            batch = self.db.batch()
+            for segment_id, segment in build_segments(station_id, tombstones).items():
+                batch.set(archive.document(segment_id), segment)
+            for doc in chunk:
+                batch.delete(doc.reference)
+            floor = max(tombstone.get("version", 0) for tombstone in tombstones.values())
+            batch.set(self._stations().document(station_id), {"tombstone_floor": floor}, merge=True)
+            batch.commit()
+            self.station_cache.invalidate(station_id)
+            self._record("write")
+        return len(docs)
+
+    @_timed
+    def list_archive_segments(self, first_day, last_day, station_id=None):
+        # Station queries need a composite index on station_id and day
+        query = self.db.collection("session_archive").where("day", ">=", first_day).where("day", "<=", last_day)
+        if station_id is not None:
+            query = query.where("station_id", "==", station_id)
+        segments = [doc.to_dict() for doc in query.stream()]
+        self._record("stream", len(segments))
+        return segments
+
+    @_timed
+    def list_rollups(self, station_id, start, end):
+        # Needs a composite index on station_id and hour
+        query = (self.db.collection("station_rollups").where("station_id", "==", station_id)
+                 .where("hour", ">=", start).where("hour", "<", end))
+        rollups = [doc.to_dict() for doc in query.stream()]
+        self._record("stream", len(rollups))
+        return rollups
+
+    @_timed
+    def acquire_lease(self, name, holder, ttl_seconds):
+        lease_ref = self.db.collection("scheduler_leases").document(name)
+
+        @self._firestore.transactional
+        def acquire(transaction):
+            snapshot = lease_ref.get(transaction=transaction)
+            lease = snapshot.to_dict() if snapshot.exists else {}
+            now = datetime.now(timezone.utc)
+            if lease.get("holder") not in (None, holder) and lease.get("expires_at") and lease["expires_at"] > now:
+                return False
+            transaction.set(lease_ref, {"holder": holder, "expires_at": now + timedelta(seconds=ttl_seconds)})
+            return True
+
+        acquired = acquire(self.db.transaction())
+        self._record("read", 1)
+        if acquired:
+            self._record("write")
+        return acquired
+
+    @_timed
+    def release_lease(self, name, holder):
+        lease_ref = self.db.collection("scheduler_leases").document(name)
+
+        @self._firestore.transactional
+        def release(transaction):
+            snapshot = lease_ref.get(transaction=transaction)
+            if snapshot.exists and snapshot.to_dict().get("holder") == holder:
+                transaction.delete(lease_ref)
+
+        release(self.db.transaction())
+        self._record("read", 1)
+        self._record("write")
+
+    @_timed
+    def save_job_stats(self, job_name, stats):
+        self.db.collection("scheduler_jobs").document(job_name).set(stats, merge=True)
+        self._record("write")
+
+    @_timed
+    def save_station_index(self, snapshot):
+        # The entries go in shards of STATION_INDEX_SHARD_SIZE, committed in one batch (at most
+        # 10 MiB, so about 20,000 stations) with the "current" document that says how many there are
+        index_ref = self.db.collection("station_index")
+        current = index_ref.document("current").get()
+        previous = (current.to_dict() or {}).get("shards", 0) if current.exists else 0
+        stations = snapshot.get("stations", [])
+        shards = [stations[start:start + STATION_INDEX_SHARD_SIZE]
+                  for start in range(0, len(stations), STATION_INDEX_SHARD_SIZE)]
+        batch = self.db.batch()
+        for number, entries in enumerate(shards):
+            batch.set(index_ref.document(f"shard_{number}"), {"stations": entries})
+        for number in range(len(shards), previous):
+            batch.delete(index_ref.document(f"shard_{number}"))
+        fields = {field: value for field, value in snapshot.items() if field != "stations"}
+        batch.set(index_ref.document("current"), dict(fields, shards=len(shards)))
+        batch.commit()
+        self._record("read", 1)
+        self._record("write")
+
+    @_timed
+    def load_station_index(self):
+        index_ref = self.db.collection("station_index")
+
+        # Read in one transaction, so a snapshot stored meanwhile is never mixed in
+        @self._firestore.transactional
+        def load(transaction):
+            current = index_ref.document("current").get(transaction=transaction)
+            if not current.exists:
+                return None, 1
+            snapshot = current.to_dict()
+            if "shards" not in snapshot:
+                # Stored whole, before the index was split
+                return snapshot, 1
+            shard_refs = [index_ref.document(f"shard_{number}") for number in range(snapshot.pop("shards"))]
+            shards = {doc.id: doc.to_dict() for doc in transaction.get_all(shard_refs) if doc.exists}
+            snapshot["stations"] = [entry for ref in shard_refs for entry in shards.get(ref.id, {}).get("stations", [])]
+            return snapshot, 1 + len(shard_refs)
+
+        snapshot, reads = load(self.db.transaction(read_only=True))
+        self._record("read", reads)
+        return snapshot
+
+    def watch_station(self, station_id, callback):
+        def on_snapshot(docs, changes, read_time):
+            # Watched stations also see writes made by other processes at once
+            self.station_cache.invalidate(station_id)
+            callback(docs[0].to_dict() if docs and docs[0].exists else None)
+
+        watch = self._stations().document(station_id).on_snapshot(on_snapshot)
+        return watch.unsubscribe
+
+
+class MemoryStorage(Storage):
+    """
+    In-process storage with the same semantics as the Firestore backend.
+    Data lives only as long as the process; meant for local runs and benchmarks.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._stations = {}
+        self._vehicles = {}
+        self._tombstones = {}
+        self._watchers = {}
+        self._leases = {}
+        self._job_stats = {}
+        self._station_index = None
+        self._archive = {}
+        self._rollups = {}
+
+    @staticmethod
+    def _apply(doc, updates):
+        for key, value in updates.items():
+            if isinstance(value, Increment):
+                doc[key] = (doc.get(key) or 0) + value.amount
+            elif value is DELETE_FIELD:
+                doc.pop(key, None)
+            else:
+                doc[key] = copy.deepcopy(value)
+
+    @_timed
+    def _get_station(self, station_id):
+        with self._lock:
+            station = self._stations.get(station_id)
+            self._record("read", 1 if station is not None else 0)
+            return copy.deepcopy(station)
+
+    @_timed
+    def create_station(self, station_id, data):
+        with self._lock:
+            self.station_cache.invalidate(station_id)
+            self._stations[station_id] = copy.deepcopy(data)
+            self._record("write")
+
+    @_timed
+    def update_station(self, station_id, updates):
+        with self._lock:
+            if station_id not in self._stations:
+                raise KeyError(f"No document to update: charging_stations/{station_id}")
+            self.station_cache.invalidate(station_id)
+            self._apply(self._stations[station_id], updates)
+            self._record("write")
+        self._notify(station_id)
+
+    @_timed
+    def update_stations(self, updates):
+        items = list(updates.items())
+        for start in range(0, len(items), MAX_BATCH_OPS):
+            chunk = items[start:start + MAX_BATCH_OPS]
+            with self._lock:
+                missing = [station_id for station_id, _ in chunk if station_id not in self._stations]
+                if missing:
+                    raise KeyError(f"No document to update: charging_stations/{missing[0]}")
+                self.station_cache.invalidate(*(station_id for station_id, _ in chunk))
+                for station_id, fields in chunk:
+                    self._apply(self._stations[station_id], fields)
+                self._record("write")
+            for station_id, _ in chunk:
+                self._notify(station_id)
+
+    def _notify(self, station_id):
+        with self._lock:
+            callbacks = list(self._watchers.get(station_id, ()))
+            data = copy.deepcopy(self._stations.get(station_id))
+        for callback in callbacks:
+            callback(copy.deepcopy(data))
+
+    def watch_station(self, station_id, callback):
+        with self._lock:
+            self._watchers.setdefault(station_id, []).append(callback)
+            data = copy.deepcopy(self._stations.get(station_id))
+        callback(data)
+
+        def unsubscribe():
+            with self._lock:
+                callbacks = self._watchers.get(station_id, [])
+                if callback in callbacks:
+                    callbacks.remove(callback)
+        return unsubscribe
+
+    @_timed
+    def find_station_by_email(self, email):
+        with self._lock:
+            for station in self._stations.values():
+                if station.get("email") == email:
+                    self._record("stream", 1)
+                    return copy.deepcopy(station)
+            self._record("stream")
+            return None
+
+    @_timed
+    def stream_stations(self):
+        with self._lock:
+            stations = copy.deepcopy(list(self._stations.items()))
+            self._record("stream", len(stations))
+        return iter(stations)
+
+    @_timed
+    def get_vehicle(self, station_id, vehicle_id):
+        with self._lock:
+            vehicle = self._vehicles.get(station_id, {}).get(vehicle_id)
+            self._record("read", 1 if vehicle is not None else 0)
+            if vehicle is None:
+                return None
+            return dict(copy.deepcopy(vehicle), id=vehicle_id)
+
+    @_timed
+    def list_vehicles(self, station_id):
+        with self._lock:
+            vehicles = [dict(copy.deepcopy(data), id=vehicle_id)
+                        for vehicle_id, data in self._vehicles.get(station_id, {}).items()]
+            self._record("stream", len(vehicles))
+        return vehicles
+
+    def new_vehicle_id(self, station_id):
+        return uuid.uuid4().hex[:20]
+
+    @_timed
+    def commit_vehicle_changes(self, station_id, added=None, updated=None, removed=(), station_updates=None,
+                               expected_version=None):
+        removed = list(removed)
+        with self._lock:
+            # Also on a conflict: the cached copy is what the caller planned from, and it is stale
+            self.station_cache.invalidate(station_id)
+            vehicles = self._vehicles.setdefault(station_id, {})
+            missing = [vehicle_id for vehicle_id in (updated or {}) if vehicle_id not in vehicles]
+            if missing:
+                raise KeyError(f"No document to update: vehicles/{missing[0]}")
+            if station_id not in self._stations:
+                raise KeyError(f"No document to update: charging_stations/{station_id}")
+            station = self._stations[station_id]
+            if expected_version is not None and (station.get("vehicles_version") or 0) != expected_version:
+                self._record("read", 1)
+                raise VersionConflict(station_id, expected_version, station.get("vehicles_version") or 0)
+            version = (station.get("vehicles_version") or 0) + 1
+            previous = {vehicle_id: copy.deepcopy(vehicles[vehicle_id])
+                        for vehicle_id in list(updated or {}) + removed if vehicle_id in vehicles}
+            # A vehicle removed since the caller looked keeps the tombstone, and session, of that removal
+            removed = [vehicle_id for vehicle_id in removed if vehicle_id in previous]
+            removed_at = datetime.now(timezone.utc)
+            rollup_docs = _rollup_docs(station_id, previous, added, removed, removed_at)
+            try:
+                _check_commit_size(station_id, added, updated, removed, rollup_docs)
+            except CommitTooLarge:
+                self._record("read", 1 + len(previous))
+                raise
+            counters = _updated_counters(station, previous, added, updated, removed)
+            slot_fields = {}
+            if "slot_free_at" not in (station_updates or {}):
+                slot_fields = _updated_slot_free_at(station, previous, added, updated, removed, removed_at)
+            for vehicle_id, data in (added or {}).items():
+                vehicles[vehicle_id] = dict(copy.deepcopy(data), version=version,
+                                            timestamp=datetime.now(timezone.utc))
+            for vehicle_id, fields in (updated or {}).items():
+                self._apply(vehicles[vehicle_id], dict(fields, version=version))
+            tombstones = self._tombstones.setdefault(station_id, {})
+            for vehicle_id in removed:
+                del vehicles[vehicle_id]
+                tombstones[vehicle_id] = {"version": version, "removed_at": removed_at,
+                                          "session": previous[vehicle_id]}
+            for doc_id, fields in rollup_docs.items():
+                self._apply(self._rollups.setdefault(doc_id, {}), fields)
+            self._apply(station, dict(station_updates or {}, vehicles_version=version,
+                                      last_change=_last_change(version, added, updated, removed),
+                                      **counters, **slot_fields))
+            self._record("read", 1 + len(previous))
+            self._record("write")
+        self._notify(station_id)
+        return version
+
+    @_timed
+    def acquire_lease(self, name, holder, ttl_seconds):
+        with self._lock:
+            lease = self._leases.get(name)
+            now = datetime.now(timezone.utc)
+            self._record("read", 1)
+            if lease is not None and lease["holder"] != holder and lease["expires_at"] > now:
+                return False
+            self._leases[name] = {"holder": holder, "expires_at": now + timedelta(seconds=ttl_seconds)}
+            self._record("write")
+            return True
+
+    @_timed
+    def release_lease(self, name, holder):
+        with self._lock:
+            if self._leases.get(name, {}).get("holder") == holder:
+                del self._leases[name]
+            self._record("write")
+
+    @_timed
+    def save_job_stats(self, job_name, stats):
+        with self._lock:
+            self._job_stats.setdefault(job_name, {}).update(copy.deepcopy(stats))
+            self._record("write")
+
+    @_timed
+    def save_station_index(self, snapshot):
+        with self._lock:
+            self._station_index = copy.deepcopy(snapshot)
+            self._record("write")
+
+    @_timed
+    def load_station_index(self):
+        with self._lock:
+            self._record("read", 1)
+            return copy.deepcopy(self._station_index)
+
+    @_timed
+    def find_due_vehicles(self, now):
+        due = {}
+        found = [0, 0]
+        with self._lock:
+            for station_id, vehicles in self._vehicles.items():
+                for vehicle_id, data in vehicles.items():
+                    departed = data.get("departure_ts") is not None and data["departure_ts"] <= now
+                    started = (data.get("status") == "WAITING" and data.get("charging_start_ts") is not None
+                               and data["charging_start_ts"] <= now)
+                    for index, matched in enumerate((departed, started)):
+                        if matched:
+                            due.setdefault(station_id, ([], []))[index].append(vehicle_id)
+                            found[index] += 1
+            self._record("stream", found[0])
+            self._record("stream", found[1])
+        return due
+
+    @_timed
+    def reconcile_counters(self, station_id):
+        with self._lock:
+            vehicles = list(self._vehicles.get(station_id, {}).values())
+            counters = vehicle_counters(vehicles)
+            self._record("read", 1)
+            self._record("stream", len(vehicles))
+            station = self._stations.get(station_id)
+            if station is not None and any(station.get(field) != value for field, value in counters.items()):
+                self.station_cache.invalidate(station_id)
+                self._apply(station, counters)
+                self._record("write")
+            return copy.deepcopy(counters)
+
+    @_timed
+    def list_vehicle_changes(self, station_id, since_version):
+        with self._lock:
+            changed = [dict(copy.deepcopy(data), id=vehicle_id)
+                       for vehicle_id, data in self._vehicles.get(station_id, {}).items()
+                       if (data.get("version") or 0) > since_version]
+            removed = [vehicle_id for vehicle_id, tombstone in self._tombstones.get(station_id, {}).items()
+                       if tombstone["version"] > since_version]
+            self._record("stream", len(changed))
+            self._record("stream", len(removed))
+        return changed, removed
+
+    @_timed
+    def prune_tombstones(self, station_id, before):
+        with self._lock:
+            tombstones = self._tombstones.get(station_id, {})
+            expired = [vehicle_id for vehicle_id, tombstone in tombstones.items() if tombstone["removed_at"] < before]
+            self._record("stream", len(expired))
+            if not expired:
+                return 0
+            floor = max(tombstones[vehicle_id]["version"] for vehicle_id in expired)
+            self._archive.update(build_segments(station_id, {vehicle_id: tombstones.pop(vehicle_id)
+                                                             for vehicle_id in expired}))
+            self.station_cache.invalidate(station_id)
+            self._stations.setdefault(station_id, {})["tombstone_floor"] = floor
+            self._record("write")
+            return len(expired)
+
+    @_timed
+    def list_archive_segments(self, first_day, last_day, station_id=None):
+        with self._lock:
+            segments = [copy.deepcopy(segment) for segment in self._archive.values()
+                        if first_day <= segment["day"] <= last_day
+                        and (station_id is None or segment["station_id"] == station_id)]
+            self._record("stream", len(segments))
+            return segments
+
+    @_timed
+    def list_rollups(self, station_id, start, end):
+        with self._lock:
+            rollups = [copy.deepcopy(rollup) for rollup in self._rollups.values()
+                       if rollup["station_id"] == station_id and start <= rollup["hour"] < end]
+            self._record("stream", len(rollups))
+            return rollups
+
+
+BACKENDS = {
+    "firestore": FirestoreStorage,
+    "memory": MemoryStorage,
+}
+
+
+def create_storage(backend=None):
+    """Create the storage backend named by ``backend`` or ``STORAGE_BACKEND``."""
+    backend = (backend or os.environ.get("STORAGE_BACKEND") or "firestore").lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown STORAGE_BACKEND '{backend}'. Expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[backend]()
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    The process's storage backend, created on first use. Nothing connects to
+    Firebase at import time, so gunicorn can preload the app and fork before any
+    gRPC channel exists; each worker then opens its own.
+    """
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+
+_fanout_pool = None
+_fanout_lock = threading.Lock()
+
+
+def gather(*calls):
+    """
+    Call each of ``calls`` (functions without arguments) at the same time and
+    return their results in order. The first runs on the calling thread and the
+    others on a pool shared by the process, each in a copy of the caller's
+    context, so their round-trips count towards the current request. Only pass
+    calls that do not depend on each other. If any call raises, the first
+    exception in order is raised once all of them have finished.
+    """
+    global _fanout_pool
+    if len(calls) < 2 or STORAGE_FANOUT_WORKERS < 1:
+        return [call() for call in calls]
+    if _fanout_pool is None:
+        with _fanout_lock:
+            if _fanout_pool is None:
+                # Created on first use like the backend, so no thread exists before gunicorn forks
+                _fanout_pool = ThreadPoolExecutor(max_workers=STORAGE_FANOUT_WORKERS,
+                                                  thread_name_prefix="storage-fanout")
+    futures = [_fanout_pool.submit(contextvars.copy_context().run, call) for call in calls[1:]]
+    try:
+        first = calls[0]()
+    finally:
+        errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [first] + [future.result() for future in futures]
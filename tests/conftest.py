@@ -0,0 +1,18 @@
+import os
+import sys
+
+# The modules live at the repository root; the tests never talk to Firestore
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def memory_storage(monkeypatch):
+    """A fresh MemoryStorage as the process's storage backend."""
+    backend = storage.MemoryStorage()
+    monkeypatch.setattr(storage, "_storage", backend)
+    return backend
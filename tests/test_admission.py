@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import auth
+from slots import TimelineCache
+
+
+@pytest.fixture
+def station(memory_storage, monkeypatch):
+    monkeypatch.setattr(auth, "timelines", TimelineCache())
+    monkeypatch.setattr(auth, "ADMISSION_BACKOFF_SECONDS", 0)
+    memory_storage.create_station("s1", {"name": "Station", "access_key": "key", "total_slots": 1,
+                                         "available_slots": 1, "chargingType": "CCS"})
+    return "s1"
+
+
+def booking(start):
+    return {"vehicle_number": "KA01", "slot_number": 1, "status": "WAITING", "arrival_ts": start,
+            "charging_start_ts": start, "departure_ts": start + timedelta(minutes=30)}
+
+
+def add_plan(vehicle_id, start, before_commit=None):
+    """A plan adding one vehicle; ``before_commit`` runs after planning, e.g. to write in between."""
+    attempts = []
+
+    def plan(station_data, timeline):
+        attempts.append(station_data.get("vehicles_version", 0))
+        if before_commit is not None:
+            before_commit(len(attempts))
+        return {"added": {vehicle_id: booking(start)}}, lambda t: None
+
+    return plan, attempts
+
+
+def test_planned_change_is_planned_again_after_a_concurrent_write(memory_storage, station):
+    start = datetime.now(timezone.utc) + timedelta(hours=1)
+
+    def concurrent_add(attempt):
+        if attempt == 1:
+            memory_storage.commit_vehicle_changes(station, added={"other": booking(start)})
+
+    plan, attempts = add_plan("mine", start, concurrent_add)
+    _, version, conflicts = auth.commit_planned_change(station, plan)
+
+    assert conflicts == 1
+    # The second plan saw the concurrent vehicle
+    assert attempts == [0, 1]
+    station_data = memory_storage.get_station(station, cached=False)
+    assert version == station_data["vehicles_version"] == 2
+    assert station_data["admission_conflicts"] == 1
+    assert {vehicle["id"] for vehicle in memory_storage.list_vehicles(station)} == {"other", "mine"}
+
+
+def test_planned_change_fails_with_409_when_every_attempt_conflicts(memory_storage, station):
+    start = datetime.now(timezone.utc) + timedelta(hours=1)
+
+    def concurrent_add(attempt):
+        memory_storage.commit_vehicle_changes(station, added={f"other{attempt}": booking(start)})
+
+    plan, attempts = add_plan("mine", start, concurrent_add)
+    with pytest.raises(auth.InvalidUsage) as raised:
+        auth.commit_planned_change(station, plan)
+
+    assert raised.value.status_code == 409
+    assert len(attempts) == auth.ADMISSION_ATTEMPTS
+    assert "mine" not in {vehicle["id"] for vehicle in memory_storage.list_vehicles(station)}
+
+
+def test_remove_vehicle_answers_409_when_the_station_stays_busy(memory_storage, station, monkeypatch):
+    start = datetime.now(timezone.utc) + timedelta(hours=1)
+    memory_storage.commit_vehicle_changes(station, added={"x": booking(start)})
+    commit = memory_storage.commit_vehicle_changes
+
+    def always_behind(station_id, **changes):
+        # Another request always writes between this one's read and its commit
+        commit(station_id, station_updates={"name": "Station"})
+        return commit(station_id, **changes)
+
+    monkeypatch.setattr(memory_storage, "commit_vehicle_changes", always_behind)
+    client = auth.app.test_client()
+    with client.session_transaction() as session:
+        session["station_id"] = station
+    response = client.post("/remove_vehicle", json={"vehicle_id": "x"})
+
+    assert response.status_code == 409
+    assert response.get_json()["error"] == "The station is busy right now, please try again."
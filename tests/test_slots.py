@@ -0,0 +1,68 @@
+from slots import SLOT_BUFFER_MINUTES, SlotTimeline
+
+NOW = 30_000_000
+
+
+def timeline_with(*vehicles, total_slots=1):
+    """A timeline of ``(vehicle_id, slot, start, departure, arrival)`` bookings stored as WAITING."""
+    timeline = SlotTimeline(total_slots)
+    for vehicle_id, slot, start, departure, arrival in vehicles:
+        timeline.add(vehicle_id, slot, start, departure, True, arrival)
+    return timeline
+
+
+def test_place_uses_a_gap_long_enough_for_the_charge():
+    timeline = timeline_with(("a", 1, NOW, NOW + 60, NOW), ("b", 1, NOW + 130, NOW + 190, NOW + 130))
+    assert timeline.place(NOW, 60) == (1, NOW + 60 + SLOT_BUFFER_MINUTES)
+
+
+def test_place_skips_a_gap_too_short_for_the_charge():
+    timeline = timeline_with(("a", 1, NOW, NOW + 60, NOW), ("b", 1, NOW + 100, NOW + 160, NOW + 100))
+    assert timeline.place(NOW, 60) == (1, NOW + 160 + SLOT_BUFFER_MINUTES)
+
+
+def test_place_picks_the_slot_free_first():
+    timeline = timeline_with(("a", 1, NOW, NOW + 90, NOW), ("b", 2, NOW, NOW + 30, NOW), total_slots=2)
+    assert timeline.place(NOW, 60) == (2, NOW + 30 + SLOT_BUFFER_MINUTES)
+
+
+def test_place_never_starts_a_past_arrival_before_now():
+    timeline = timeline_with(("a", 1, NOW - 400, NOW - 300, NOW - 400), ("b", 1, NOW + 100, NOW + 200, NOW + 100))
+    # Without now the gap that has already passed is used
+    assert timeline.place(NOW - 240, 60) == (1, NOW - 240)
+    assert timeline.place(NOW - 240, 60, NOW) == (1, NOW)
+
+
+def test_place_clamped_to_now_still_needs_the_whole_gap():
+    timeline = timeline_with(("a", 1, NOW - 400, NOW - 300, NOW - 400), ("b", 1, NOW + 30, NOW + 90, NOW + 30))
+    assert timeline.place(NOW - 240, 60, NOW) == (1, NOW + 90 + SLOT_BUFFER_MINUTES)
+
+
+def test_reflow_moves_waiting_vehicles_into_freed_time():
+    timeline = timeline_with(("a", 1, NOW - 30, NOW + 30, NOW - 30), ("b", 1, NOW + 31, NOW + 91, NOW - 10))
+    timeline.remove_many(["a"])
+    moves = timeline.reflow(NOW)
+    start = NOW + SLOT_BUFFER_MINUTES
+    assert moves == {"b": (1, start, start + 60, NOW - 10)}
+    assert timeline.place(start, 60) == (1, start + 60 + SLOT_BUFFER_MINUTES)
+
+
+def test_reflow_keeps_vehicles_that_cannot_start_before_their_arrival():
+    timeline = timeline_with(("a", 1, NOW - 30, NOW + 30, NOW - 30), ("b", 1, NOW + 120, NOW + 180, NOW + 120))
+    timeline.remove_many(["a"])
+    assert timeline.reflow(NOW) == {}
+
+
+def test_reflow_never_moves_a_vehicle_later():
+    # Overlapping bookings (e.g. stored by an older version): placing "b" again would start it after "a"
+    timeline = timeline_with(("a", 1, NOW, NOW + 60, NOW), ("b", 1, NOW + 10, NOW + 40, NOW + 10))
+    assert timeline.reflow(NOW) == {}
+    assert timeline.slot_free_at(1) == NOW + 60
+
+
+def test_reflow_keeps_the_charging_duration():
+    timeline = timeline_with(("a", 1, NOW + 5, NOW + 50, NOW), ("b", 2, NOW + 100, NOW + 145, NOW), total_slots=2)
+    moves = timeline.reflow(NOW)
+    slot, start, departure, _ = moves["b"]
+    assert (slot, departure - start) == (2, 45)
+    assert start < NOW + 100
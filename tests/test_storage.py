@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta, timezone
+
+import archive
+from storage import DELETE_FIELD, _updated_slot_free_at
+from timeutil import to_minutes
+
+NOW = datetime(2026, 10, 18, 12, 0, tzinfo=timezone.utc)
+
+
+def vehicle(slot, departure, **fields):
+    return dict({"slot_number": slot, "status": "CHARGING", "departure_ts": departure}, **fields)
+
+
+def test_slot_free_at_is_left_alone_without_a_map():
+    added = {"x": vehicle(1, NOW + timedelta(hours=1))}
+    assert _updated_slot_free_at({}, {}, added, None, [], NOW) == {}
+
+
+def test_slot_free_at_follows_a_later_departure():
+    station = {"slot_free_at": {"1": NOW + timedelta(minutes=30)}}
+    added = {"x": vehicle(1, NOW + timedelta(hours=1)), "y": vehicle(2, NOW + timedelta(minutes=10))}
+    assert _updated_slot_free_at(station, {}, added, None, [], NOW) == {
+        "slot_free_at": {"1": NOW + timedelta(hours=1), "2": NOW + timedelta(minutes=10)}}
+
+
+def test_slot_free_at_keeps_a_later_departure():
+    station = {"slot_free_at": {"1": NOW + timedelta(hours=2)}}
+    added = {"x": vehicle(1, NOW + timedelta(hours=1))}
+    assert _updated_slot_free_at(station, {}, added, None, [], NOW) == station
+
+
+def test_slot_free_at_is_unchanged_by_a_departed_vehicle_leaving():
+    station = {"slot_free_at": {"1": NOW + timedelta(hours=1)}}
+    previous = {"x": vehicle(1, NOW - timedelta(minutes=5))}
+    assert _updated_slot_free_at(station, previous, None, None, ["x"], NOW) == station
+
+
+def test_slot_free_at_is_dropped_when_the_last_vehicle_leaves_early():
+    station = {"slot_free_at": {"1": NOW + timedelta(hours=1)}}
+    previous = {"x": vehicle(1, NOW + timedelta(hours=1))}
+    assert _updated_slot_free_at(station, previous, None, None, ["x"], NOW) == {"slot_free_at": DELETE_FIELD}
+
+
+def test_slot_free_at_is_dropped_for_a_vehicle_without_departure():
+    station = {"slot_free_at": {"1": NOW + timedelta(hours=1)}}
+    added = {"x": vehicle(1, None)}
+    assert _updated_slot_free_at(station, {}, added, None, [], NOW) == {"slot_free_at": DELETE_FIELD}
+
+
+def test_slot_free_at_follows_a_moved_vehicle():
+    station = {"slot_free_at": {"1": NOW + timedelta(hours=1), "2": NOW + timedelta(hours=3)}}
+    previous = {"x": vehicle(2, NOW + timedelta(hours=3))}
+    moved = {"x": {"slot_number": 1, "departure_ts": NOW + timedelta(hours=2)}}
+    # Slot 2's next departure is not known here, so the map is left for the sweep to rebuild
+    assert _updated_slot_free_at(station, previous, None, moved, [], NOW) == {"slot_free_at": DELETE_FIELD}
+
+
+def departed_vehicle():
+    now = datetime.now(timezone.utc)
+    return vehicle(1, now - timedelta(hours=1), arrival_ts=now - timedelta(hours=2),
+                   charging_start_ts=now - timedelta(hours=2), vehicle_number="KA01", charging_cost=120)
+
+
+def test_removing_a_vehicle_twice_keeps_its_session(memory_storage):
+    memory_storage.create_station("s1", {"name": "Station", "total_slots": 1})
+    memory_storage.commit_vehicle_changes("s1", added={"x": departed_vehicle()})
+    # The sweep finds the departed vehicle, then staff remove it before the sweep gets to the station
+    departed, _ = memory_storage.find_due_vehicles(datetime.now(timezone.utc))["s1"]
+    removed_version = memory_storage.commit_vehicle_changes("s1", removed=["x"])
+    version = memory_storage.commit_vehicle_changes("s1", removed=departed)
+
+    # The tombstone still records the first removal
+    assert memory_storage.list_vehicle_changes("s1", removed_version - 1) == ([], ["x"])
+    assert memory_storage.list_vehicle_changes("s1", removed_version) == ([], [])
+    station = memory_storage.get_station("s1", cached=False)
+    assert station["last_change"] == {"version": version, "added": [], "updated": [], "removed": []}
+    assert station["vehicle_count"] == 0
+
+    start = to_minutes(datetime.now(timezone.utc)) - 60
+    memory_storage.prune_tombstones("s1", datetime.now(timezone.utc) + timedelta(seconds=1))
+    sessions = list(archive.read_sessions(memory_storage, start, start + 120, "s1"))
+    assert [(session["id"], session["vehicle_number"]) for session in sessions] == [("x", "KA01")]
@@ -0,0 +1,104 @@
+"""
+Time handling for the scheduling core.
+
+Inside the app a point in time is an ``int`` of epoch minutes (whole minutes
+since 1970-01-01 UTC). Minutes compare, sort and subtract directly, carry no
+timezone ambiguity and work across midnight and across days.
+
+Vehicles store their times as timezone-aware timestamps (``arrival_ts``,
+``charging_start_ts``, ``departure_ts``), which convert to epoch minutes
+without any parsing. Text is only produced at the edge (templates, JSON
+responses), in the station timezone. Vehicles written before the timestamps
+existed only carry ``'%Y-%m-%d %H:%M'`` strings in station time; those are
+parsed as a fallback until ``scheduler.py --backfill`` has added timestamps.
+"""
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+# A bare "HH:MM" arrival is taken to be the occurrence closest to now, at most this far away
+ARRIVAL_WINDOW_MINUTES = 12 * 60
+
+
+def _station_timezone():
+    for name in (os.environ.get("STATION_TZ"), os.environ.get("TZ"), "Asia/Kolkata"):
+        if name:
+            try:
+                return ZoneInfo(name.lstrip(":"))
+            except (ZoneInfoNotFoundError, ValueError):
+                continue
+    return timezone.utc
+
+
+# Stations run on local time (the deployment sets TZ); STATION_TZ overrides it
+STATION_TZ = _station_timezone()
+
+
+def now_minutes():
+    """The current time in epoch minutes."""
+    return int(time.time() // 60)
+
+
+def to_minutes(dt):
+    """Epoch minutes of ``dt``. Naive datetimes are read as station time."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=STATION_TZ)
+    return int(dt.timestamp() // 60)
+
+
+def to_timestamp(minutes):
+    """Timezone-aware UTC datetime for epoch minutes, as stored in the ``*_ts`` fields."""
+    return datetime.fromtimestamp(minutes * 60, timezone.utc)
+
+
+def to_local(minutes):
+    """Timezone-aware datetime in station time for epoch minutes."""
+    return datetime.fromtimestamp(minutes * 60, STATION_TZ)
+
+
+def format_minutes(minutes, fmt=TIME_FORMAT):
+    """Station-time text for epoch minutes; only for display and API responses."""
+    return to_local(minutes).strftime(fmt)
+
+
+def parse_local(text, fmt=TIME_FORMAT):
+    """Epoch minutes of a station-time string."""
+    return to_minutes(datetime.strptime(text, fmt))
+
+
+def vehicle_minutes(vehicle, name):
+    """
+    Epoch minutes of a vehicle's ``arrival``, ``charging_start`` or ``departure``,
+    or None if it has none. Raises ValueError for an unreadable legacy string.
+    """
+    ts = vehicle.get(f"{name}_ts")
+    if ts is not None:
+        return to_minutes(ts)
+    text = vehicle.get(f"{name}_time")
+    return parse_local(text) if text else None
+
+
+def resolve_arrival(time_text, date_text=None, now=None):
+    """
+    Epoch minutes of an arrival entered as ``HH:MM``, optionally with a
+    ``YYYY-MM-DD`` date, or as a full ``YYYY-MM-DDTHH:MM`` / ``YYYY-MM-DD HH:MM``.
+    Without a date the occurrence of ``HH:MM`` closest to ``now`` is used, so
+    00:30 entered at 23:50 means the next day. Raises ValueError if unreadable.
+    """
+    time_text = (time_text or "").strip().replace("T", " ")
+    if " " in time_text:
+        return parse_local(time_text)
+    if date_text:
+        return parse_local(f"{date_text.strip()} {time_text}")
+    clock = datetime.strptime(time_text, "%H:%M")
+    today = to_local(now_minutes() if now is None else now)
+    candidate = to_minutes(datetime.combine(today.date(), clock.time()))
+    now = to_minutes(today)
+    for day_shift in (-1, 1):
+        shifted = to_minutes(datetime.combine(today.date() + timedelta(days=day_shift), clock.time()))
+        if abs(shifted - now) < abs(candidate - now) and abs(shifted - now) <= ARRIVAL_WINDOW_MINUTES:
+            candidate = shifted
+    return candidate